@@ -8,21 +8,39 @@ import matplotlib.pyplot as plt
 from datetime import datetime
 import numpy as np
 import cv2
+from PIL import Image
 import os
+import sys
 import time
 import collections
 from pathlib import Path
 import argparse
 import json
+import sqlite3
+import hashlib
+import heapq
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from array import array
+import tempfile
+import pickle
+import threading
 import warnings
 warnings.filterwarnings('ignore')
 
+BLOCK_BYTES = 2 ** 23 # size of the blocks of image matrices compared at once, small enough to stay in cache
+CASCADE_GRID = 8 # grid of the block means of the cascade comparison, compared after the mean color
+CASCADE_ROWS = 8 # rows summed per step of the early-abort mse of the cascade comparison
+CASCADE_DENSE = 1 / 32 # share of pairs left after the coarse levels above which the full resolution of a block is compared at once
+PARALLEL_WINDOW = 4 # tiles per worker submitted ahead of the one whose matches are merged when comparing in a process pool
+REDUCED_DECODE_MIN = 4 # with reduced_decode JPEGs are downscaled on decode only while their shorter side stays this many times px_size, closer to px_size the diffs drift more
+
 class dif:
 
-    def __init__(self, directory_A, directory_B=None, similarity="normal", px_size=50, show_progress=True, show_output=False, delete=False, silent_del=False):
+    def __init__(self, directory_A, directory_B=None, similarity="normal", px_size=50, show_progress=True, show_output=False, delete=False, silent_del=False, cache_dir=None, workers=1, index=False, library=False, mirror=False, canonical=False, cascade=False, fingerprints=None, catalog=None, reduced_decode=False):
         """
-        directory_A (str)........folder path to search for duplicate/similar images
-        directory_B (str)........second folder path to search for duplicate/similar images
+        directory_A (str)........folder path to search for duplicate/similar images, a DirectoryIndex of the folder or a list of file paths
+        directory_B (str)........second folder path to search for duplicate/similar images, a DirectoryIndex of the folder or a list of file paths
         similarity (str, int)...."normal" = searches for duplicates, recommended setting, MSE < 200
                                  "high" = serached for exact duplicates, extremly sensitive to details, MSE < 0.1
                                  "low" = searches for similar images, MSE < 1000
@@ -39,13 +57,38 @@ class dif:
         silent_del (bool)........! please use with care, as this cannot be undone
                                  True = skips the asking for user confirmation when deleting lower resolution duplicate images
                                  will only work if "delete" AND "silent_del" are both == True
+        cache_dir (str)..........folder where the image matrices are cached between runs
+                                 only new or modified files are decoded again, None = no caching
+        workers (int)............number of processes used to decode and compare the images, 1 = everything runs in this process
+        index (bool, int)........False = compares every pair of images
+                                 True = compares only images whose perceptual hashes are close in a BK-tree,
+                                 with the max hamming distance mapped from the similarity grade
+                                 or any int, which will be used as max hamming distance
+        library (bool)...........True = directory_B is an already deduplicated library, directory_A is a batch of new images
+                                 which is searched against the library and against itself, pairs within the library are never compared
+                                 library images are never reported as lower quality, with cache_dir set they are not decoded again
+                                 directory_B can be a FingerprintLibrary, which is searched without reading the library again
+        mirror (bool)............True = also compares horizontally mirrored images, not only rotated ones
+        canonical (bool).........True = every image is turned to a canonical orientation once, so each pair is compared only once
+                                 instead of once per rotation (and mirror), faster but may miss rotated copies of symmetric images
+        cascade (bool)...........True = pairs are first compared by mean color and 8x8 block means and rejected when these already
+                                 prove the mse too high, the remaining pairs get a full comparison that stops once it exceeds the
+                                 similarity grade, same results, faster when few images are alike
+        fingerprints (dict)......matrices of files that are known already by file path, made with dif.fingerprint from the bytes
+                                 of the file, these files are not read and decoded again, None = every file is decoded or taken from the cache
+        catalog (ImageCatalog)...header facts of the images, the image with the higher resolution is kept and the file size only decides
+                                 between images of the same resolution, None = the bigger file is kept
+        reduced_decode (bool)....True = big JPEGs are downscaled by 2, 4 or 8 while they are decoded, much faster for photos, but the
+                                 DCT downscale averages where the resize of the full image samples, so diffs of JPEGs move by about
+                                 3 to 10 MSE (up to 14) at px_size 50 and results near the similarity grade can differ
+                                 False = every image is fully decoded, the diffs are the ones of the original difPy
 
         OUTPUT (set).............a dictionary with the filename of the duplicate images 
                                and a set of lower resultion images of all duplicates
 
         *** CLI-Interface ***
         dif.py [-h] -A DIRECTORY_A [-B [DIRECTORY_B]] [-Z [OUTPUT_DIRECTORY]] [-s [{low,normal,high}]] [-px [PX_SIZE]]
-               [-p [{True,False}]] [-o [{True,False}]] [-d [{True,False}]] [-D [{True,False}]]
+               [-p [{True,False}]] [-o [{True,False}]] [-d [{True,False}]] [-D [{True,False}]] [-c [CACHE_DIR]] [-w [WORKERS]] [-i [INDEX]] [-L] [-m] [-C] [-x] [-R] [-r]
         
         OUTPUT.................output data is written to files and saved in the working directory
                                difPy_results_xxx_.json
@@ -55,31 +98,67 @@ class dif:
         start_time = time.time()        
         print("DifPy process initializing...", end="\r")
 
-        dif._validate_parameters(show_output, show_progress, similarity, px_size, delete, silent_del)
+        dif._validate_parameters(show_output, show_progress, similarity, px_size, delete, silent_del, workers, index, library, directory_B, mirror, canonical, cascade, catalog, reduced_decode)
+
+        cache = FingerprintCache(cache_dir, px_size, reduced_decode) if cache_dir != None else None
+        index_distance = dif._map_index_distance(index, similarity)
+        transforms, canonical_transforms = dif._map_transforms(mirror, canonical)
+        img_matrices_B = None
 
         if directory_B == None:
             # process one directory
             directory_A = dif._process_directory(directory_A)
-            img_matrices_A, folderfiles_A = dif._create_imgs_matrix(directory_A, px_size, show_progress)
+            # byte identical files are collapsed first, only one file of each group is decoded and compared
+            folderfiles_A, exact_A = dif._find_exact_duplicates(dif._list_files(directory_A), show_progress, dif._file_sizes(directory_A))
+            img_matrices_A, folderfiles_A = dif._create_imgs_matrix(directory_A, px_size, show_progress, cache, workers, folderfiles_A, cache_dir, canonical_transforms, fingerprints, False, reduced_decode)
             ref = dif._map_similarity(similarity)
             result, lower_quality, total = dif._search_one_dir(img_matrices_A, folderfiles_A, 
-                                                               ref, show_output, show_progress)
+                                                               ref, show_output, show_progress, index_distance, exact_A, workers, transforms, cascade, catalog)
+        elif library:
+            # process new images against a library
+            directory_A = dif._process_directory(directory_A)
+            directory_B = dif._process_directory(directory_B)
+            folderfiles_A, exact_A = dif._find_exact_duplicates(dif._list_files(directory_A), show_progress, dif._file_sizes(directory_A))
+            img_matrices_A, folderfiles_A = dif._create_imgs_matrix(directory_A, px_size, show_progress, cache, workers, folderfiles_A, cache_dir, canonical_transforms, fingerprints, False, reduced_decode)
+            # the library is compared straight from the cache or the FingerprintLibrary, so its matrices are not copied on every search
+            if isinstance(directory_B, FingerprintLibrary):
+                img_matrices_B, folderfiles_B = directory_B.matrices()
+            else:
+                img_matrices_B, folderfiles_B = dif._create_imgs_matrix(directory_B, px_size, show_progress, cache, workers, None, cache_dir, canonical_transforms, fingerprints, True, reduced_decode)
+            ref = dif._map_similarity(similarity)
+            result, lower_quality, total = dif._search_library(img_matrices_A, folderfiles_A,
+                                                               img_matrices_B, folderfiles_B,
+                                                               ref, show_output, show_progress, index_distance, exact_A, workers, transforms, cascade, catalog)
         else:
             # process two directories
             directory_A = dif._process_directory(directory_A)
             directory_B = dif._process_directory(directory_B)
-            img_matrices_A, folderfiles_A = dif._create_imgs_matrix(directory_A, px_size, show_progress)
-            img_matrices_B, folderfiles_B = dif._create_imgs_matrix(directory_B, px_size, show_progress)
+            img_matrices_A, folderfiles_A = dif._create_imgs_matrix(directory_A, px_size, show_progress, cache, workers, None, cache_dir, canonical_transforms, fingerprints, False, reduced_decode)
+            img_matrices_B, folderfiles_B = dif._create_imgs_matrix(directory_B, px_size, show_progress, cache, workers, None, cache_dir, canonical_transforms, fingerprints, False, reduced_decode)
             ref = dif._map_similarity(similarity)
             result, lower_quality, total = dif._search_two_dirs(img_matrices_A, folderfiles_A,
                                                                 img_matrices_B, folderfiles_B,
-                                                                ref, show_output, show_progress)
+                                                                ref, show_output, show_progress, index_distance, workers, transforms, cascade, catalog)
+
+        if cache != None:
+            cache.close()
+
+        # the memory-mapped files can only be removed once nothing maps them
+        store_files = [getattr(img_matrices, "filename", None) for img_matrices in (img_matrices_A, img_matrices_B)]
+        img_matrices_A = img_matrices_B = None
+        for filename in store_files:
+            dif._remove_imgs_matrix(filename)
 
         end_time = time.time()
         time_elapsed = np.round(end_time - start_time, 4)
         stats = dif._generate_stats(directory_A, directory_B, 
                                     time.localtime(start_time), time.localtime(end_time), time_elapsed, 
                                     similarity, total, len(result))
+        stats["index_distance"] = index_distance
+        stats["library"] = library
+        stats["mirror"] = mirror
+        stats["canonical"] = canonical
+        stats["cascade"] = cascade
 
         self.result = result
         self.lower_quality = lower_quality
@@ -104,8 +183,113 @@ class dif:
                 else:
                     dif._delete_imgs(set(lower_quality))
 
+    def iter_clusters(directory_A, directory_B=None, similarity="normal", px_size=50, show_progress=True, cache_dir=None, workers=1, index=False, library=False, mirror=False, canonical=False, cascade=False, fingerprints=None, catalog=None, reduced_decode=False):
+        """
+        Generator that yields clusters of duplicate/similar images while the comparison is still running
+        a cluster is yielded as soon as no later comparison can add an image to it
+        parameters are the same as for dif
+
+        YIELDS (list)............paths of all images of one cluster, the image with the highest quality first
+                                 and the lower quality images after it, in library mode an image of the library is first
+                                 unlike result, every image is only in one cluster, also when it's only similar through another image
+        """
+        dif._validate_parameters(False, show_progress, similarity, px_size, False, False, workers, index, library, directory_B, mirror, canonical, cascade, catalog, reduced_decode)
+
+        cache = FingerprintCache(cache_dir, px_size, reduced_decode) if cache_dir != None else None
+        index_distance = dif._map_index_distance(index, similarity)
+        transforms, canonical_transforms = dif._map_transforms(mirror, canonical)
+        ref = dif._map_similarity(similarity)
+        img_matrices_A = img_matrices_B = None
+
+        try:
+            directory_A = dif._process_directory(directory_A)
+            exact_A = {}
+            if directory_B == None or library:
+                folderfiles_A, exact_A = dif._find_exact_duplicates(dif._list_files(directory_A), show_progress, dif._file_sizes(directory_A))
+                img_matrices_A, folderfiles_A = dif._create_imgs_matrix(directory_A, px_size, show_progress, cache, workers, folderfiles_A, cache_dir, canonical_transforms, fingerprints, False, reduced_decode)
+            else:
+                img_matrices_A, folderfiles_A = dif._create_imgs_matrix(directory_A, px_size, show_progress, cache, workers, None, cache_dir, canonical_transforms, fingerprints, False, reduced_decode)
+            folderfiles_B = None
+            if directory_B != None:
+                directory_B = dif._process_directory(directory_B)
+                if isinstance(directory_B, FingerprintLibrary):
+                    img_matrices_B, folderfiles_B = directory_B.matrices()
+                else:
+                    img_matrices_B, folderfiles_B = dif._create_imgs_matrix(directory_B, px_size, show_progress, cache, workers, None, cache_dir, canonical_transforms, fingerprints, library, reduced_decode)
+            if cache != None:
+                cache.close()
+                cache = None
+
+            # pairs as (index in A, key of the other image), keys are ("A", index), ("B", index) or ("copy", file)
+            if directory_B == None:
+                pairs = ((count_A, ("A", count_B)) for count_A, count_B, transform, err in
+                         dif._matches(img_matrices_A, img_matrices_A, ref, True, show_progress, index_distance, workers, transforms, cascade))
+            elif library:
+                pairs = ((count_A, ("B", count_B) if source == 0 else ("A", count_B)) for count_A, source, count_B in heapq.merge(
+                         ((count_A, 0, count_B) for count_A, count_B, transform, err in dif._matches(img_matrices_A, img_matrices_B, ref, False, show_progress, index_distance, workers, transforms, cascade)),
+                         ((count_A, 1, count_B) for count_A, count_B, transform, err in dif._matches(img_matrices_A, img_matrices_A, ref, True, False, index_distance, workers, transforms, cascade))))
+            else:
+                pairs = ((count_A, ("B", count_B)) for count_A, count_B, transform, err in
+                         dif._matches(img_matrices_A, img_matrices_B, ref, False, show_progress, index_distance, workers, transforms, cascade))
+
+            clusters = UnionFind()
+            positions = {file: count for count, file in enumerate(folderfiles_A)}
+            for file, copies in exact_A.items():
+                if file in positions:
+                    for copy in copies:
+                        clusters.union(("A", positions[file]), ("copy", copy), positions[file])
+
+            for count_A, key_B in pairs:
+                # pairs come ordered by count_A, clusters that only hold images of A before it are finished
+                for members in clusters.pop_closed(count_A):
+                    yield dif._order_cluster(members, folderfiles_A, folderfiles_B, library, catalog)
+                closing = count_A if key_B[0] == "B" else max(count_A, key_B[1])
+                clusters.union(("A", count_A), key_B, closing if key_B[0] == "A" else float("inf"))
+            for members in clusters.pop_closed(float("inf"), True):
+                yield dif._order_cluster(members, folderfiles_A, folderfiles_B, library, catalog)
+        finally:
+            if cache != None:
+                cache.close()
+            store_files = [getattr(img_matrices, "filename", None) for img_matrices in (img_matrices_A, img_matrices_B)]
+            img_matrices_A = img_matrices_B = None
+            for filename in store_files:
+                dif._remove_imgs_matrix(filename)
+
+    def fingerprint(data, px_size=50, reduced_decode=False):
+        """
+        Matrix of an image from the bytes of its file, the same one dif creates when it reads the file,
+        so a program that has the encoded file in memory can hand it to dif with the fingerprints parameter
+
+        data (bytes).............content of the image file
+        px_size (int)............size of the matrix, has to be the px_size of the search
+        reduced_decode (bool)....has to be the reduced_decode of the search
+
+        OUTPUT (ndarray).........px_size x px_size x 3 uint8 matrix, None if the data is not an image
+        """
+        return dif._decode_img_matrix(np.frombuffer(data, dtype=np.uint8), px_size, reduced_decode)
+
+    # Function that turns the keys of a cluster into paths ordered by quality, highest first
+    def _order_cluster(members, folderfiles_A, folderfiles_B, library, catalog=None):
+        paths = []
+        for source, item in sorted(members, key=lambda member: (member[0] == "copy", member[1] if member[0] != "copy" else 0)):
+            if source == "A":
+                paths.append((source, Path(folderfiles_A[item][0]) / folderfiles_A[item][1]))
+            elif source == "B":
+                paths.append((source, Path(folderfiles_B[item][0]) / folderfiles_B[item][1]))
+            else:
+                paths.append((source, Path(item[0]) / item[1]))
+        qualities = {}
+        for source, path in paths:
+            try:
+                qualities[path] = dif._quality_key(path, catalog)
+            except OSError:
+                qualities[path] = (-1, -1)
+        # sorted is stable, so images of the same quality keep the order in which they were found
+        paths.sort(key=lambda item: (not (library and item[0] == "B"), -qualities[item[1]][0], -qualities[item[1]][1]))
+        return [str(path) for source, path in paths]
+
     # Function that validates the input parameters of DifPy
-    def _validate_parameters(show_output, show_progress, similarity, px_size, delete, silent_del):
+    def _validate_parameters(show_output, show_progress, similarity, px_size, delete, silent_del, workers=1, index=False, library=False, directory_B=None, mirror=False, canonical=False, cascade=False, catalog=None, reduced_decode=False):
         # validate the parameters of the function
         if show_output != True and show_output != False:
             raise ValueError('Invalid value for "show_output" parameter.')
@@ -124,109 +308,297 @@ class dif:
             raise ValueError('Invalid value for "delete" parameter.')
         if silent_del != True and silent_del != False:
             raise ValueError('Invalid value for "silent_del" parameter.')
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError('Invalid value for "workers" parameter.')
+        if index != True and index != False and (not isinstance(index, int) or index < 0 or index > 64):
+            raise ValueError('Invalid value for "index" parameter.')
+        if library != True and library != False:
+            raise ValueError('Invalid value for "library" parameter.')
+        if library and directory_B == None:
+            raise ValueError('Parameter "library" needs "directory_B" with the library folder.')
+        if isinstance(directory_B, FingerprintLibrary) and (not library or directory_B.px_size != px_size or directory_B.reduced_decode != reduced_decode or directory_B.canonical_transforms != dif._map_transforms(mirror, canonical)[1]):
+            raise ValueError('Invalid value for "directory_B" parameter.')
+        if mirror != True and mirror != False:
+            raise ValueError('Invalid value for "mirror" parameter.')
+        if canonical != True and canonical != False:
+            raise ValueError('Invalid value for "canonical" parameter.')
+        if cascade != True and cascade != False:
+            raise ValueError('Invalid value for "cascade" parameter.')
+        if catalog != None and not isinstance(catalog, ImageCatalog):
+            raise ValueError('Invalid value for "catalog" parameter.')
+        if reduced_decode != True and reduced_decode != False:
+            raise ValueError('Invalid value for "reduced_decode" parameter.')
 
-    # Function that processes the directories that were input as parameters
+    # Function that processes the directories that were input as parameters, a DirectoryIndex or a FingerprintLibrary is kept as it is
+    # and a list of files becomes a list of paths
     def _process_directory(directory):
-        directory = Path(directory)
+        if isinstance(directory, FingerprintLibrary):
+            return directory
+        if isinstance(directory, (list, tuple)):
+            for path in directory:
+                if not os.path.isfile(path):
+                    raise FileNotFoundError(f"File {Path(path)} does not exist")
+            return [Path(path) for path in directory]
+        if not isinstance(directory, DirectoryIndex):
+            directory = Path(directory)
         # check if directories are valid
         if not os.path.isdir(directory):
-            raise FileNotFoundError(f"Directory " + str(directory) + " does not exist")
+            raise FileNotFoundError(f"Directory {Path(directory)} does not exist")
         return directory
 
-    # Function that creates a list of matrices for each image found in the folders
-    def _create_imgs_matrix(directory, px_size, show_progress):
+    # Function that creates a list of tuples with files found in directory and its subfolders, format: (path, filename)
+    # a DirectoryIndex is not listed again, its files are taken as they are, as are the files of a list
+    def _list_files(directory):
+        if isinstance(directory, DirectoryIndex):
+            return directory.folder_files()
+        if isinstance(directory, list):
+            return [(path.parent, path.name) for path in directory]
         subfolders = dif._find_subfolders(directory)
 
-        # create list of tuples with files found in directory, format: (path, filename)
         folder_files = [(directory, filename) for filename in os.listdir(directory)]
-        if len(subfolders) >= 1:
-            for folder in subfolders:
-                subfolder_files = [(folder, filename) for filename in os.listdir(folder)]
-                folder_files = folder_files + subfolder_files
+        for folder in subfolders:
+            folder_files.extend((folder, filename) for filename in os.listdir(folder))
+        return folder_files
+
+    # Function that returns the sizes of the files of a DirectoryIndex by (path, filename), None for a folder that has to be stat-ed
+    def _file_sizes(directory):
+        if isinstance(directory, DirectoryIndex):
+            return directory.sizes()
+        return None
 
-        # create images matrix
-        imgs_matrix, delete_index = [], []
+    # Function that finds byte identical files, files are grouped by size first and only files with the same size are hashed
+    # returns folder_files without the copies and a dict of the first file of each group with the list of its copies
+    # file_sizes are the sizes of the files by (path, filename) if they are known already
+    def _find_exact_duplicates(folder_files, show_progress=False, file_sizes=None):
+        sizes = collections.defaultdict(list)
         for count, file in enumerate(folder_files):
+            if file_sizes != None:
+                if file in file_sizes:
+                    sizes[file_sizes[file]].append(count)
+                continue
+            path = Path(file[0]) / file[1]
             try:
-                if show_progress:
-                    dif._show_progress(count, folder_files, task='preparing files')
-                path = Path(file[0]) / file[1]
-                # check if the file is not a folder
-                if not os.path.isdir(path):
+                if os.path.isfile(path):
+                    sizes[os.stat(path).st_size].append(count)
+            except OSError:
+                pass
+
+        collisions = [count for counts in sizes.values() if len(counts) > 1 for count in counts]
+        hashes = collections.defaultdict(list)
+        for step, count in enumerate(collisions):
+            if show_progress:
+                dif._show_progress(step, collisions, task='hashing files')
+            path = Path(folder_files[count][0]) / folder_files[count][1]
+            try:
+                hashes[(os.stat(path).st_size, dif._hash_file(path))].append(count)
+            except OSError:
+                pass
+
+        exact, copies = {}, set()
+        for counts in hashes.values():
+            if len(counts) > 1:
+                counts.sort()
+                exact[folder_files[counts[0]]] = [folder_files[count] for count in counts[1:]]
+                copies.update(counts[1:])
+
+        return [file for count, file in enumerate(folder_files) if count not in copies], exact
+
+    # Function that calculates the content hash of a file
+    def _hash_file(path):
+        file_hash = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                file_hash.update(chunk)
+        return file_hash.digest()
+
+    # Function that creates a memory-mapped matrix of all images found in the folders and a PathTable of their files
+    # store_dir is the folder of the FingerprintStore file, None = system temp folder
+    # with canonical_transforms every matrix is stored in its canonical orientation among those transforms
+    # fingerprints are matrices that are known already by file path, they are taken instead of decoding the files
+    # with from_cache and a cache all matrices are saved to the cache and returned as CachedMatrices of its data file instead of a store
+    # with reduced_decode big JPEGs are downscaled while they are decoded
+    def _create_imgs_matrix(directory, px_size, show_progress, cache=None, workers=1, folder_files=None, store_dir=None, canonical_transforms=None, fingerprints=None, from_cache=False, reduced_decode=False):
+        if folder_files == None:
+            folder_files = dif._list_files(directory)
+        if fingerprints != None:
+            fingerprints = {os.path.abspath(os.fspath(path)): img for path, img in fingerprints.items()}
+
+        # take known matrices and matrices of unchanged files from the cache, the rest has to be decoded
+        cached_slots, known, to_decode, stats, seen = {}, {}, [], {}, set()
+        indexed = isinstance(directory, DirectoryIndex)
+        for count, file in enumerate(folder_files):
+            path = Path(file[0]) / file[1]
+            # check if the file is not a folder, files of a DirectoryIndex are never folders
+            if indexed or not os.path.isdir(path):
+                if cache != None:
+                    # a dangling link or a file removed since it was listed is skipped like a file that is not an image,
+                    # it's not seen, so its cache entry is pruned
                     try:
-                        img = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_COLOR)
-                        if type(img) == np.ndarray:
-                                img = img[..., 0:3]
-                                img = cv2.resize(img, dsize=(px_size, px_size), interpolation=cv2.INTER_CUBIC)
-                                
-                                if len(img.shape) == 2:
-                                    img = skimage.color.gray2rgb(img)
-                                imgs_matrix.append(img)
-                        else:
-                            delete_index.append(count)
-                    except:
-                        delete_index.append(count)
+                        stats[count] = os.stat(path)
+                    except OSError:
+                        continue
+                    seen.add(cache.key(path))
+                if fingerprints != None and os.path.abspath(path) in fingerprints:
+                    known[count] = fingerprints[os.path.abspath(path)]
+                    continue
+                if cache != None:
+                    slot = cache.lookup(path, stats[count])
+                    if slot != None:
+                        cached_slots[count] = slot
+                        continue
+                to_decode.append(count)
+
+        # create images matrix, results are kept in the order of folder_files
+        from_cache = from_cache and cache != None and canonical_transforms == None
+        store = FingerprintStore(store_dir, len(cached_slots) + len(known) + len(to_decode), px_size) if not from_cache else None
+        files = PathTable()
+        paths = [Path(folder_files[count][0]) / folder_files[count][1] for count in to_decode]
+        if workers > 1 and len(paths) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                chunksize = max(1, min(64, len(paths) // (workers * 4)))
+                decoded = executor.map(dif._create_img_matrix, paths, repeat(px_size), repeat(reduced_decode), chunksize=chunksize)
+                dif._fill_store(store, files, folder_files, cached_slots, to_decode, decoded, stats, cache, show_progress, canonical_transforms, known)
+        else:
+            decoded = map(dif._create_img_matrix, paths, repeat(px_size), repeat(reduced_decode))
+            dif._fill_store(store, files, folder_files, cached_slots, to_decode, decoded, stats, cache, show_progress, canonical_transforms, known)
+
+        if cache != None:
+            # a list of files is only a part of its folders, files missing from it were not removed
+            if not isinstance(directory, list):
+                cache.prune(directory, seen)
+            cache.save()
+
+        if from_cache:
+            return CachedMatrices(cache.data, [cache.entries[cache.key(Path(file[0]) / file[1])][2] for file in files]), files
+        return store.open(), files
+
+    # Function that appends cached, known and decoded matrices to the store in the order of folder_files, files that are not images are skipped
+    # known matrices are cached like decoded ones, without a store only the files are listed
+    def _fill_store(store, files, folder_files, cached_slots, to_decode, decoded, stats, cache, show_progress, canonical_transforms=None, known=None):
+        try:
+            decoded = iter(decoded)
+            to_decode_set = set(to_decode)
+            step = 0
+            for count, file in enumerate(folder_files):
+                if count in cached_slots:
+                    img = cache.matrix(cached_slots[count])
+                elif known != None and count in known:
+                    img = known[count]
+                    if cache != None:
+                        cache.store(Path(file[0]) / file[1], stats[count], img)
+                elif count in to_decode_set:
+                    if show_progress:
+                        dif._show_progress(step, to_decode, task='preparing files')
+                    step += 1
+                    img = next(decoded)
+                    if cache != None:
+                        cache.store(Path(file[0]) / file[1], stats[count], img)
                 else:
-                    delete_index.append(count)
-            except KeyboardInterrupt:
-                raise KeyboardInterrupt
+                    continue
+                if isinstance(img, np.ndarray):
+                    if store != None:
+                        store.append(img if canonical_transforms == None else dif._canonical(img, canonical_transforms))
+                    files.append(file)
+        except KeyboardInterrupt:
+            raise KeyboardInterrupt
+
+    # Function that removes the file of a memory-mapped images matrix, all references to it have to be dropped before
+    def _remove_imgs_matrix(filename):
+        if filename == None:
+            return
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    # Function that decodes one image file into a px_size x px_size matrix, returns None if it's not an image
+    def _create_img_matrix(path, px_size, reduced_decode=False):
+        try:
+            return dif._decode_img_matrix(np.fromfile(path, dtype=np.uint8), px_size, reduced_decode)
+        except:
+            pass
+        return None
+
+    # Function that creates the matrix of an image from the bytes of its file
+    def _decode_img_matrix(data, px_size, reduced_decode=False):
+        try:
+            img = cv2.imdecode(data, dif._decode_flag(data, px_size) if reduced_decode else cv2.IMREAD_COLOR)
+            if type(img) == np.ndarray:
+                img = img[..., 0:3]
+                img = cv2.resize(img, dsize=(px_size, px_size), interpolation=cv2.INTER_CUBIC)
+
+                if len(img.shape) == 2:
+                    img = skimage.color.gray2rgb(img)
+                return img
+        except:
+            pass
+        return None
 
-        for index in reversed(delete_index):
-            del folder_files[index]
+    # Function that picks the cv2 decode flag of reduced_decode, JPEGs are downscaled on decode as long as they stay REDUCED_DECODE_MIN times px_size
+    # the DCT downscale averages where the resize of the full image samples, so diffs of JPEGs are not exactly the ones of a full decode,
+    # at 4 times px_size they move by about 3 to 10 MSE (up to 14) at px_size 50, nearer to px_size they moved by up to 90
+    def _decode_flag(data, px_size):
+        size = dif._jpeg_size(data)
+        if size != None:
+            for scale, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if min(size) // scale >= REDUCED_DECODE_MIN * px_size:
+                    return flag
+        return cv2.IMREAD_COLOR
 
-        return imgs_matrix, folder_files
+    # Function that reads (height, width) from the frame header of a JPEG, returns None for other files
+    def _jpeg_size(data):
+        if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+            return None
+        offset = 2
+        while offset + 9 < len(data):
+            if data[offset] != 0xFF:
+                return None
+            marker = data[offset + 1]
+            if marker == 0xFF:
+                offset += 1
+                continue
+            # start of frame markers, except DHT, JPG and DAC which share the range
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                return (int(data[offset + 5]) << 8 | int(data[offset + 6]), int(data[offset + 7]) << 8 | int(data[offset + 8]))
+            offset += 2 + (int(data[offset + 2]) << 8 | int(data[offset + 3]))
+        return None
 
     # Function that searches one directory for duplicate/similar images
-    def _search_one_dir(img_matrices_A, folderfiles_A, similarity, show_output=False, show_progress=False):
+    def _search_one_dir(img_matrices_A, folderfiles_A, similarity, show_output=False, show_progress=False, index_distance=None, exact=None, workers=1, transforms=None, cascade=False, catalog=None):
 
         total = len(img_matrices_A)
         result = {}
         lower_quality = []
         ref = similarity
 
+        # byte identical copies found by _find_exact_duplicates, by index of the image they are a copy of
+        exact_counts = {}
+        if exact != None:
+            positions = {file: count for count, file in enumerate(folderfiles_A)}
+            exact_counts = {positions[file]: copies for file, copies in exact.items() if file in positions}
+            total += sum(len(copies) for copies in exact_counts.values())
+        exact_queue = collections.deque(sorted(exact_counts))
+
         # find duplicates/similar images within one folder
-        for count_A, imageMatrix_A in enumerate(img_matrices_A):
-            img_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
-            while img_id in result.keys():
-                img_id = str(int(img_id) + 1)
-            if show_progress:
-                dif._show_progress(count_A, img_matrices_A, task='comparing images')
-            for count_B, imageMatrix_B in enumerate(img_matrices_A):
-                if count_B > count_A and count_A != len(img_matrices_A):
-                    rotations = 0
-                    while rotations <= 3:
-                        if rotations != 0:
-                            imageMatrix_B = dif._rotate_img(imageMatrix_B)
-
-                        err = dif._mse(imageMatrix_A, imageMatrix_B)
-                        if err < ref:
-                            if show_output:
-                                dif._show_img_figs(imageMatrix_A, imageMatrix_B, err)
-                                dif._show_file_info(Path(folderfiles_A[count_A][0]) / folderfiles_A[count_A][1], #0 is the path, 1 is the filename
-                                                    Path(folderfiles_A[count_B][0]) / folderfiles_A[count_B][1])
-                            if img_id in result.keys():
-                                result[img_id]["duplicates"]["paths"] = result[img_id]["duplicates"]["paths"] + [str(Path(folderfiles_A[count_B][0]) / folderfiles_A[count_B][1])]
-                                result[img_id]["duplicates"]["diffs"].append(err)
-                            else:
-                                result[img_id] = {'filename': str(folderfiles_A[count_A][1]),
-                                                  'location': str(Path(folderfiles_A[count_A][0]) / folderfiles_A[count_A][1]),
-                                                  'duplicates': {"paths": [str(Path(folderfiles_A[count_B][0]) / folderfiles_A[count_B][1])], "diffs": [err]}}
-                            try:                                    
-                                high, low = dif._check_img_quality(Path(folderfiles_A[count_A][0]) / folderfiles_A[count_A][1], Path(folderfiles_A[count_B][0]) / folderfiles_A[count_B][1])
-                                lower_quality.append(str(low))
-                            except:
-                                pass
-                            break
-                        else:
-                            rotations += 1
-                            
+        img_ids = {}
+        for count_A, count_B, transform, err in dif._matches(img_matrices_A, img_matrices_A, ref, True, show_progress, index_distance, workers, transforms, cascade):
+            dif._add_exact_results(result, lower_quality, img_ids, exact_counts, exact_queue, folderfiles_A, count_A, catalog)
+            if count_A not in img_ids:
+                img_ids[count_A] = dif._generate_img_id(result)
+            if show_output:
+                dif._show_img_figs(img_matrices_A[count_A], dif._transform(img_matrices_A[count_B], transform), err)
+                dif._show_file_info(Path(folderfiles_A[count_A][0]) / folderfiles_A[count_A][1], #0 is the path, 1 is the filename
+                                    Path(folderfiles_A[count_B][0]) / folderfiles_A[count_B][1])
+            dif._add_result(result, lower_quality, img_ids[count_A], folderfiles_A[count_A], folderfiles_A[count_B], err, catalog=catalog)
+        dif._add_exact_results(result, lower_quality, img_ids, exact_counts, exact_queue, folderfiles_A, len(folderfiles_A), catalog)
+
         result = collections.OrderedDict(sorted(result.items()))
         lower_quality = list(set(lower_quality))
         
         return result, lower_quality, total
 
     # Function that searches two directories for duplicate/similar images
-    def _search_two_dirs(img_matrices_A, folderfiles_A, img_matrices_B, folderfiles_B, similarity, show_output=False, show_progress=False):
+    def _search_two_dirs(img_matrices_A, folderfiles_A, img_matrices_B, folderfiles_B, similarity, show_output=False, show_progress=False, index_distance=None, workers=1, transforms=None, cascade=False, catalog=None):
 
         total = len(img_matrices_A) + len(img_matrices_B)
         result = {}
@@ -234,44 +606,344 @@ class dif:
         ref = similarity
 
         # find duplicates/similar images between two folders
+        img_ids = {}
+        for count_A, count_B, transform, err in dif._matches(img_matrices_A, img_matrices_B, ref, False, show_progress, index_distance, workers, transforms, cascade):
+            if count_A not in img_ids:
+                img_ids[count_A] = dif._generate_img_id(result)
+            if show_output:
+                dif._show_img_figs(img_matrices_A[count_A], dif._transform(img_matrices_B[count_B], transform), err)
+                dif._show_file_info(Path(folderfiles_A[count_A][0]) / folderfiles_A[count_A][1],
+                                    Path(folderfiles_B[count_B][0]) / folderfiles_B[count_B][1])
+            dif._add_result(result, lower_quality, img_ids[count_A], folderfiles_A[count_A], folderfiles_B[count_B], err, catalog=catalog)
+
+        result = collections.OrderedDict(sorted(result.items()))
+        lower_quality = list(set(lower_quality))
+
+        return result, lower_quality, total
+
+    # Function that searches a directory of new images against a library and against itself for duplicate/similar images
+    def _search_library(img_matrices_A, folderfiles_A, img_matrices_L, folderfiles_L, similarity, show_output=False, show_progress=False, index_distance=None, exact=None, workers=1, transforms=None, cascade=False, catalog=None):
+
+        total = len(img_matrices_A) + len(img_matrices_L)
+        result = {}
+        lower_quality = []
+        ref = similarity
+
+        exact_counts = {}
+        if exact != None:
+            positions = {file: count for count, file in enumerate(folderfiles_A)}
+            exact_counts = {positions[file]: copies for file, copies in exact.items() if file in positions}
+            total += sum(len(copies) for copies in exact_counts.values())
+        exact_queue = collections.deque(sorted(exact_counts))
+
+        # matches with the library (0) and within the new images (1), merged in the order of the new images
+        library_matches = ((count_A, 0, count_B, transform, err) for count_A, count_B, transform, err in
+                           dif._matches(img_matrices_A, img_matrices_L, ref, False, show_progress, index_distance, workers, transforms, cascade))
+        new_matches = ((count_A, 1, count_B, transform, err) for count_A, count_B, transform, err in
+                       dif._matches(img_matrices_A, img_matrices_A, ref, True, False, index_distance, workers, transforms, cascade))
+
+        img_ids = {}
+        for count_A, source, count_B, transform, err in heapq.merge(library_matches, new_matches):
+            dif._add_exact_results(result, lower_quality, img_ids, exact_counts, exact_queue, folderfiles_A, count_A, catalog)
+            if count_A not in img_ids:
+                img_ids[count_A] = dif._generate_img_id(result)
+            img_matrices_B, folderfiles_B = (img_matrices_L, folderfiles_L) if source == 0 else (img_matrices_A, folderfiles_A)
+            if show_output:
+                dif._show_img_figs(img_matrices_A[count_A], dif._transform(img_matrices_B[count_B], transform), err)
+                dif._show_file_info(Path(folderfiles_A[count_A][0]) / folderfiles_A[count_A][1],
+                                    Path(folderfiles_B[count_B][0]) / folderfiles_B[count_B][1])
+            dif._add_result(result, lower_quality, img_ids[count_A], folderfiles_A[count_A], folderfiles_B[count_B], err, keep_B=(source == 0), catalog=catalog)
+        dif._add_exact_results(result, lower_quality, img_ids, exact_counts, exact_queue, folderfiles_A, len(folderfiles_A), catalog)
+
+        result = collections.OrderedDict(sorted(result.items()))
+        lower_quality = list(set(lower_quality))
+
+        return result, lower_quality, total
+
+    # Function that generates a unique, time ordered id for a new result entry
+    def _generate_img_id(result):
+        img_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        while img_id in result.keys():
+            img_id = str(int(img_id) + 1)
+        return img_id
+
+    # Function that adds the byte identical copies of all images up to index up_to to the result with a diff of 0
+    def _add_exact_results(result, lower_quality, img_ids, exact_counts, exact_queue, folderfiles, up_to, catalog=None):
+        while len(exact_queue) > 0 and exact_queue[0] <= up_to:
+            count = exact_queue.popleft()
+            img_ids[count] = dif._generate_img_id(result)
+            for file in exact_counts[count]:
+                dif._add_result(result, lower_quality, img_ids[count], folderfiles[count], file, 0.0, catalog=catalog)
+
+    # Function that adds a found duplicate/similar image to the result and its lower quality image to the list
+    # keep_B = True means B is never reported as lower quality, A is reported instead
+    def _add_result(result, lower_quality, img_id, file_A, file_B, err, keep_B=False, catalog=None):
+        path_A = Path(file_A[0]) / file_A[1]
+        path_B = Path(file_B[0]) / file_B[1]
+        if img_id in result.keys():
+            result[img_id]["duplicates"]["paths"].append(str(path_B))
+            result[img_id]["duplicates"]["diffs"].append(err)
+        else:
+            result[img_id] = {'filename': str(file_A[1]),
+                              'location': str(path_A),
+                              'duplicates': {"paths": [str(path_B)], "diffs": [err]}}
+        if keep_B:
+            lower_quality.append(str(path_A))
+            return
+        try:
+            high, low = dif._check_img_quality(path_A, path_B, catalog)
+            lower_quality.append(str(low))
+        except:
+            pass
+
+    # Function that picks between comparing all pairs and comparing only the pairs found in the index
+    def _matches(img_matrices_A, img_matrices_B, ref, same_dir, show_progress=False, index_distance=None, workers=1, transforms=None, cascade=False):
+        if index_distance == None:
+            return dif._find_matches(img_matrices_A, img_matrices_B, ref, same_dir, show_progress, workers, transforms, cascade)
+        return dif._find_index_matches(img_matrices_A, img_matrices_B, ref, same_dir, index_distance, show_progress, transforms, cascade)
+
+    # Function that finds all pairs of image matrices with a mse below ref, yields (index_A, index_B, transform, mse)
+    # pairs are yielded ordered by index_A and index_B, transform is the first of transforms applied to B that matched
+    # with workers > 1 and memory-mapped matrices (a store or the cache) the tiles of the pair space are compared in a process pool
+    def _find_matches(img_matrices_A, img_matrices_B, ref, same_dir, show_progress=False, workers=1, transforms=None, cascade=False):
+        if len(img_matrices_A) == 0 or len(img_matrices_B) == 0:
+            return
+        if transforms == None:
+            transforms = dif._transforms(False)
+        if not isinstance(img_matrices_A, np.ndarray):
+            img_matrices_A = np.stack(img_matrices_A)
+        if same_dir:
+            img_matrices_B = img_matrices_A
+        elif not isinstance(img_matrices_B, (np.ndarray, CachedMatrices)):
+            img_matrices_B = np.stack(img_matrices_B)
+
+        block = dif._block_size(img_matrices_A[0].size)
+        if workers > 1 and dif._shared_spec(img_matrices_A) != None and dif._shared_spec(img_matrices_B) != None:
+            yield from dif._find_matches_parallel(img_matrices_A, img_matrices_B, ref, same_dir, show_progress, workers, block, transforms, cascade)
+            return
+
+        # one tile per row block, compared against all following columns
+        tiles = [(start_A, min(start_A + block, len(img_matrices_A)), start_A if same_dir else 0, len(img_matrices_B))
+                 for start_A in range(0, len(img_matrices_A), block)]
+        for count, tile in enumerate(tiles):
+            if show_progress:
+                dif._show_progress(count, tiles, task='comparing images')
+            yield from dif._compare_tile(img_matrices_A, img_matrices_B, tile, ref, same_dir, transforms, cascade)
+
+    # Function that compares the tiles of the pair space in a process pool, tiles are row blocks x column blocks
+    # of the upper triangle (one directory) or of A x B, results are merged in the same order as on a single core
+    # tiles are submitted in order and at most PARALLEL_WINDOW per worker wait or run at once, the result of the oldest one is taken
+    # before the next one is submitted, so only the window and the row block being merged are held however many tiles there are
+    def _find_matches_parallel(img_matrices_A, img_matrices_B, ref, same_dir, show_progress, workers, block, transforms, cascade):
+        count_A, count_B = len(img_matrices_A), len(img_matrices_B)
+        tiles = ((start_A, min(start_A + block, count_A), start_B, min(start_B + block, count_B))
+                 for start_A in range(0, count_A, block) for start_B in range(start_A if same_dir else 0, count_B, block))
+        total = sum(-(-(count_B - (start_A if same_dir else 0)) // block) for start_A in range(0, count_A, block))
+
+        progress = {"done": 0, "lock": threading.Lock()}
+        def tile_done(future):
+            with progress["lock"]:
+                if show_progress:
+                    dif._show_progress(progress["done"], range(total), task='comparing images')
+                progress["done"] += 1
+
+        # the workers map the store files once when they start
+        specs = (dif._shared_spec(img_matrices_A), dif._shared_spec(img_matrices_B))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_map_shared_matrices, initargs=specs) as executor:
+            pending = collections.deque()
+            row_matches, row_start = [], None
+            while True:
+                while len(pending) < workers * PARALLEL_WINDOW:
+                    tile = next(tiles, None)
+                    if tile == None:
+                        break
+                    future = executor.submit(_compare_shared_tile, tile, ref, same_dir, transforms, cascade)
+                    future.add_done_callback(tile_done)
+                    pending.append((tile, future))
+                if len(pending) == 0:
+                    break
+
+                # tiles of one row block are sorted together, so pairs come out ordered by index_A and index_B
+                tile, future = pending.popleft()
+                if tile[0] != row_start:
+                    yield from sorted(row_matches)
+                    row_matches, row_start = [], tile[0]
+                row_matches.extend(future.result())
+            yield from sorted(row_matches)
+
+    # Function that returns how a pool worker maps the matrices again, None if they are not in a file
+    # ("store", file, number of matrices) for a FingerprintStore, ("cache", file, shape, slots) for CachedMatrices
+    def _shared_spec(img_matrices):
+        if isinstance(img_matrices, CachedMatrices):
+            if getattr(img_matrices.data, "filename", None) == None:
+                return None
+            return ("cache", img_matrices.data.filename, img_matrices.data.shape, img_matrices.slots)
+        if getattr(img_matrices, "filename", None) == None:
+            return None
+        return ("store", img_matrices.filename, len(img_matrices))
+
+    # Function that compares rows start_A to end_A of A with columns start_B to end_B of B, returns the sorted matches
+    # with cascade pairs are first rejected when a lower bound of their mse from the coarse levels (mean color, 8x8 block
+    # means) reaches ref, the full resolution is only compared where many pairs are left, the rest get the early-abort mse
+    def _compare_tile(img_matrices_A, img_matrices_B, tile, ref, same_dir, transforms, cascade=False):
+        start_A, end_A, start_B, end_B = tile
+        rows_A, rows_B = dif._as_rows(img_matrices_A), dif._as_rows(img_matrices_B)
+        shape = img_matrices_A.shape[1:]
+        pixels = float(shape[0] * shape[1])
+        block = dif._block_size(rows_A.shape[1])
+        # strict upper bound of the float32 rounding error of the dot products, whatever order they are summed in:
+        # |error| <= d * eps / 2 * sum |a_i * b_i| <= d * eps / 4 * (|a|^2 + |b|^2), doubled in the mse and with room for the
+        # higher order terms, so no pair under ref is ever rejected, candidates are confirmed with the exact mse
+        error_factor = rows_A.shape[1] * np.finfo(np.float32).eps / pixels
+
+        # transforming A backwards is the same as transforming B forwards, so only the rows of the tile are transformed
+        # the full resolution rows are only prepared once the coarse levels leave too many pairs
+        transformed_A = None
+        if cascade:
+            means_A, grids_A = dif._coarse_levels(np.asarray(img_matrices_A[start_A:end_A]))
+            grids_A = [np.ascontiguousarray(dif._inverse_transform(grids_A, transform, batch=True)).reshape(end_A - start_A, -1) for transform in transforms]
+
+        candidates = []
+        for start in range(start_B, end_B, block):
+            end = min(start + block, end_B)
+            block_B = None
+            if same_dir:
+                upper = np.arange(start_A, end_A)[:, None] < np.arange(start, end)[None, :]
+            if cascade:
+                means_B, grids_B = dif._coarse_levels(np.asarray(img_matrices_B[start:end]))
+                grids_B = grids_B.reshape(end - start, -1)
+                found_means = dif._lower_bounds(means_A, means_B) < ref
+            for number in range(len(transforms)):
+                found = upper.copy() if same_dir else np.ones((end_A - start_A, end - start), dtype=bool)
+                if cascade:
+                    found &= found_means
+                    found &= dif._lower_bounds(grids_A[number], grids_B) < ref
+                if not cascade or np.count_nonzero(found) > CASCADE_DENSE * found.size:
+                    if transformed_A is None:
+                        block_A = dif._float_block(rows_A, start_A, end_A)
+                        norms_A = dif._squared_norms(block_A)
+                        block_A = block_A.reshape((end_A - start_A,) + shape)
+                        transformed_A = [np.ascontiguousarray(dif._inverse_transform(block_A, transform, batch=True)).reshape(end_A - start_A, -1) for transform in transforms]
+                    if block_B is None:
+                        block_B = dif._float_block(rows_B, start, end)
+                        norms = norms_A[:, None] + dif._squared_norms(block_B)[None, :]
+                        limit = ref + error_factor * norms
+                    dots = transformed_A[number] @ block_B.T
+                    errs = (norms - 2 * dots.astype(np.float64)) / pixels
+                    found &= errs < limit
+                rows, cols = np.nonzero(found)
+                candidates.extend(zip((rows + start_A).tolist(), (cols + start).tolist(), [number] * len(rows)))
+
+        # confirm candidates with the exact mse, first matching transform wins
+        candidates.sort()
+        matches, last_pair = [], None
+        for count_A, count_B, number in candidates:
+            if (count_A, count_B) == last_pair:
+                continue
+            if cascade:
+                err = dif._bounded_mse(img_matrices_A[count_A], dif._transform(img_matrices_B[count_B], transforms[number]), ref)
+            else:
+                err = dif._mse(img_matrices_A[count_A], dif._transform(img_matrices_B[count_B], transforms[number]))
+            if err != None and err < ref:
+                last_pair = (count_A, count_B)
+                matches.append((count_A, count_B, transforms[number], err))
+        return matches
+
+    # Function that finds pairs like _find_matches, but only compares B images whose dhash is within index_distance of A
+    # the hashes of A under all transforms are looked up, as transforming A backwards is the same as transforming B forwards
+    def _find_index_matches(img_matrices_A, img_matrices_B, ref, same_dir, index_distance, show_progress=False, transforms=None, cascade=False):
+        if transforms == None:
+            transforms = dif._transforms(False)
+        tree = BKTree()
+        for count_B, imageMatrix_B in enumerate(img_matrices_B):
+            tree.add(dif._dhash(imageMatrix_B), count_B)
+
         for count_A, imageMatrix_A in enumerate(img_matrices_A):
-            img_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
-            while img_id in result.keys():
-                img_id = str(int(img_id) + 1)
             if show_progress:
                 dif._show_progress(count_A, img_matrices_A, task='comparing images')
-            for count_B, imageMatrix_B in enumerate(img_matrices_B):
-                rotations = 0
-                while rotations <= 3:
-                    if rotations != 0:
-                        imageMatrix_B = dif._rotate_img(imageMatrix_B)
-                        
-                    err = dif._mse(imageMatrix_A, imageMatrix_B)
-                    if err < ref:
-                        if show_output:
-                            dif._show_img_figs(imageMatrix_A, imageMatrix_B, err)
-                            dif._show_file_info(Path(folderfiles_A[count_A][0]) / folderfiles_A[count_A][1],
-                                                Path(folderfiles_B[count_B][0]) / folderfiles_B[count_B][1])
-                        if img_id in result.keys():
-                                result[img_id]["duplicates"]["paths"] = result[img_id]["duplicates"]["paths"] + [str(Path(folderfiles_A[count_B][0]) / folderfiles_A[count_B][1])]
-                                result[img_id]["duplicates"]["diffs"].append(err)
-                        else:
-                            result[img_id] = {'filename': str(folderfiles_A[count_A][1]),
-                                              'location': str(Path(folderfiles_A[count_A][0]) / folderfiles_A[count_A][1]),
-                                              'duplicates': {"paths": [str(Path(folderfiles_A[count_B][0]) / folderfiles_A[count_B][1])], "diffs": [err]}}
-                        try:
-                            high, low = dif._check_img_quality(Path(folderfiles_A[count_A][0]) / folderfiles_A[count_A][1], Path(folderfiles_B[count_B][0]) / folderfiles_B[count_B][1])
-                            lower_quality.append(str(low))
-                        except:
-                            pass
-                        break
+            candidates = set()
+            for transform in transforms:
+                candidates.update(tree.find(dif._dhash(dif._inverse_transform(imageMatrix_A, transform)), index_distance))
+            for count_B in sorted(candidates):
+                if same_dir and count_B <= count_A:
+                    continue
+                for transform in transforms:
+                    if cascade:
+                        err = dif._bounded_mse(imageMatrix_A, dif._transform(img_matrices_B[count_B], transform), ref)
                     else:
-                        rotations += 1
+                        err = dif._mse(imageMatrix_A, dif._transform(img_matrices_B[count_B], transform))
+                    if err != None and err < ref:
+                        yield count_A, count_B, transform, err
+                        break
 
-        result = collections.OrderedDict(sorted(result.items()))
-        lower_quality = list(set(lower_quality))
+    # Function that calculates the 64 bit difference hash of an image matrix
+    def _dhash(image):
+        gray = cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, dsize=(9, 8), interpolation=cv2.INTER_AREA)
+        bits = np.packbits(small[:, 1:] > small[:, :-1])
+        return int.from_bytes(bits.tobytes(), "big")
 
-        return result, lower_quality, total
+    # Function that compares the index with all pairs, reports for each max hamming distance how many matches it finds
+    def _index_recall(img_matrices, ref, distances):
+        start_time = time.time()
+        exhaustive = {(count_A, count_B) for count_A, count_B, transform, err in dif._find_matches(img_matrices, img_matrices, ref, True)}
+        print(f"DifPy exhaustive search: {len(exhaustive)} matches in {time.time() - start_time:.3f} seconds")
+
+        report = []
+        for index_distance in distances:
+            start_time = time.time()
+            found = {(count_A, count_B) for count_A, count_B, transform, err in dif._find_index_matches(img_matrices, img_matrices, ref, True, index_distance)}
+            recall = len(found & exhaustive) / len(exhaustive) if len(exhaustive) > 0 else 1.0
+            seconds = time.time() - start_time
+            print(f"DifPy index distance {index_distance}: recall {recall:.2%}, {len(found)} matches in {seconds:.3f} seconds")
+            report.append({"index_distance": index_distance, "recall": recall, "matches": len(found), "seconds": seconds})
+        return report
+
+    # Function that returns image matrices as rows of one uint8 array, a memory-mapped matrix is only reshaped, not copied
+    def _as_rows(img_matrices):
+        if isinstance(img_matrices, np.ndarray):
+            return img_matrices.reshape(len(img_matrices), -1)
+        if isinstance(img_matrices, CachedMatrices):
+            return img_matrices.rows()
+        return np.stack(img_matrices).reshape(len(img_matrices), -1)
+
+    # Function that converts rows start to end to float32, centered around zero to keep the dot products precise
+    def _float_block(rows, start, end):
+        block = rows[start:end].astype(np.float32)
+        block -= 127.5
+        return block
+
+    # Function that calculates the squared norms of a centered float32 block in float64
+    def _squared_norms(block):
+        block = block.astype(np.float64)
+        return np.einsum('ij,ij->i', block, block)
+
+    # Function that calculates the coarse levels of image matrices, the mean color and the CASCADE_GRID x CASCADE_GRID block
+    # means per color weighted by the square root of the block's share of the pixels, so the squared distance of the levels
+    # of two images is a lower bound of their mse, the blocks are symmetric so the grid of a transformed image is the transformed grid
+    def _coarse_levels(images):
+        size = images.shape[1]
+        grid = min(CASCADE_GRID, size)
+        # an even grid can't be split symmetrically into an odd number of pixels
+        if grid % 2 == 0 and size % 2 == 1:
+            grid -= 1
+        half = [count * size // grid for count in range(grid // 2 + 1)]
+        edges = np.array(half + [size - edge for edge in reversed(half[:grid - len(half) + 1])])
+        sums = np.add.reduceat(np.add.reduceat(images, edges[:-1], axis=1, dtype=np.float64), edges[:-1], axis=2)
+        pixels = float(size * size)
+        areas = np.diff(edges)[:, None] * np.diff(edges)[None, :]
+        means = sums.sum(axis=(1, 2)) / pixels
+        return means, sums / np.sqrt(areas * pixels)[None, :, :, None]
+
+    # Function that calculates the squared distances of all pairs of two coarse levels, less a margin for the rounding error
+    def _lower_bounds(level_A, level_B):
+        norms_A, norms_B = np.einsum('ij,ij->i', level_A, level_A), np.einsum('ij,ij->i', level_B, level_B)
+        bounds = norms_A[:, None] + norms_B[None, :] - 2 * (level_A @ level_B.T)
+        return bounds - 1e-9 * (norms_A[:, None] + norms_B[None, :]) - 1e-9
+
+    # Function that calculates how many float32 rows fit into one block of the comparison
+    def _block_size(row_size):
+        return max(1, BLOCK_BYTES // (row_size * 4))
 
     # Function that maps the similarity grade to the respective MSE value
     def _map_similarity(similarity):
@@ -289,6 +961,33 @@ class dif:
                 ref = 200
         return ref
 
+    # Function that maps mirror and canonical to the transforms pairs are compared in and the transforms of the canonical orientation
+    def _map_transforms(mirror, canonical):
+        transforms = dif._transforms(mirror)
+        if canonical:
+            return [(0, False)], transforms
+        return transforms, None
+
+    # Function that maps the index parameter to the max hamming distance of the dhashes, None = no index
+    def _map_index_distance(index, similarity):
+        if index is False:
+            return None
+        if index is not True:
+            return int(index)
+        if similarity == "low":
+            return 16
+        elif similarity == "high":
+            return 4
+        elif similarity == "normal":
+            return 10
+        # manual mse threshold, use the distance of the closest grade
+        ref = dif._map_similarity(similarity)
+        if ref >= 1000:
+            return 16
+        elif ref <= 0.1:
+            return 4
+        return 10
+
     # Function that creates a list of all subfolders it found in a folder
     def _find_subfolders(directory):
         subfolders = [Path(f.path) for f in os.scandir(directory) if f.is_dir()]
@@ -302,6 +1001,17 @@ class dif:
         err /= float(imageA.shape[0] * imageA.shape[1])
         return err
 
+    # Function that calculates the mse like _mse, but sums CASCADE_ROWS rows at a time and returns None as soon as the
+    # sum reaches ref, the squared differences are whole numbers so the result is the same as the one of _mse
+    def _bounded_mse(imageA, imageB, ref):
+        pixels = float(imageA.shape[0] * imageA.shape[1])
+        err = 0.0
+        for start in range(0, imageA.shape[0], CASCADE_ROWS):
+            err += np.sum((imageA[start:start + CASCADE_ROWS].astype("float") - imageB[start:start + CASCADE_ROWS].astype("float")) ** 2)
+            if err / pixels >= ref:
+                return None
+        return err / pixels
+
     # Function that plots two compared image files and their mse
     def _show_img_figs(imageA, imageB, err):
         fig = plt.figure()
@@ -328,21 +1038,65 @@ class dif:
         image = np.rot90(image, k=1, axes=(0, 1))
         return image
 
+    # Function that lists the transforms an image is compared in, (90 degree rotations, mirrored) tuples
+    def _transforms(mirror):
+        transforms = [(rotations, False) for rotations in range(4)]
+        if mirror:
+            transforms += [(rotations, True) for rotations in range(4)]
+        return transforms
+
+    # Function that applies a transform to an image matrix, the image is mirrored horizontally first and then rotated
+    def _transform(image, transform):
+        rotations, mirrored = transform
+        if mirrored:
+            image = np.flip(image, axis=1)
+        return np.rot90(image, k=rotations, axes=(0, 1))
+
+    # Function that undoes a transform, batch = True for an array of image matrices
+    def _inverse_transform(image, transform, batch=False):
+        rotations, mirrored = transform
+        axes = (1, 2) if batch else (0, 1)
+        image = np.rot90(image, k=-rotations, axes=axes)
+        if mirrored:
+            image = np.flip(image, axis=axes[1])
+        return image
+
+    # Function that turns an image matrix to its canonical orientation, the one of transforms that puts the brightness
+    # centroid closest to the bottom right diagonal, so rotated (or mirrored) copies end up as the same matrix
+    def _canonical(image, transforms):
+        gray = image.astype(np.float64).sum(axis=2)
+        gray -= gray.mean()
+        centered = np.arange(gray.shape[0]) - (gray.shape[0] - 1) / 2
+        best, best_key = image, None
+        for transform in transforms:
+            transformed = dif._transform(gray, transform)
+            y = float(transformed.sum(axis=1) @ centered)
+            x = float(transformed.sum(axis=0) @ centered)
+            key = (x + y, x)
+            if best_key == None or key > best_key:
+                best, best_key = transform, key
+        return np.ascontiguousarray(dif._transform(image, best))
+
     # Function for checking the quality of compared images, appends the lower quality image to the list
-    def _check_img_quality(imageA, imageB):
-        size_imgA = os.stat(imageA).st_size
-        size_imgB = os.stat(imageB).st_size
-        if size_imgA >= size_imgB:
+    def _check_img_quality(imageA, imageB, catalog=None):
+        if dif._quality_key(imageA, catalog) >= dif._quality_key(imageB, catalog):
             return imageA, imageB
         else:
             return imageB, imageA
+
+    # Function that returns what the quality of an image is compared by, (pixels, file size) with a catalog, (0, file size) without it
+    def _quality_key(image, catalog=None):
+        if catalog != None:
+            info = catalog.get(image)
+            return (info.width * info.height, info.size)
+        return (0, os.stat(image).st_size)
     
     # Function that generates a dictionary for statistics around the completed DifPy process
     def _generate_stats(directoryA, directoryB, start_time, end_time, time_elapsed, similarity, total_searched, total_found):
         stats = {}
-        stats["directory_1"] = str(Path(directoryA))
+        stats["directory_1"] = dif._directory_name(directoryA)
         if directoryB != None:
-            stats["directory_2"] = str(Path(directoryB))
+            stats["directory_2"] = dif._directory_name(directoryB)
         else:
             stats["directory_2"] = None
         stats["duration"] = {"start_date": time.strftime("%Y-%m-%d", start_time),
@@ -359,6 +1113,14 @@ class dif:
         stats["total_dupl_sim_found"] = total_found
         return stats
 
+    # Function that returns the directory for the stats, the paths for a list of files
+    def _directory_name(directory):
+        if isinstance(directory, FingerprintLibrary):
+            return [str(Path(file[0]) / file[1]) for file in directory.matrices()[1]]
+        if isinstance(directory, list):
+            return [str(path) for path in directory]
+        return str(Path(directory))
+
     # Function that displays a progress bar during the search
     def _show_progress(count, list, task='processing images'):
         if count+1 == len(list):
@@ -381,6 +1143,684 @@ class dif:
                 print("Could not delete file:", file, end="\r")
         print("\n***\nDeleted", deleted, "images.")
 
+class DirectoryIndex:
+    """
+    Index of the files of a folder tree, listed with os.scandir so every file is stat-ed at most once per listing
+
+    directory (str)..........root folder of the tree
+    extensions (list)........file extensions to index (compared in lower case), None = all files
+    recursive (bool).........True = sub-folders are indexed too
+    snapshot (str)...........file where the listings are kept between runs, refresh() then lists a folder again only if its mtime
+                             changed, files changed in place in an unchanged folder keep their old size and mtime (None = no snapshot)
+    workers (int)............number of threads the sub-trees are listed with
+
+    the index can be used wherever a folder path is expected (os.fspath gives the root folder) and dif takes it directly
+    """
+
+    # folders modified this close to the listing are listed again next time, mtimes of some file systems are this coarse
+    RACY_NS = 2 * 10 ** 9
+
+    def __init__(self, directory, extensions=None, recursive=True, snapshot=None, workers=1):
+        self.directory = Path(directory)
+        self.extensions = None if extensions == None else sorted({extension.lower() for extension in extensions})
+        self.recursive = recursive
+        self.snapshot = snapshot
+        self.workers = max(1, workers)
+        # folder -> (mtime, sub-folder names, [(filename, size, mtime)]), mtime None = list again
+        self.folders = {}
+        self._load_snapshot()
+
+    def __fspath__(self):
+        return os.fspath(self.directory)
+
+    # Function that lists the tree again level by level, the folders of a level are listed in parallel
+    # and unchanged folders are taken from the snapshot
+    def refresh(self):
+        previous, folders = self.folders, {}
+        level = [os.fspath(self.directory)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while level:
+                next_level = []
+                for folder, listing in executor.map(self._list_folder, level, [previous.get(folder) for folder in level]):
+                    folders[folder] = listing
+                    if self.recursive:
+                        next_level.extend(os.path.join(folder, name) for name in listing[1])
+                level = next_level
+        self.folders = folders
+        self._save_snapshot()
+        return self
+
+    # Function that returns the indexed files as (path, filename) tuples, in the same order as dif._list_files lists them
+    def folder_files(self):
+        folder_files = []
+        for folder in self._ordered_folders():
+            path = Path(folder)
+            folder_files.extend((path, filename) for filename, size, mtime in self.folders[folder][2])
+        return folder_files
+
+    # Function that returns the paths of the indexed files, each one made from a single string as that's the fastest way to a Path
+    def paths(self):
+        return [Path(folder + os.sep + filename) for folder in self._ordered_folders() for filename, size, mtime in self.folders[folder][2]]
+
+    # Function that returns the sizes of the indexed files by (path, filename)
+    def sizes(self):
+        sizes = {}
+        for folder in self._ordered_folders():
+            path = Path(folder)
+            sizes.update(((path, filename), size) for filename, size, mtime in self.folders[folder][2])
+        return sizes
+
+    # Function that returns the indexed files as (path, size, mtime) tuples, path as a string
+    def entries(self):
+        return [(folder + os.sep + filename, size, mtime) for folder in self._ordered_folders() for filename, size, mtime in self.folders[folder][2]]
+
+    # Function that returns the folders root first, then the sub-folders like dif._find_subfolders finds them
+    def _ordered_folders(self):
+        root = os.fspath(self.directory)
+        if root not in self.folders:
+            self.refresh()
+        return [root] + self._subfolders(root)
+
+    def _subfolders(self, folder):
+        children = [os.path.join(folder, name) for name in self.folders[folder][1] if os.path.join(folder, name) in self.folders]
+        subfolders = list(children)
+        for child in children:
+            subfolders.extend(self._subfolders(child))
+        return subfolders
+
+    # Function that lists one folder, the previous listing is kept if the folder's mtime didn't change
+    def _list_folder(self, folder, previous):
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+            if previous != None and previous[0] == mtime:
+                return folder, previous
+            subfolders, files = [], []
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        subfolders.append(entry.name)
+                    elif self.extensions == None or os.path.splitext(entry.name)[1].lower() in self.extensions:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            return folder, (None, [], [])
+        if mtime >= time.time_ns() - self.RACY_NS:
+            mtime = None
+        return folder, (mtime, subfolders, files)
+
+    # Function that loads the listings of the snapshot, a snapshot of other settings is ignored
+    def _load_snapshot(self):
+        if self.snapshot == None or not os.path.exists(self.snapshot):
+            return
+        try:
+            with open(self.snapshot, "rb") as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+        except Exception:
+            return
+        if snapshot.get("extensions") == self.extensions and snapshot.get("recursive") == self.recursive:
+            self.folders = snapshot["folders"]
+
+    # Function that writes the listings to the snapshot, through a temporary file so a crash never leaves half a snapshot
+    def _save_snapshot(self):
+        if self.snapshot == None:
+            return
+        temporary = os.fspath(self.snapshot) + ".tmp"
+        with open(temporary, "wb") as snapshot_file:
+            pickle.dump({"extensions": self.extensions, "recursive": self.recursive, "folders": self.folders}, snapshot_file, protocol=4)
+        os.replace(temporary, self.snapshot)
+
+class ImageInfo(collections.namedtuple("ImageInfo", "size mtime width height format mode quality alpha")):
+    """
+    Header facts of an image file, read without decoding its pixels
+
+    size (int)...............file size in bytes
+    mtime (int)..............modification time of the file in nanoseconds
+    width, height (int)......dimensions in pixels, 0 if the file is not an image
+    format (str).............format PIL read the file as ("JPEG", "PNG", ...), None if the file is not an image
+    mode (str)...............mode of the pixels ("RGB", "RGBA", "P", ...)
+    quality (float)..........quality a JPEG was saved with, estimated from its quantization tables, None for other formats
+    alpha (bool).............True = the image has transparency (alpha band or transparent palette color)
+    """
+
+    __slots__ = ()
+
+class ImageCatalog:
+    """
+    SQLite catalog of the header facts of image files, kept between runs, a file is read again only when its size or mtime changed
+
+    path (str)...............file of the catalog
+    workers (int)............number of threads headers are read with by update()
+
+    get(path)................ImageInfo of a file, read from its header if the catalog doesn't know it as it is
+    update(index)............reads the headers of the files of a DirectoryIndex that are new or changed
+                             and drops the files under its folder that are gone
+    save()...................writes what was read since the last save, close() saves too
+    """
+
+    # luminance quantization table of the JPEG standard (IJG quality 50), libjpeg based encoders scale it by the quality
+    JPEG_STANDARD_LUMINANCE_TABLE = [
+        16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+        14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+        18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+        49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99
+    ]
+
+    def __init__(self, path, workers=1):
+        self.db = sqlite3.connect(os.fspath(path))
+        self.db.execute("CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, width INTEGER, height INTEGER, format TEXT, mode TEXT, quality REAL, alpha INTEGER)")
+        self.workers = max(1, workers)
+        self.entries = {row[0]: ImageInfo(row[1], row[2], row[3], row[4], row[5], row[6], row[7], bool(row[8])) for row in self.db.execute("SELECT * FROM images")}
+        self.pending = {}
+        self.removed = set()
+
+    # Function that returns the key under which a file is stored
+    def key(self, path):
+        return os.path.abspath(os.fspath(path))
+
+    # Function that returns the ImageInfo of a file, stat is the os.stat of the file if it's known already
+    def get(self, path, stat=None):
+        key = self.key(path)
+        stat = stat if stat != None else os.stat(key)
+        info = self.entries.get(key)
+        if info == None or info.size != stat.st_size or info.mtime != stat.st_mtime_ns:
+            info = ImageCatalog.read(key, stat)
+            self.entries[key] = self.pending[key] = info
+        return info
+
+    # Function that reads the headers of new and changed files of a DirectoryIndex in threads and drops files that are gone
+    def update(self, index):
+        entries = index.entries()
+        seen = set()
+        to_read = []
+        for path, size, mtime in entries:
+            key = self.key(path)
+            seen.add(key)
+            info = self.entries.get(key)
+            if info == None or info.size != size or info.mtime != mtime:
+                to_read.append(key)
+        if len(to_read) > 0:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for key, info in zip(to_read, executor.map(ImageCatalog.read, to_read)):
+                    self.entries[key] = self.pending[key] = info
+        prefix = os.path.join(self.key(index), "")
+        for key in self.entries:
+            if key.startswith(prefix) and key not in seen and key not in self.pending:
+                self.removed.add(key)
+        self.save()
+        return self
+
+    # Function that writes the files read since the last save and drops the removed ones
+    def save(self):
+        if len(self.pending) == 0 and len(self.removed) == 0:
+            return
+        # a file that is read again after it was gone stays
+        self.removed -= set(self.pending)
+        for key in self.removed:
+            self.entries.pop(key, None)
+        with self.db:
+            self.db.executemany("DELETE FROM images WHERE path = ?", [(key,) for key in self.removed])
+            self.db.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                [(key,) + tuple(info[:7]) + (int(info.alpha),) for key, info in self.pending.items()])
+        self.pending = {}
+        self.removed = set()
+
+    # Function that closes the catalog, what was read is saved first
+    def close(self):
+        self.save()
+        self.db.close()
+
+    # Function that reads the ImageInfo of a file from its header, PIL parses the header on open and decodes pixels only when they are used
+    def read(path, stat=None):
+        stat = stat if stat != None else os.stat(path)
+        try:
+            with Image.open(path) as image:
+                return ImageCatalog.describe(image, stat)
+        except Exception:
+            return ImageInfo(stat.st_size, stat.st_mtime_ns, 0, 0, None, None, None, False)
+
+    # Function that returns the ImageInfo of an opened PIL image, size and mtime are None without the stat of its file
+    def describe(image, stat=None):
+        alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        quality = ImageCatalog.jpeg_quality(getattr(image, "quantization", None)) if image.format == "JPEG" else None
+        size, mtime = (stat.st_size, stat.st_mtime_ns) if stat != None else (None, None)
+        return ImageInfo(size, mtime, image.width, image.height, image.format, image.mode, quality, alpha)
+
+    # Function that estimates the quality a JPEG was saved with from its quantization tables by inverting the IJG scaling
+    # tables clamped to 255 at very low qualities give a higher estimate, so low quality files are never taken for better than they are
+    def jpeg_quality(quantization):
+        if not quantization or 0 not in quantization:
+            return None
+        scale = sum(quantization[0]) * 100 / sum(ImageCatalog.JPEG_STANDARD_LUMINANCE_TABLE)
+        if scale <= 0:
+            return None
+        if scale <= 100:
+            return (200 - scale) / 2
+        return 5000 / scale
+
+class FingerprintCache:
+    """
+    On-disk store of the image matrices created by dif, so unchanged files don't have to be decoded again
+
+    cache_dir (str)..........folder where the cache files are stored
+    px_size (int)............size of the stored image matrices, every px_size has its own data file
+    reduced_decode (bool)....whether the matrices are decoded with reduced_decode, these are kept in files of their own
+
+    fingerprints.db..........sqlite index with path, size, mtime and slot of every cached file
+                             files that are not images are stored with slot -1
+    fingerprints_<px>.bin....packed uint8 image matrices, one px x px x 3 block per slot
+                             with reduced_decode fingerprints_reduced.db and fingerprints_reduced_<px>.bin
+    """
+
+    def __init__(self, cache_dir, px_size, reduced_decode=False):
+        self.cache_dir = Path(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.px_size = px_size
+        self.shape = (px_size, px_size, 3)
+        self.row_size = px_size * px_size * 3
+        name = "fingerprints_reduced" if reduced_decode else "fingerprints"
+        self.data_path = self.cache_dir / "{}_{}.bin".format(name, px_size)
+
+        self.db = sqlite3.connect(str(self.cache_dir / "{}.db".format(name)))
+        self.db.execute("CREATE TABLE IF NOT EXISTS fingerprints (path TEXT, px_size INTEGER, size INTEGER, mtime INTEGER, slot INTEGER, PRIMARY KEY (path, px_size))")
+        self.entries = {row[0]: tuple(row[1:]) for row in self.db.execute("SELECT path, size, mtime, slot FROM fingerprints WHERE px_size = ?", (px_size,))}
+        self.pending = {}
+        self.removed = set()
+        self.data = self._open_data()
+
+    # Function that returns the key under which a file is stored
+    def key(self, path):
+        return os.path.abspath(os.fspath(path))
+
+    # Function that returns the slot of the file if it's cached and unchanged, -1 for files that are not images, None if it's not cached
+    def lookup(self, path, stat):
+        entry = self.entries.get(self.key(path))
+        if entry == None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns or entry[2] >= self._slots():
+            return None
+        return entry[2]
+
+    # Function that returns the cached matrix in a slot, None for slot -1
+    def matrix(self, slot):
+        if slot < 0:
+            return None
+        return self.data[slot]
+
+    # Function that remembers a newly created matrix, it's written to disk by save()
+    def store(self, path, stat, img):
+        self.pending[self.key(path)] = (stat.st_size, stat.st_mtime_ns, img)
+
+    # Function that drops entries of files in the directory that no longer exist
+    def prune(self, directory, seen):
+        prefix = os.path.join(self.key(directory), "")
+        for path in self.entries:
+            if path.startswith(prefix) and path not in seen and path not in self.pending:
+                self.removed.add(path)
+
+    # Function that writes pending matrices into free slots of the data file and updates the index
+    def save(self):
+        if len(self.pending) == 0 and len(self.removed) == 0:
+            return
+
+        for path in self.removed:
+            del self.entries[path]
+        for path in self.pending:
+            self.entries.pop(path, None)
+        used = {entry[2] for entry in self.entries.values() if entry[2] >= 0}
+        free = iter(sorted(set(range(self._slots())) - used))
+
+        # data file can't be written to while it's mapped
+        self.data = None
+        rows = []
+        with open(self.data_path, "r+b" if self.data_path.exists() else "wb") as data_file:
+            end = data_file.seek(0, os.SEEK_END) // self.row_size
+            for path, (size, mtime, img) in self.pending.items():
+                slot = -1
+                if type(img) == np.ndarray:
+                    slot = next(free, None)
+                    if slot == None:
+                        slot = end
+                        end += 1
+                    data_file.seek(slot * self.row_size)
+                    data_file.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+                self.entries[path] = (size, mtime, slot)
+                rows.append((path, self.px_size, size, mtime, slot))
+
+        with self.db:
+            self.db.executemany("DELETE FROM fingerprints WHERE path = ? AND px_size = ?", [(path, self.px_size) for path in self.removed])
+            self.db.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)", rows)
+
+        self.pending = {}
+        self.removed = set()
+        self.data = self._open_data()
+
+    # Function that closes the cache, pending matrices are saved first
+    def close(self):
+        self.save()
+        self.data = None
+        self.db.close()
+
+    # Function that maps the data file into memory, returns an empty array if there's no data yet
+    def _open_data(self):
+        if not self.data_path.exists() or os.path.getsize(self.data_path) < self.row_size:
+            return np.empty((0,) + self.shape, dtype=np.uint8)
+        slots = os.path.getsize(self.data_path) // self.row_size
+        return np.memmap(self.data_path, dtype=np.uint8, mode="r", shape=(slots,) + self.shape)
+
+    # Function that returns the number of slots in the data file
+    def _slots(self):
+        return len(self.data) if self.data is not None else os.path.getsize(self.data_path) // self.row_size
+
+class FingerprintStore:
+    """
+    Memory-mapped N x px_size x px_size x 3 uint8 array of image matrices, written once in the order of their files
+    and then opened read-only, so processes can share it through its file instead of copying it
+
+    store_dir (str)..........folder where the .npy file is created, None = system temp folder
+    capacity (int)...........max number of matrices, the opened array holds only the appended ones
+    px_size (int)............size of the image matrices
+    """
+
+    def __init__(self, store_dir, capacity, px_size):
+        handle, self.path = tempfile.mkstemp(prefix="difpy_", suffix=".npy", dir=None if store_dir == None else str(store_dir))
+        os.close(handle)
+        self.count = 0
+        # an empty file can't be mapped, so there's always room for one matrix
+        self.matrices = np.lib.format.open_memmap(self.path, mode="w+", dtype=np.uint8, shape=(max(capacity, 1), px_size, px_size, 3))
+
+    # Function that appends a matrix to the store
+    def append(self, img):
+        self.matrices[self.count] = img
+        self.count += 1
+
+    # Function that finishes writing and returns the read-only array of the appended matrices
+    def open(self):
+        shape = self.matrices.shape[1:]
+        self.matrices.flush()
+        self.matrices = None
+        if self.count == 0:
+            os.remove(self.path)
+            return np.empty((0,) + shape, dtype=np.uint8)
+        return np.load(self.path, mmap_mode="r")[:self.count]
+
+class CachedMatrices:
+    """
+    Read-only image matrices kept in the data file of a FingerprintCache, in the order of their files,
+    used instead of a FingerprintStore so images that are all cached are compared without copying their matrices
+
+    data (memmap)............slots x px_size x px_size x 3 matrices of the cache, or the same matrices as rows
+    slots (list).............slot of every matrix in data
+    """
+
+    def __init__(self, data, slots):
+        self.data = data
+        self.slots = np.asarray(slots, dtype=np.int64)
+        self.shape = (len(self.slots),) + data.shape[1:]
+
+    def __len__(self):
+        return len(self.slots)
+
+    # an index returns a view of one matrix, a slice a copy of the matrices
+    def __getitem__(self, index):
+        return self.data[self.slots[index]]
+
+    def __iter__(self):
+        for slot in self.slots:
+            yield self.data[slot]
+
+    # Function that returns the matrices as flattened rows
+    def rows(self):
+        return CachedMatrices(self.data.reshape(len(self.data), -1), self.slots)
+
+class FingerprintLibrary:
+    """
+    Image matrices of a library kept between searches, so new images are compared against it without listing, decoding or copying
+    the library again, it's passed as directory_B of dif or dif.iter_clusters with library=True
+
+    px_size (int)............size of the image matrices, searches have to use the same px_size
+    mirror (bool)............mirror parameter of the searches, only matters with canonical
+    canonical (bool).........matrices are stored in their canonical orientation, searches have to use the same canonical parameter
+    store_dir (str)..........folder where the memory-mapped file of the matrices is created, None = system temp folder
+    reduced_decode (bool)....big JPEGs are downscaled while they are decoded, searches have to use the same reduced_decode parameter
+
+    the file grows as images are added, removed images keep their slot until the library is closed
+    """
+
+    def __init__(self, px_size=50, mirror=False, canonical=False, store_dir=None, reduced_decode=False):
+        self.px_size = px_size
+        self.reduced_decode = reduced_decode
+        self.shape = (px_size, px_size, 3)
+        self.canonical_transforms = dif._map_transforms(mirror, canonical)[1]
+        self.store_dir = store_dir
+        handle, self.path = tempfile.mkstemp(prefix="difpy_library_", suffix=".bin", dir=None if store_dir == None else str(store_dir))
+        os.close(handle)
+        self.data = np.empty((0,) + self.shape, dtype=np.uint8)
+        # file of every slot, None once it's removed, and the slots and files that are searched
+        self.files = []
+        self.slots = {}
+        self.live, self.table = array("q"), PathTable()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, path):
+        return os.path.abspath(os.fspath(path)) in self.slots
+
+    # Function that adds images to the library, files that are not images or are in it already are skipped
+    # cache_dir, fingerprints and workers are used like dif uses them
+    def add(self, paths, cache_dir=None, fingerprints=None, workers=1):
+        paths = [Path(path) for path in dict.fromkeys(os.path.abspath(os.fspath(path)) for path in paths) if path not in self.slots]
+        if len(paths) == 0:
+            return
+
+        cache = FingerprintCache(cache_dir, self.px_size, self.reduced_decode) if cache_dir != None else None
+        try:
+            img_matrices, files = dif._create_imgs_matrix(paths, self.px_size, False, cache, workers, None, self.store_dir, self.canonical_transforms, fingerprints, True, self.reduced_decode)
+        finally:
+            if cache != None:
+                cache.close()
+
+        start = len(self.files)
+        self._reserve(start + len(img_matrices))
+        step = max(1, BLOCK_BYTES // (self.px_size * self.px_size * 3))
+        for count in range(0, len(img_matrices), step):
+            self.data[start + count:start + min(count + step, len(img_matrices))] = img_matrices[count:count + step]
+        for slot, file in enumerate(files, start):
+            self.files.append(file)
+            self.slots[os.path.abspath(Path(file[0]) / file[1])] = slot
+            if self.table != None:
+                self.live.append(slot)
+                self.table.append(file)
+
+        store_file = getattr(img_matrices, "filename", None)
+        img_matrices = None
+        dif._remove_imgs_matrix(store_file)
+
+    # Function that removes an image from the library, it's not searched anymore
+    def remove(self, path):
+        slot = self.slots.pop(os.path.abspath(os.fspath(path)), None)
+        if slot != None:
+            self.files[slot] = None
+            self.table = None
+
+    # Function that returns the matrices as CachedMatrices and the PathTable of the images in the library, in the order they were added
+    def matrices(self):
+        if self.table == None:
+            self.live = array("q", (slot for slot, file in enumerate(self.files) if file != None))
+            self.table = PathTable(self.files[slot] for slot in self.live)
+        return CachedMatrices(self.data, self.live), self.table
+
+    # Function that removes the file of the library, nothing may use its matrices anymore
+    def close(self):
+        self.data = None
+        dif._remove_imgs_matrix(self.path)
+
+    # Function that grows the file, so it holds at least count matrices, to twice the size it had
+    def _reserve(self, count):
+        if count <= len(self.data):
+            return
+        capacity = max(count, 2 * len(self.data), 64)
+        self.data = None
+        os.truncate(self.path, capacity * self.shape[0] * self.shape[1] * 3)
+        self.data = np.memmap(self.path, dtype=np.uint8, mode="r+", shape=(capacity,) + self.shape)
+
+class PathTable:
+    """
+    Compact table of files in the (path, filename) format of folder_files, every folder is stored once
+    and the filenames are packed into one string with their offsets
+    """
+
+    def __init__(self, folder_files=()):
+        self.folders, self.folder_ids = [], {}
+        self.folder_index = array("i")
+        self.offsets = array("q", [0])
+        self.names, self.pending = "", []
+        for file in folder_files:
+            self.append(file)
+
+    # Function that appends a (path, filename) tuple to the table
+    def append(self, file):
+        folder_id = self.folder_ids.get(file[0])
+        if folder_id == None:
+            folder_id = len(self.folders)
+            self.folders.append(file[0])
+            self.folder_ids[file[0]] = folder_id
+        self.folder_index.append(folder_id)
+        self.pending.append(file[1])
+        self.offsets.append(self.offsets[-1] + len(file[1]))
+
+    def __len__(self):
+        return len(self.folder_index)
+
+    def __getitem__(self, index):
+        index = range(len(self))[index]
+        if len(self.pending) > 0:
+            self.names += "".join(self.pending)
+            self.pending = []
+        return self.folders[self.folder_index[index]], self.names[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+class UnionFind:
+    """
+    Disjoint sets of duplicate/similar images, a set is closed once the search passed its closing index
+    closed sets are removed, so memory only holds the sets that can still grow
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.members = {}
+        self.closing = {}
+        self.heap = []
+
+    # Function that returns the root of the set of key
+    def find(self, key):
+        root = key
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # path compression
+        while self.parent[key] != root:
+            self.parent[key], key = root, self.parent[key]
+        return root
+
+    # Function that joins the sets of key_A and key_B, closing is the index after which the joined set can't grow
+    def union(self, key_A, key_B, closing):
+        for key in (key_A, key_B):
+            if key not in self.parent:
+                self.parent[key] = key
+                self.members[key] = [key]
+                self.closing[key] = -1
+        root_A, root_B = self.find(key_A), self.find(key_B)
+        if root_A != root_B:
+            # the smaller set is attached to the bigger one
+            if len(self.members[root_A]) < len(self.members[root_B]):
+                root_A, root_B = root_B, root_A
+        previous = self.closing[root_A]
+        if root_A != root_B:
+            self.parent[root_B] = root_A
+            self.members[root_A].extend(self.members.pop(root_B))
+            self.closing[root_A] = max(self.closing[root_A], self.closing.pop(root_B))
+        self.closing[root_A] = max(self.closing[root_A], closing)
+        # the entry of the root is only outdated when its closing index moved
+        if self.closing[root_A] != previous:
+            heapq.heappush(self.heap, (self.closing[root_A], id(root_A), root_A))
+            if len(self.heap) > 2 * len(self.members) + 64:
+                self.heap = [(index, id(root), root) for root, index in self.closing.items()]
+                heapq.heapify(self.heap)
+
+    # Function that removes and returns the members of all sets closing before index, or of all sets with everything=True
+    def pop_closed(self, index, everything=False):
+        closed = []
+        while len(self.heap) > 0 and (everything or self.heap[0][0] < index):
+            closing, _, root = heapq.heappop(self.heap)
+            # entries of joined or grown sets are outdated
+            if root not in self.members or self.closing[root] != closing:
+                continue
+            members = self.members.pop(root)
+            del self.closing[root]
+            for key in members:
+                del self.parent[key]
+            closed.append(members)
+        return closed
+
+class BKTree:
+    """
+    Tree of 64 bit perceptual hashes, finds all items whose hash is within a hamming distance 
+    without measuring the distance to every hash in the tree
+
+    node (tuple).............(hash, list of items with that hash, dict of children by their distance to this node)
+    """
+
+    def __init__(self):
+        self.root = None
+
+    # Function that adds an item with its hash to the tree
+    def add(self, img_hash, item):
+        if self.root == None:
+            self.root = (img_hash, [item], {})
+            return
+        node = self.root
+        while True:
+            distance = bin(node[0] ^ img_hash).count("1")
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = (img_hash, [item], {})
+                return
+            node = node[2][distance]
+
+    # Function that returns all items whose hash is at most max_distance bits away from img_hash
+    def find(self, img_hash, max_distance):
+        found = []
+        nodes = [self.root] if self.root != None else []
+        while nodes:
+            node = nodes.pop()
+            distance = bin(node[0] ^ img_hash).count("1")
+            if distance <= max_distance:
+                found.extend(node[1])
+            # triangle inequality, only children in this range can hold hashes close enough
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return found
+
+# matrices of A and B memory-mapped by a pool worker of _find_matches_parallel
+_shared_matrices = {}
+
+# Function that maps the matrices read-only from their files when a pool worker starts
+def _map_shared_matrices(spec_A, spec_B):
+    for name, spec in (("A", spec_A), ("B", spec_B)):
+        if spec[0] == "cache":
+            _shared_matrices[name] = CachedMatrices(np.memmap(spec[1], dtype=np.uint8, mode="r", shape=spec[2]), spec[3])
+        else:
+            _shared_matrices[name] = np.load(spec[1], mmap_mode="r")[:spec[2]]
+
+# Function that compares one tile in a pool worker
+def _compare_shared_tile(tile, ref, same_dir, transforms, cascade):
+    return dif._compare_tile(_shared_matrices["A"], _shared_matrices["B"], tile, ref, same_dir, transforms, cascade)
+
 def type_str_int(x):
     try:
         return int(x)
@@ -400,13 +1840,41 @@ if __name__ == "__main__":
     parser.add_argument("-o", "--show_output", type=bool, help='(optional) Shows the comapred images in real-time.', required=False, nargs='?', choices=[True, False], default=False)
     parser.add_argument("-d", "--delete", type=bool, help='(optional) Deletes all duplicate images with lower quality.', required=False, nargs='?', choices=[True, False], default=False)
     parser.add_argument("-D", "--silent_del", type=bool, help='(optional) Supresses the user confirmation when deleting images.', required=False, nargs='?', choices=[True, False], default=False)
+    parser.add_argument("-c", "--cache_dir", type=str, help='(optional) Directory where image matrices are cached between runs.', required=False, nargs='?', default=None)
+    parser.add_argument("-w", "--workers", type=int, help='(optional) Number of processes used to decode and compare images.', required=False, nargs='?', default=1)
+    parser.add_argument("-i", "--index", type=type_str_int, help='(optional) Compare only images close in the perceptual hash index, True or max hamming distance.', required=False, nargs='?', const=True, default=False)
+    parser.add_argument("-L", "--library", help='(optional) Directory B is a deduplicated library, only new images in directory A are searched against it and against each other.', required=False, action='store_true')
+    parser.add_argument("-m", "--mirror", help='(optional) Also compares horizontally mirrored images.', required=False, action='store_true')
+    parser.add_argument("-C", "--canonical", help='(optional) Turns images to a canonical orientation and compares each pair once.', required=False, action='store_true')
+    parser.add_argument("-x", "--cascade", help='(optional) Rejects pairs by mean color and 8x8 block means before the full comparison.', required=False, action='store_true')
+    parser.add_argument("-M", "--catalog", type=str, help='(optional) File where header facts of the images are kept between runs, the duplicate with the higher resolution is kept.', required=False, nargs='?', default=None)
+    parser.add_argument("-R", "--reduced_decode", help='(optional) Downscales big JPEGs while they are decoded, faster but their diffs move by a few MSE.', required=False, action='store_true')
+    parser.add_argument("-r", "--index_recall", help='(optional) Reports the recall of the index against comparing all images in directory A and exits.', required=False, action='store_true')
     args = parser.parse_args()
 
+    if args.index == "True":
+        args.index = True
+    elif args.index == "False":
+        args.index = False
+
+    if args.index_recall:
+        img_matrices, folderfiles = dif._create_imgs_matrix(dif._process_directory(args.directory_A), args.px_size, args.show_progress, None, args.workers, reduced_decode=args.reduced_decode)
+        dif._index_recall(img_matrices, dif._map_similarity(args.similarity), range(0, 25, 2))
+        store_file = getattr(img_matrices, "filename", None)
+        img_matrices = None
+        dif._remove_imgs_matrix(store_file)
+        sys.exit()
+
+    catalog = ImageCatalog(args.catalog, args.workers) if args.catalog != None else None
+
     # initialize difPy
     search = dif(directory_A=args.directory_A, directory_B=args.directory_B,
                  similarity=args.similarity, px_size=args.px_size, 
                  show_output=args.show_output, show_progress=args.show_progress, 
-                 delete=args.delete, silent_del=args.silent_del)
+                 delete=args.delete, silent_del=args.silent_del, cache_dir=args.cache_dir, workers=args.workers, index=args.index, library=args.library, mirror=args.mirror, canonical=args.canonical, cascade=args.cascade, catalog=catalog, reduced_decode=args.reduced_decode)
+
+    if catalog != None:
+        catalog.close()
 
     # create filenames for the output files
     timestamp =str(time.time()).replace(".", "_")
@@ -1,14 +1,36 @@
-import sys, os, time, shutil, mozjpeg_lossless_optimization, statistics, cv2, numpy
-from subprocess import DEVNULL, STDOUT, check_call
+import sys, os, time, shutil, mozjpeg_lossless_optimization, statistics, numpy, sqlite3, hashlib, collections, select, struct
+from subprocess import DEVNULL, STDOUT, Popen
+from multiprocessing import Process
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from shutil import rmtree, move
 from pathlib import Path
 from io import BytesIO
 from PIL import Image
-from DifPy import dif
+from DifPy import dif, DirectoryIndex, ImageCatalog, FingerprintLibrary
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# inotify of Linux through libc, without it watching lists BASE_DIR again and again
+try:
+    import ctypes, ctypes.util
+    LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    LIBC.inotify_init1, LIBC.inotify_add_watch
+except (ImportError, OSError, TypeError, AttributeError):
+    LIBC = None
 
 # Declarations ---------------------------------------------------
 IMAGES = []
+MANIFEST = None
+UPSCALE_COSTS = None
+CATALOG = None
+FINGERPRINTS = {}
+STAGED = collections.Counter()
+WATCHING = False
 watch_start = datetime.now()
 RUNNING_DIR = str(Path(__file__).parent.resolve())
 # Declarations ---------------------------------------------------
@@ -18,33 +40,65 @@ DEBUG = False # whether you should see more info than you would normally need
 BASE_DIR = Path(RUNNING_DIR + '/Images/Base') # dir where images are located
 USE_RECURSION = True # will scan images located inside sub-folders recursively
 EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp'] # allowed image extensions for processing
+INDEX_SNAPSHOT_DIR = Path(RUNNING_DIR + '/Images/Cache') # dir where folder listings are kept so indexing again only lists folders that changed (None to disable)
+IMAGE_CATALOG_PATH = Path(RUNNING_DIR + '/Images/Cache/catalog.db') # keeps dimensions, format, JPEG quality and transparency read from the headers of indexed images, so the stages don't open them again and the duplicate with the higher resolution is kept (None to disable)
 FORCE_CREATE_DIRS = True # we dont ask user if they want directories created
 DELETE_DIRS_AFTER_EXIT = True # deletes temporary directories (OPTIMALIZED_IMGS_DIR_BASE, UPSCALED_IMGS_DIR, DUPLICATES_DIR if it's empty)
+STAGING_HARDLINKS = True # images put into upscale jobs and DUPLICATES_DIR are hardlinked when the file system can't reflink them, a hardlink is the same file as the image, so editing it edits the image too (False to copy instead)
+WORKERS = os.cpu_count() or 1 # number of processes used for work that can run in parallel
+PIPELINE_STREAMING = False # full cycle streams images from stage to stage instead of finishing every stage before the next one starts, duplicates are handled at the end
+PIPELINE_QUEUE_SIZE = 64 # max images waiting between two streamed stages, the stage before waits while it's full
+WATCH_DEBOUNCE = 2 # seconds an image has to stay unchanged before watching BASE_DIR takes it, so images still being copied are not taken half written
+WATCH_BATCH_SIZE = 64 # most images watching BASE_DIR streams through the stages at once, the ones that come in meanwhile go with the next batch
+WATCH_POLL_INTERVAL = 5 # seconds between listings of BASE_DIR when watching it without inotify (not Linux)
+WATCH_AUTO_CONFIRM = False # answer yes to the questions while watching BASE_DIR, duplicates are then deleted or saved to DUPLICATES_DIR as ALLOW_DELETING and ALLOW_DUPLICATES allow (False answers no, so nothing is deleted)
+PIPELINE_DEDUP_BATCH = 32 # optimalized images compared against the already cleared ones at once when streaming
 
 # Image duplicity handling
 ALLOW_DELETING = True # will ask if you want to delete duplicates
 ALLOW_DUPLICATES = True # will ask if you want to copy duplicates (only variations, not 1:1) to DUPLICATES_DIR for manual sorting
 Image.MAX_IMAGE_PIXELS = 1000000000 # max size of image in pixels (set low only in case that you process some random uploads as it's to prevent decompression bomb DOS attack)
 IMAGE_SIMILIARITY = "low" # low, normal, high or any int, which will be used as MSE threshold for comparison
+IMAGE_SIMILIARITY_PX_SIZE = 50 # images are shrunk to this many pixels in width and height before they are compared
+IMAGE_SIMILIARITY_INDEX = False # compare only images with close perceptual hashes (faster on big folders, may miss some duplicates), True or any int, which will be used as max hamming distance
+IMAGE_SIMILIARITY_MIRROR = False # also find horizontally mirrored duplicates
+IMAGE_SIMILIARITY_CANONICAL = False # turn images to a canonical orientation and compare each pair once (faster, may miss rotated copies of symmetric images)
+IMAGE_SIMILIARITY_CASCADE = False # reject pairs by mean color and 8x8 block means before the full comparison (same results, faster when few images are alike)
+IMAGE_SIMILIARITY_REDUCED_DECODE = False # downscale big JPEGs while they are decoded for comparison (faster for photos, but their MSE moves by a few points, so pairs near IMAGE_SIMILIARITY can be found differently)
 DUPLICATES_DIR = Path(RUNNING_DIR + '/Images/Duplicates') # dir where duplicates will be stored for manual sorting
+DUPLICATES_FIRST = False # full cycle looks for duplicates among the originals in BASE_DIR before optimalizing, so duplicates are never optimalized or upscaled (originals are not deleted, transparency is ignored when comparing)
+DUPLICATES_CHECK_LIBRARY = True # new images are checked only against each other and already processed images in OPTIMALIZED_IMGS_DIR_UPSCALED instead of the whole folder against itself
+FINGERPRINT_CACHE_DIR = Path(RUNNING_DIR + '/Images/Cache') # dir where image fingerprints are cached so unchanged images are not decoded again (None to disable)
+MANIFEST_PATH = Path(RUNNING_DIR + '/Images/manifest.db') # records what every stage made from which file content with which settings, so only changed work is redone and a crashed run resumes (None to disable)
 
 # Image optimalitazion
 OPTIMALIZED_IMGS_DIR_BASE = Path(RUNNING_DIR + '/Images/OptimalizedBase') # dir where base optimalized images should be stored
 OPTIMALIZED_IMGS_DIR_UPSCALED = Path(RUNNING_DIR + '/Images/BaseUpscaledOptimalized') # dir where base optimalized images should be stored
 OPTIMALIZATION_QUALITY = 70 # sets quality of image (worst, lower size 0 - 100 best, bigger size)
+OPTIMALIZATION_LOSSLESS_BELOW_QUALITY = True # JPEGs already saved at or below OPTIMALIZATION_QUALITY are only optimized losslessly instead of being re-encoded
+OPTIMALIZATION_MEMORY_BUDGET = None # megabytes the images optimalized at once are expected to take, big images are optimalized alone and small ones side by side (None for half of the memory of this machine or 2048 when it can't be found out, 0 for no limit)
+OPTIMALIZATION_FINGERPRINTS = True # base images get their duplicate detection fingerprints from the optimalized bytes in memory, so duplicate detection doesn't read and decode them again
 OPTIMALIZATION_TRANSPARENCY_REPLACE = True # replace transparency in images
 OPTIMALIZATION_TRANSPARENCY_REPLACE_COLOR = (255, 255, 255) # RGB
 OPTIMALIZATION_TRANSPARENCY_REPLACE_USE_AVERAGE = True # if true then transparent color will be average color
 
 # Image upscaling
+UPSCALE_BACKEND = "realesrgan" # realesrgan or lanczos (resize on the CPU, a stand-in to try and benchmark upscaling without a GPU)
 REALSRGAN_PATH = Path(RUNNING_DIR + '/Real-ESRGAN/realesrgan-ncnn-vulkan.exe') # path to executable that will do the upscaling
 UPSCALED_IMGS_DIR = Path(RUNNING_DIR + '/Images/Upscaled') # dir where upscaled images will be stored
+UPSCALE_STAGING_DIR = Path(RUNNING_DIR + '/Images/UpscaleStaging') # dir where the images of every upscale job are gathered and its outputs are written until the job is done
+UPSCALE_JOB_SIZE = 8 # images handed to one call of the upscaller (1 to upscale image by image)
+UPSCALE_CONCURRENT_JOBS = 1 # calls of the upscaller running at once
+UPSCALE_JOB_TIMEOUT = 300 # seconds one image may take, a job that runs longer than this times its images is killed and tried again (None for no limit)
+UPSCALE_JOB_RETRIES = 1 # how many times a failed or killed job is tried again
 UPSCALING_MODEL = "realesrgan-x4plus-anime" # model to be used when upscaling
 UPSCALE_SIZE = 4 # upscaled image will be X times the size of original
 UPSCALE_USE_GPU_ID = 0 # id of GPU to be used
 UPSCALE_OUTPUT_FORMAT = "jpg" # output format of uspcaled image
 UPSCALE_CMD_TEMPLATE = '"{}" -i "{}" -o "{}" -n {} -s {} -g {} -f {}' # template command with params for the upscaller
 UPSCALE_SKIP_MIN_MIL_PIXELS = 10 # how many milions of pixels muset be in image so that we skip it's upscaling, try to experiment with this value to see what's best for your image set (low - faster upscaling, high - best quality)
+UPSCALE_TIME_BUDGET = None # seconds a run may spend upscaling, images that gain the most quality per expected second are upscaled first and the ones that don't fit are left for the next run (None for no limit)
+UPSCALE_COSTS_PATH = Path(RUNNING_DIR + '/Images/upscale_costs.db') # records how long upscale jobs took, so the time of the next ones can be predicted for UPSCALE_TIME_BUDGET (None to disable, the budget then learns from the jobs of the run only)
 # Settings -------------------------------------------------------
 
 def clear():
@@ -78,7 +132,12 @@ def inputFromChoices(message, choices):
         if response in choices:
             return response
 
+# while watching BASE_DIR nobody answers, so the questions get WATCH_AUTO_CONFIRM, nothing is deleted unless it's set
 def askYN(message):
+    if WATCHING:
+        print("{} (y/n): {}".format(message, "y" if WATCH_AUTO_CONFIRM else "n"))
+        return WATCH_AUTO_CONFIRM
+
     while True:
         response = input("{} (y/n): ".format(message))
 
@@ -107,7 +166,215 @@ def check_directory(DIR, DIR_NAME, ERR_IF_NOT_EXISTS):
                 else:
                     sys.exit("Stopping execution as directory is needed.")
 
+# ioctl of Linux that makes a file share the data blocks of another one until either of them is written (reflink)
+FICLONE = 0x40049409
+
+# copies a file to where a stage needs it the cheapest way the file system allows, STAGED counts the ways
+# on the same file system a reflink shares the data blocks and a hardlink (STAGING_HARDLINKS) is the same file, neither copies a byte,
+# otherwise copy_file_range copies in the kernel and only where that's not supported the bytes go through a buffered copy
+def stage_file(source, target):
+    source, target = str(source), str(target)
+
+    # writing into an old hardlink would write into the file it's linked to
+    if os.path.lexists(target):
+        os.remove(target)
+
+    if os.stat(source).st_dev == os.stat(os.path.dirname(os.path.abspath(target))).st_dev:
+        if reflink_file(source, target):
+            STAGED["reflink"] += 1
+            return
+
+        if STAGING_HARDLINKS:
+            try:
+                os.link(source, target)
+                STAGED["hardlink"] += 1
+                return
+            except OSError:
+                pass
+
+    if kernel_copy_file(source, target):
+        STAGED["copy_file_range"] += 1
+        return
+
+    shutil.copy(source, target)
+    STAGED["copy"] += 1
+
+# reflinks source to target, False when the file system or the system doesn't support it
+def reflink_file(source, target):
+    if fcntl == None:
+        return False
+
+    try:
+        with open(source, "rb") as source_file, open(target, "wb") as target_file:
+            fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+
+        return True
+    except OSError:
+        if os.path.exists(target):
+            os.remove(target)
+
+        return False
+
+# copies source to target with copy_file_range, so the bytes never leave the kernel, False when it's not supported
+def kernel_copy_file(source, target):
+    if not hasattr(os, "copy_file_range"):
+        return False
+
+    try:
+        with open(source, "rb") as source_file, open(target, "wb") as target_file:
+            remaining = os.fstat(source_file.fileno()).st_size
+
+            while remaining > 0:
+                copied = os.copy_file_range(source_file.fileno(), target_file.fileno(), remaining)
+
+                if copied == 0:
+                    break
+
+                remaining -= copied
+
+        if remaining == 0:
+            return True
+    except OSError:
+        pass
+
+    if os.path.exists(target):
+        os.remove(target)
+
+    return False
+
+# how the files staged since the last report were staged
+def report_staging():
+    if len(STAGED) > 0:
+        debug("Staged {} file(s): {}".format(sum(STAGED.values()), ", ".join("{} {}".format(count, way) for way, count in STAGED.most_common())))
+        STAGED.clear()
+
+# blake2b of the content of a file, read in chunks
+def hash_file(path):
+    file_hash = hashlib.blake2b(digest_size=20)
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+class Manifest:
+    """
+    SQLite manifest of the pipeline, one row per stage and source file
+
+    stage............"optimalize base", "upscale" or "optimalize upscaled"
+    source...........absolute path of the input file of the stage
+    hash.............hash of the content of the source, size and mtime tell when it has to be hashed again
+    settings.........settings of the stage after the settings of the stages its source came from
+    output...........absolute path of the file the stage wrote
+    origin...........hash of the image in BASE_DIR the chain of stages started with
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(str(path))
+        self.db.execute("CREATE TABLE IF NOT EXISTS outputs (stage TEXT, source TEXT, hash TEXT, size INTEGER, mtime INTEGER, settings TEXT, output TEXT, origin TEXT, PRIMARY KEY (stage, source))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS outputs_output ON outputs (output)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS outputs_origin ON outputs (stage, origin)")
+        self.hashes = {}
+        self.uncommitted = 0
+
+    def key(self, path):
+        return os.path.abspath(str(path))
+
+    # hash of the file, hashed again only when its size or mtime changed since the manifest saw it
+    def file_hash(self, path):
+        key = self.key(path)
+        stat = os.stat(key)
+        entry = (key, stat.st_size, stat.st_mtime_ns)
+
+        if entry not in self.hashes:
+            row = self.db.execute("SELECT hash FROM outputs WHERE source = ? AND size = ? AND mtime = ? LIMIT 1", entry).fetchone()
+            self.hashes[entry] = row[0] if row != None else hash_file(key)
+
+        return self.hashes[entry]
+
+    # output of the stage if it was made from the same content of the source with the same settings and it still exists, otherwise None
+    def current(self, stage, source, settings):
+        row = self.db.execute("SELECT hash, settings, output FROM outputs WHERE stage = ? AND source = ?", (stage, self.key(source))).fetchone()
+
+        if row == None or row[1] != settings or not Path(row[2]).exists() or row[0] != self.file_hash(source):
+            return None
+
+        return Path(row[2])
+
+    # origin and settings of the chain of stages that wrote the file, None if no stage wrote it
+    def lineage(self, output):
+        return self.db.execute("SELECT origin, settings FROM outputs WHERE output = ? LIMIT 1", (self.key(output),)).fetchone()
+
+    # source that another stage run wrote the output from, None if the output is free
+    def owner(self, stage, output):
+        row = self.db.execute("SELECT source FROM outputs WHERE stage = ? AND output = ? LIMIT 1", (stage, self.key(output))).fetchone()
+        return row[0] if row != None else None
+
+    # whether the stage wrote a file of the origin with the settings that still exists
+    def produced(self, stage, origin, settings):
+        for (output,) in self.db.execute("SELECT output FROM outputs WHERE stage = ? AND origin = ? AND settings = ?", (stage, origin, settings)):
+            if Path(output).exists():
+                return True
+
+        return False
+
+    # records that the stage wrote output from source, committed in batches so a crash loses only the last few records
+    def record(self, stage, source, settings, output, origin=None):
+        key = self.key(source)
+        stat = os.stat(key)
+        source_hash = self.file_hash(key)
+
+        if origin == None:
+            lineage = self.lineage(key)
+            origin = lineage[0] if lineage != None else source_hash
+
+        self.db.execute("DELETE FROM outputs WHERE stage = ? AND output = ?", (stage, self.key(output)))
+        self.db.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (stage, key, source_hash, stat.st_size, stat.st_mtime_ns, settings, self.key(output), origin))
+        self.uncommitted += 1
+
+        if self.uncommitted >= 100:
+            self.save()
+
+    def save(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.save()
+        self.db.close()
+
+# settings the output of optimalize_images depends on
+def optimalization_settings():
+    return "optimalize quality={} lossless={} transparency={} color={} average={}".format(OPTIMALIZATION_QUALITY, OPTIMALIZATION_LOSSLESS_BELOW_QUALITY, OPTIMALIZATION_TRANSPARENCY_REPLACE, OPTIMALIZATION_TRANSPARENCY_REPLACE_COLOR, OPTIMALIZATION_TRANSPARENCY_REPLACE_USE_AVERAGE)
+
+# settings the output of start_upscalling depends on
+def upscale_settings():
+    return "upscale model={} size={} format={} skip={}".format(UPSCALING_MODEL, UPSCALE_SIZE, UPSCALE_OUTPUT_FORMAT, UPSCALE_SKIP_MIN_MIL_PIXELS)
+
+# settings of a stage after the settings of the stages its source came from
+def chain_settings(source, settings):
+    lineage = MANIFEST.lineage(source)
+    return settings if lineage == None else lineage[1] + " | " + settings
+
+# whether the image ended up in OPTIMALIZED_IMGS_DIR_UPSCALED already, by content and settings with the manifest, by name without it
+# settings are the settings of the stages the image went through so far
+def in_library(image, settings=None):
+    if MANIFEST != None:
+        lineage = MANIFEST.lineage(image)
+
+        if lineage == None and settings != None:
+            lineage = (MANIFEST.file_hash(image), None)
+
+        if lineage != None:
+            settings = settings if settings != None else lineage[1]
+            return MANIFEST.produced("optimalize upscaled", lineage[0], settings + " | " + upscale_settings() + " | " + optimalization_settings())
+
+    return OPTIMALIZED_IMGS_DIR_UPSCALED.joinpath(Path(image).name).exists()
+
 def init():
+    global MANIFEST, UPSCALE_COSTS, CATALOG
+
     debug("\nInit\n")
     debug("Check directories")
 
@@ -120,75 +387,231 @@ def init():
 
     check_directory(UPSCALED_IMGS_DIR, "UPSCALED_IMGS_DIR", False)
 
+    if FINGERPRINT_CACHE_DIR != None:
+        check_directory(FINGERPRINT_CACHE_DIR, "FINGERPRINT_CACHE_DIR", False)
+
+    if INDEX_SNAPSHOT_DIR != None:
+        check_directory(INDEX_SNAPSHOT_DIR, "INDEX_SNAPSHOT_DIR", False)
+
+    if MANIFEST_PATH != None:
+        check_directory(MANIFEST_PATH.parent, "MANIFEST_PATH", False)
+        MANIFEST = Manifest(MANIFEST_PATH)
+
+    if UPSCALE_COSTS_PATH != None:
+        check_directory(UPSCALE_COSTS_PATH.parent, "UPSCALE_COSTS_PATH", False)
+        UPSCALE_COSTS = UpscaleCosts(UPSCALE_COSTS_PATH)
+    elif UPSCALE_TIME_BUDGET != None:
+        # the budget needs the times of the jobs, without a file only the ones of this run are known
+        UPSCALE_COSTS = UpscaleCosts(":memory:")
+
+    if IMAGE_CATALOG_PATH != None:
+        check_directory(IMAGE_CATALOG_PATH.parent, "IMAGE_CATALOG_PATH", False)
+        CATALOG = ImageCatalog(IMAGE_CATALOG_PATH, WORKERS)
+
+    debug("UPSCALE_BACKEND: {}".format(UPSCALE_BACKEND))
+
+    if UPSCALE_BACKEND not in UPSCALE_BACKENDS:
+        sys.exit("Unknown UPSCALE_BACKEND {}, use one of: {}".format(UPSCALE_BACKEND, ", ".join(UPSCALE_BACKENDS)))
+
     debug("REALSRGAN_PATH: {}".format(REALSRGAN_PATH))
 
-    if not REALSRGAN_PATH.exists():
+    if UPSCALE_BACKEND == "realesrgan" and not REALSRGAN_PATH.exists():
         sys.exit("REALSRGAN was not found on this path.")
 
     debug("\nCheck settings")
     debug("EXTENSIONS: {}".format(EXTENSIONS))
     debug("FORCE_CREATE_DIRS: {}".format(FORCE_CREATE_DIRS))
     debug("DELETE_DIRS_AFTER_EXIT: {}".format(DELETE_DIRS_AFTER_EXIT))
+    debug("STAGING_HARDLINKS: {}".format(STAGING_HARDLINKS))
+    debug("WORKERS: {}".format(WORKERS))
+    debug("PIPELINE_STREAMING: {}".format(PIPELINE_STREAMING))
+    debug("PIPELINE_QUEUE_SIZE: {}".format(PIPELINE_QUEUE_SIZE))
+    debug("PIPELINE_DEDUP_BATCH: {}".format(PIPELINE_DEDUP_BATCH))
+    debug("WATCH_DEBOUNCE: {}".format(WATCH_DEBOUNCE))
+    debug("WATCH_BATCH_SIZE: {}".format(WATCH_BATCH_SIZE))
+    debug("WATCH_POLL_INTERVAL: {}".format(WATCH_POLL_INTERVAL))
+    debug("WATCH_AUTO_CONFIRM: {}".format(WATCH_AUTO_CONFIRM))
     debug("ALLOW_DELETING: {}".format(ALLOW_DELETING))
     debug("ALLOW_DUPLICATES: {}".format(ALLOW_DUPLICATES))
     debug("IMAGE_SIMILIARITY: {}".format(IMAGE_SIMILIARITY))
+    debug("IMAGE_SIMILIARITY_PX_SIZE: {}".format(IMAGE_SIMILIARITY_PX_SIZE))
+    debug("IMAGE_SIMILIARITY_INDEX: {}".format(IMAGE_SIMILIARITY_INDEX))
+    debug("IMAGE_SIMILIARITY_MIRROR: {}".format(IMAGE_SIMILIARITY_MIRROR))
+    debug("IMAGE_SIMILIARITY_CANONICAL: {}".format(IMAGE_SIMILIARITY_CANONICAL))
+    debug("IMAGE_SIMILIARITY_CASCADE: {}".format(IMAGE_SIMILIARITY_CASCADE))
+    debug("IMAGE_SIMILIARITY_REDUCED_DECODE: {}".format(IMAGE_SIMILIARITY_REDUCED_DECODE))
+    debug("DUPLICATES_FIRST: {}".format(DUPLICATES_FIRST))
+    debug("DUPLICATES_CHECK_LIBRARY: {}".format(DUPLICATES_CHECK_LIBRARY))
     debug("OPTIMALIZATION_QUALITY: {}".format(OPTIMALIZATION_QUALITY))
+    debug("OPTIMALIZATION_LOSSLESS_BELOW_QUALITY: {}".format(OPTIMALIZATION_LOSSLESS_BELOW_QUALITY))
+    debug("OPTIMALIZATION_MEMORY_BUDGET: {}".format(OPTIMALIZATION_MEMORY_BUDGET))
+    debug("OPTIMALIZATION_FINGERPRINTS: {}".format(OPTIMALIZATION_FINGERPRINTS))
     debug("UPSCALING_MODEL: {}".format(UPSCALING_MODEL))
     debug("UPSCALE_SIZE: {}".format(UPSCALE_SIZE))
     debug("UPSCALE_USE_GPU_ID: {}".format(UPSCALE_USE_GPU_ID))
     debug("UPSCALE_OUTPUT_FORMAT: {}".format(UPSCALE_OUTPUT_FORMAT))
     debug("UPSCALE_SKIP_MIN_MIL_PIXELS: {}".format(UPSCALE_SKIP_MIN_MIL_PIXELS))
+    debug("UPSCALE_JOB_SIZE: {}".format(UPSCALE_JOB_SIZE))
+    debug("UPSCALE_CONCURRENT_JOBS: {}".format(UPSCALE_CONCURRENT_JOBS))
+    debug("UPSCALE_JOB_TIMEOUT: {}".format(UPSCALE_JOB_TIMEOUT))
+    debug("UPSCALE_JOB_RETRIES: {}".format(UPSCALE_JOB_RETRIES))
+    debug("UPSCALE_TIME_BUDGET: {}".format(UPSCALE_TIME_BUDGET))
+
+    if OPTIMALIZATION_MEMORY_BUDGET == None and physical_memory() == None:
+        print("Could not find out the memory of this machine, images are optimalized within {} MB at once, set OPTIMALIZATION_MEMORY_BUDGET to change it".format(FALLBACK_MEMORY_BUDGET))
+
+# lists the images of a dir with the shared scandir indexer, with INDEX_SNAPSHOT_DIR only folders that changed since the last time are listed
+# the catalog reads the headers of the images that are new or changed since it saw them
+def index_directory(DIR):
+    snapshot = None
+
+    if INDEX_SNAPSHOT_DIR != None:
+        snapshot = INDEX_SNAPSHOT_DIR.joinpath("index_{}.pickle".format(hashlib.blake2b(os.path.abspath(DIR).encode(), digest_size=8).hexdigest()))
+
+    index = DirectoryIndex(DIR, EXTENSIONS, USE_RECURSION, snapshot, WORKERS).refresh()
+
+    if CATALOG != None:
+        CATALOG.update(index)
+
+    return index
+
+# header facts of an image (ImageInfo), from the catalog or read from the header when it's disabled
+def image_info(image):
+    return CATALOG.get(image) if CATALOG != None else ImageCatalog.read(image)
+
+# header facts of an image for a worker, None when the catalog is disabled as the worker opens the image anyway
+def catalog_info(image):
+    return CATALOG.get(image) if CATALOG != None else None
 
 def index_images(DIR):
     global IMAGES
-    IMAGES = []
 
     print("Indexing [{}] images in {}".format('|'.join(EXTENSIONS), str(DIR)))
     start_watch()
 
-    search_pattern = r'**/*' if USE_RECURSION else r'*'
-
-    for path in DIR.glob(search_pattern):
-        if path.exists() and path.is_file() and path.suffix.lower() in EXTENSIONS:
-            IMAGES.append(path)
+    IMAGES = index_directory(DIR).paths()
 
     print("Indexed {} images".format(len(IMAGES)))
     end_watch("Indexing")
 
 def find_duplicate_images(DIR):
-    print("Looking for duplicates in {}".format(DIR))
+    if DUPLICATES_CHECK_LIBRARY:
+        remove_images_in_library(DIR)
+
+        print("Looking for duplicates in {} and against {}".format(DIR, OPTIMALIZED_IMGS_DIR_UPSCALED))
+
+        search = dif(index_directory(DIR), index_directory(OPTIMALIZED_IMGS_DIR_UPSCALED), fingerprints=FINGERPRINTS, similarity=IMAGE_SIMILIARITY, px_size=IMAGE_SIMILIARITY_PX_SIZE, cache_dir=FINGERPRINT_CACHE_DIR, workers=WORKERS, index=IMAGE_SIMILIARITY_INDEX, mirror=IMAGE_SIMILIARITY_MIRROR, canonical=IMAGE_SIMILIARITY_CANONICAL, cascade=IMAGE_SIMILIARITY_CASCADE, catalog=CATALOG, reduced_decode=IMAGE_SIMILIARITY_REDUCED_DECODE, library=True)
+    else:
+        print("Looking for duplicates in {}".format(DIR))
+
+        search = dif(index_directory(DIR), fingerprints=FINGERPRINTS, similarity=IMAGE_SIMILIARITY, px_size=IMAGE_SIMILIARITY_PX_SIZE, cache_dir=FINGERPRINT_CACHE_DIR, workers=WORKERS, index=IMAGE_SIMILIARITY_INDEX, mirror=IMAGE_SIMILIARITY_MIRROR, canonical=IMAGE_SIMILIARITY_CANONICAL, cascade=IMAGE_SIMILIARITY_CASCADE, catalog=CATALOG, reduced_decode=IMAGE_SIMILIARITY_REDUCED_DECODE)
 
-    search = dif(DIR, similarity=IMAGE_SIMILIARITY)
+    # the fingerprints were taken by the cache or are of files that are deleted now
+    FINGERPRINTS.clear()
 
     if len(search.lower_quality) > 0:
-        COPY_DUPLICATES = False
+        list_duplicates(search)
 
-        if ALLOW_DUPLICATES:
-            if askYN("Save original vs duplicates to {} ?".format(DUPLICATES_DIR)):
-                COPY_DUPLICATES = True
+        if ALLOW_DELETING:
+            if askYN("\nDelete duplicates?".format(DUPLICATES_DIR)):
+                delete_images(search.lower_quality)
 
-        print("List of duplicate/similar images (original -> duplicates):\n")
+# duplicate detection on the originals in BASE_DIR, duplicates are left out of IMAGES so they are never optimalized or upscaled
+# originals are never deleted, images already in the library are left out of the search like remove_images_in_library does
+def skip_duplicate_originals():
+    global IMAGES
 
-        for result in search.result:
-            duplicity_result = search.result[result]
+    candidates = []
 
-            print("{} {}".format(result, duplicity_result["filename"]))
+    for image in IMAGES:
+        if MANIFEST != None:
+            library = in_library(image, chain_settings(image, optimalization_settings()))
+        else:
+            library = in_library(optimalized_name(image, OPTIMALIZED_IMGS_DIR_UPSCALED))
 
-            if COPY_DUPLICATES:
-                shutil.copy(duplicity_result["location"], DUPLICATES_DIR.joinpath("{} original{}".format(result, Path(duplicity_result["location"]).suffix)))
+        if not library:
+            candidates.append(image)
 
-            for i in range(0, len(duplicity_result["duplicates"]["paths"])):
-                duplicit_image = duplicity_result["duplicates"]["paths"][i]
-                diff = duplicity_result["duplicates"]["diffs"][i]
+    if len(candidates) == 0:
+        print("No images left to look for duplicates in")
+        return
 
-                print("\t{} {} [{}]".format(result, Path(duplicit_image).name, diff))
+    library = index_directory(OPTIMALIZED_IMGS_DIR_UPSCALED).paths() if DUPLICATES_CHECK_LIBRARY else []
 
-                if COPY_DUPLICATES and int(float(diff)) > 0:
-                    shutil.copy(duplicit_image, DUPLICATES_DIR.joinpath("{} duplicity variation {}{}".format(result, i, Path(duplicity_result["location"]).suffix)))
+    if len(library) > 0:
+        print("Looking for duplicates in {} and against {}".format(BASE_DIR, OPTIMALIZED_IMGS_DIR_UPSCALED))
 
-        if ALLOW_DELETING:
-            if askYN("\nDelete duplicates?".format(DUPLICATES_DIR)):
-                delete_images(search.lower_quality)
+        search = dif(candidates, library, similarity=IMAGE_SIMILIARITY, px_size=IMAGE_SIMILIARITY_PX_SIZE, cache_dir=FINGERPRINT_CACHE_DIR, workers=WORKERS, index=IMAGE_SIMILIARITY_INDEX, mirror=IMAGE_SIMILIARITY_MIRROR, canonical=IMAGE_SIMILIARITY_CANONICAL, cascade=IMAGE_SIMILIARITY_CASCADE, catalog=CATALOG, reduced_decode=IMAGE_SIMILIARITY_REDUCED_DECODE, library=True)
+    else:
+        print("Looking for duplicates in {}".format(BASE_DIR))
+
+        search = dif(candidates, similarity=IMAGE_SIMILIARITY, px_size=IMAGE_SIMILIARITY_PX_SIZE, cache_dir=FINGERPRINT_CACHE_DIR, workers=WORKERS, index=IMAGE_SIMILIARITY_INDEX, mirror=IMAGE_SIMILIARITY_MIRROR, canonical=IMAGE_SIMILIARITY_CANONICAL, cascade=IMAGE_SIMILIARITY_CASCADE, catalog=CATALOG, reduced_decode=IMAGE_SIMILIARITY_REDUCED_DECODE)
+
+    if len(search.lower_quality) == 0:
+        return
+
+    list_duplicates(search)
+
+    if not ALLOW_DELETING or not askYN("\nSkip optimalizing and upscaling duplicates? (originals are kept)"):
+        return
+
+    duplicates = {Path(image) for image in search.lower_quality}
+    IMAGES = [image for image in IMAGES if image not in duplicates]
+
+    # work the duplicates would have cost, upscaling grows with pixels
+    size = pixels = upscales = 0
+
+    for image in duplicates:
+        info = image_info(image)
+        size += info.size
+        pixels += info.width * info.height
+
+        if info.width * info.height <= UPSCALE_SKIP_MIN_MIL_PIXELS * 1000000:
+            upscales += 1
+
+    print("Skipping {} duplicate(s), avoided optimalizing {} MB and upscaling {} image(s) with {} milion pixels".format(len(duplicates), round(size / 1000000, 2), upscales, round(pixels / 1000000, 2)))
+
+# lists the duplicates found by dif and saves original vs duplicates to DUPLICATES_DIR if the user wants to
+def list_duplicates(search):
+    COPY_DUPLICATES = False
+
+    if ALLOW_DUPLICATES:
+        if askYN("Save original vs duplicates to {} ?".format(DUPLICATES_DIR)):
+            COPY_DUPLICATES = True
+
+    print("List of duplicate/similar images (original -> duplicates):\n")
+
+    for result in search.result:
+        duplicity_result = search.result[result]
+
+        print("{} {}".format(result, duplicity_result["filename"]))
+
+        if COPY_DUPLICATES:
+            stage_file(duplicity_result["location"], DUPLICATES_DIR.joinpath("{} original{}".format(result, Path(duplicity_result["location"]).suffix)))
+
+        for i in range(0, len(duplicity_result["duplicates"]["paths"])):
+            duplicit_image = duplicity_result["duplicates"]["paths"][i]
+            diff = duplicity_result["duplicates"]["diffs"][i]
+
+            print("\t{} {} [{}]".format(result, Path(duplicit_image).name, diff))
+
+            if COPY_DUPLICATES and int(float(diff)) > 0:
+                stage_file(duplicit_image, DUPLICATES_DIR.joinpath("{} duplicity variation {}{}".format(result, i, Path(duplicity_result["location"]).suffix)))
+
+    report_staging()
+
+# images already present in upscaled images would be reported as duplicates of themselves, upscaling skips them anyway
+def remove_images_in_library(DIR):
+    removed = 0
+
+    for path in index_directory(DIR).paths():
+        if in_library(path):
+            os.remove(path)
+            removed += 1
+            debug("{} will be skipped as it's already present in upscaled images".format(path.name))
+
+    if removed > 0:
+        print("Skipping {} image(s) that are already present in upscaled images {}".format(removed, OPTIMALIZED_IMGS_DIR_UPSCALED))
 
 def delete_images(images):
     print("")
@@ -208,88 +631,817 @@ def delete_images(images):
 
     print("Deleted {} images".format(deleted))
 
-def convert_to_optimized_image(input_path, output_path):
-    img_bytes = BytesIO()
-    has_transparency = False
+# with px_size the duplicate detection fingerprint is returned too, made from the written bytes while they are still in memory
+# so it's the same one dif would make by reading the file, with IMAGE_SIMILIARITY_REDUCED_DECODE big JPEGs are decoded at a fraction of their size for it like dif does
+def convert_to_optimized_image(input_path, output_path, px_size=None, info=None):
+    data = encode_optimized_image(input_path, info)
+
+    with open(output_path, "wb") as output_file:
+        output_file.write(data)
+
+    if px_size != None:
+        return dif.fingerprint(data, px_size, IMAGE_SIMILIARITY_REDUCED_DECODE)
+
+# the image is decoded once, the fill color is taken from the decoded pixels and the encoded jpeg is handed to mozjpeg without copying it
+# JPEGs that are already at or below the target quality are not decoded at all, their original bytes are only optimized losslessly
+# info are the header facts of the image from the catalog, with them such JPEGs are not even opened, without them the opened header is used
+def encode_optimized_image(input_path, info=None):
+    if info != None and losslessly_optimizable(info):
+        optimized = optimize_jpeg_losslessly(input_path)
+
+        if optimized != None:
+            return optimized
 
     with Image.open(input_path, "r") as image:
-        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
-            if OPTIMALIZATION_TRANSPARENCY_REPLACE:
-                if OPTIMALIZATION_TRANSPARENCY_REPLACE_USE_AVERAGE:
-                    avg_color = numpy.average(numpy.average(cv2.imread(str(input_path)), axis=0), axis=0)
-                    image = remove_transparency(image, (int(avg_color[0]), int(avg_color[1]), int(avg_color[2])))
-                else:
-                    image = remove_transparency(image, OPTIMALIZATION_TRANSPARENCY_REPLACE_COLOR)
+        if info == None:
+            info = ImageCatalog.describe(image)
+
+            if losslessly_optimizable(info):
+                optimized = optimize_jpeg_losslessly(input_path)
+
+                if optimized != None:
+                    return optimized
 
-                image.convert("RGB").save(img_bytes, format="JPEG", quality=OPTIMALIZATION_QUALITY)
+        if info.alpha:
+            image = image if image.mode == "RGBA" else image.convert("RGBA")
+
+            if not OPTIMALIZATION_TRANSPARENCY_REPLACE:
+                png_bytes = BytesIO()
+                image.save(png_bytes, format="PNG", quality=OPTIMALIZATION_QUALITY)
+                return png_bytes.getvalue()
+
+            if OPTIMALIZATION_TRANSPARENCY_REPLACE_USE_AVERAGE:
+                image = remove_transparency(image, average_color(image, OPTIMALIZATION_TRANSPARENCY_REPLACE_COLOR))
             else:
-                has_transparency = True
-                image.convert("RGBA").save(img_bytes, format="PNG", quality=OPTIMALIZATION_QUALITY)
-        else:
-            image.convert("RGB").save(img_bytes, format="JPEG", quality=OPTIMALIZATION_QUALITY)
+                image = remove_transparency(image, OPTIMALIZATION_TRANSPARENCY_REPLACE_COLOR)
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
 
-    img_bytes.seek(0)
+        img_bytes = BytesIO()
+        image.save(img_bytes, format="JPEG", quality=OPTIMALIZATION_QUALITY)
 
-    if not has_transparency:
-        img_bytes = mozjpeg_lossless_optimization.optimize(img_bytes.read())
+    return mozjpeg_lossless_optimization.optimize(img_bytes.getvalue())
 
-    with open(output_path, "wb") as output_file:
-        if has_transparency:
-            output_file.write(img_bytes.read())
-        else:
-            output_file.write(img_bytes)
+# whether the image is a JPEG saved at or below OPTIMALIZATION_QUALITY, which is only optimized losslessly
+def losslessly_optimizable(info):
+    return OPTIMALIZATION_LOSSLESS_BELOW_QUALITY and info.format == "JPEG" and info.mode in ('RGB', 'L') and info.quality != None and round(info.quality) <= OPTIMALIZATION_QUALITY
+
+# bytes a pixel takes once PIL decodes an image of the mode, the modes not listed take 4 (RGB is kept in 4 bytes too)
+PIXEL_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16L": 2, "I;16B": 2, "I;16N": 2}
+
+# peak bytes a worker is expected to take while optimalizing an image, from its header facts (ImageInfo)
+# while the image is open it's the decoded image and its RGBA and RGB copies, WebP is decoded through buffers of libwebp 4 times its size,
+# after it the RGB image and the DCT coefficients mozjpeg holds, 8 bytes per pixel, and a JPEG optimized losslessly takes up to 6 bytes per pixel of coefficients
+def optimalization_memory(info):
+    pixels = info.width * info.height
+
+    if losslessly_optimizable(info):
+        return pixels * (6 if info.mode == "RGB" else 2) + info.size * 2
+
+    decoded = PIXEL_BYTES.get(info.mode, 4) * (4 if info.format == "WEBP" else 1)
+
+    if info.alpha:
+        converting = decoded + (0 if info.mode == "RGBA" else 4) + 4
+    elif info.mode != "RGB":
+        converting = decoded + 4
+    else:
+        converting = decoded
+
+    return pixels * max(converting, 8)
+
+# the original JPEG bytes through mozjpeg's lossless optimization, None when mozjpeg can't read the file
+def optimize_jpeg_losslessly(input_path):
+    try:
+        return mozjpeg_lossless_optimization.optimize(Path(input_path).read_bytes())
+    except ValueError:
+        return None
+
+# average color of an RGBA image weighted by alpha, so fully transparent pixels don't count, summed in strips of rows to keep memory low
+def average_color(image, default_color):
+    width, height = image.size
+    color_sums = numpy.zeros(3, dtype=numpy.uint64)
+    alpha_sum = 0
+
+    for top in range(0, height, 256):
+        strip = numpy.asarray(image.crop((0, top, width, min(top + 256, height))))
+        alpha = strip[:, :, 3].astype(numpy.uint32)
+        color_sums += (strip[:, :, :3] * alpha[:, :, None]).sum(axis=(0, 1), dtype=numpy.uint64)
+        alpha_sum += int(alpha.sum())
+
+    if alpha_sum == 0:
+        return default_color
+
+    return tuple(int(round(int(color_sum) / alpha_sum)) for color_sum in color_sums)
 
 # https://stackoverflow.com/questions/35859140/remove-transparency-alpha-from-any-image-using-pil
+# pastes the RGBA image onto an RGB background using its own alpha as mask, so no bands are split and no RGB conversion follows
 def remove_transparency(im, replacing_color):
-    alpha = im.convert('RGBA').split()[-1]
-    bg = Image.new("RGBA", im.size, replacing_color + (255,))
-    bg.paste(im, mask=alpha)
+    bg = Image.new("RGB", im.size, replacing_color)
+    bg.paste(im, mask=im)
     return bg
 
-def optimalize_images(DIR):
+# runs in a worker process, returns (error, fingerprint), the error is returned instead of raised so one broken image doesn't stop the whole batch
+# the fingerprint is made only with px_size, info are the header facts of the image looked up before in the main process
+def optimalize_image(image, new_path, px_size=None, info=None):
+    try:
+        return None, convert_to_optimized_image(image, new_path, px_size, info)
+    except Exception as e:
+        # a half written image would be skipped as already optimalized next time
+        if new_path.exists():
+            os.remove(new_path)
+        return "{}: {}".format(type(e).__name__, e), None
+
+# px_size of the fingerprints the stage makes for duplicate detection, None when it makes none
+def fingerprint_size(stage):
+    return IMAGE_SIMILIARITY_PX_SIZE if stage == "optimalize base" and OPTIMALIZATION_FINGERPRINTS else None
+
+# where an image is optimalized to, (path, None) when it has to be optimalized, (path, "current") when it doesn't
+# and (None, "library") when it's in the library already (only images from BASE_DIR)
+# with the manifest an image is skipped when its output is current and images with the same name get the start of their hash appended,
+# without it the first image of a name is optimalized if it doesn't exist yet, new_paths are the outputs taken by this run so far
+def optimalization_path(image, DIR, stage, new_paths, settings):
+    new_path = optimalized_name(image, DIR)
+
+    if MANIFEST == None:
+        # only the first image is optimalized when more of them end up with the same name, like when converting one by one
+        if new_path.exists() or new_path in new_paths:
+            return new_path, "current"
+
+        new_paths.add(new_path)
+        return new_path, None
+
+    settings[image] = chain_settings(image, optimalization_settings())
+    output = MANIFEST.current(stage, image, settings[image])
+
+    if output != None:
+        return output, "current"
+
+    if stage == "optimalize base" and in_library(image, settings[image]):
+        return None, "library"
+
+    owner = MANIFEST.owner(stage, new_path)
+
+    if new_path in new_paths or (owner != None and owner != MANIFEST.key(image) and Path(owner).exists()):
+        new_path = new_path.with_name("{}_{}{}".format(new_path.stem, MANIFEST.file_hash(image)[:8], new_path.suffix))
+
+    new_paths.add(new_path)
+    return new_path, None
+
+# path in DIR an image gets when it's optimalized, before telling it apart from images with the same name
+def optimalized_name(image, DIR):
+    if OPTIMALIZATION_TRANSPARENCY_REPLACE:
+        return Path(DIR.joinpath(image.stem + ".jpg"))
+
+    file_name = os.path.basename(image)
+    index_of_dot = file_name.index('.')
+    file_name_without_extension = file_name[:index_of_dot]
+    return Path(DIR.joinpath(file_name_without_extension)).with_suffix(image.suffix)
+
+# records an optimalized image and keeps its fingerprint for duplicate detection
+def optimalized(stage, image, settings, new_path, fingerprint):
+    if MANIFEST != None:
+        MANIFEST.record(stage, image, settings[image], new_path)
+
+    if fingerprint is not None:
+        FINGERPRINTS[new_path] = fingerprint
+
+# megabytes optimalized at once when the memory of this machine can't be found out
+FALLBACK_MEMORY_BUDGET = 2048
+
+# bytes of OPTIMALIZATION_MEMORY_BUDGET, half of the memory of this machine when it's None or FALLBACK_MEMORY_BUDGET when that can't be found out, None for no limit
+def memory_budget():
+    if OPTIMALIZATION_MEMORY_BUDGET == 0:
+        return None
+
+    if OPTIMALIZATION_MEMORY_BUDGET != None:
+        return OPTIMALIZATION_MEMORY_BUDGET * 1024 * 1024
+
+    memory = physical_memory()
+
+    if memory == None:
+        return FALLBACK_MEMORY_BUDGET * 1024 * 1024
+
+    return memory // 2
+
+# bytes of physical memory of this machine, with sysconf on Linux and macOS and GlobalMemoryStatusEx on Windows, None if neither works
+def physical_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        pass
+
+    try:
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong), ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                        ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong), ("ullTotalVirtual", ctypes.c_ulonglong),
+                        ("ullAvailVirtual", ctypes.c_ulonglong), ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+    except (NameError, AttributeError, OSError):
+        pass
+
+    return None
+
+class MemoryBudget:
+    """
+    Admits optimalizing jobs to the process pool only while the memory they are expected to take fits under OPTIMALIZATION_MEMORY_BUDGET
+
+    limit....................bytes the admitted jobs may take at once, None for no limit
+    used.....................bytes the admitted jobs are expected to take
+    jobs.....................expected bytes of every admitted job by its future
+    peak.....................most bytes admitted at once
+    largest..................expected bytes of the biggest job
+
+    a job is admitted whenever no other one is, so an image bigger than the whole budget is still optimalized, alone
+    """
+
+    def __init__(self):
+        self.limit = memory_budget()
+        self.used = 0
+        self.jobs = {}
+        self.peak = 0
+        self.largest = 0
+
+    # expected bytes of optimalizing the image, 0 without a limit so no header is read for nothing
+    def estimate(self, image):
+        return optimalization_memory(image_info(image)) if self.limit != None else 0
+
+    def fits(self, estimate):
+        return self.limit == None or len(self.jobs) == 0 or self.used + estimate <= self.limit
+
+    def admit(self, future, estimate):
+        self.jobs[future] = estimate
+        self.used += estimate
+        self.peak = max(self.peak, self.used)
+        self.largest = max(self.largest, estimate)
+
+    def release(self, future):
+        self.used -= self.jobs.pop(future, 0)
+
+    def report(self):
+        if self.limit != None and self.largest > 0:
+            debug("Memory budget {} MB, at most {} MB admitted at once, biggest image {} MB".format(*(round(size / 1024 / 1024) for size in (self.limit, self.peak, self.largest))))
+
+class WorkerPool:
+    """
+    Process pool for optimalizing jobs that is started again when one of its workers dies
+
+    executor.................pool the jobs are submitted to
+    broken...................whether a worker of the pool died, nothing is submitted until every job of it is back
+    suspects.................images that were in the pool when it broke, they run again one at a time
+
+    a dead worker fails every job in the pool, so the jobs are run again alone and only the image that takes a worker down on its own is reported
+    """
+
+    def __init__(self):
+        self.executor = ProcessPoolExecutor(max_workers=WORKERS)
+        self.broken = False
+        self.suspects = set()
+
+    # whether the image may be submitted next to the running ones
+    def accepts(self, image, running):
+        if self.broken:
+            return False
+
+        return len(running) == 0 or (image not in self.suspects and not any(job in self.suspects for job in running))
+
+    # future of the job, None when the pool broke before it was submitted
+    def submit(self, image, new_path, px_size):
+        try:
+            return self.executor.submit(optimalize_image, image, new_path, px_size, catalog_info(image))
+        except BrokenProcessPool:
+            self.broken = True
+            return None
+
+    # whether the finished job has to run again, an image that broke the pool alone is reported through its result
+    def crashed(self, future, image):
+        if not isinstance(future.exception(), BrokenProcessPool):
+            self.suspects.discard(image)
+            return False
+
+        self.broken = True
+
+        if image in self.suspects:
+            self.suspects.discard(image)
+            return False
+
+        self.suspects.add(image)
+        return True
+
+    # a new pool once every job of the broken one is back
+    def restart(self, running):
+        if self.broken and len(running) == 0:
+            self.executor.shutdown()
+            self.executor = ProcessPoolExecutor(max_workers=WORKERS)
+            self.broken = False
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+# with more workers the biggest images are started first, each job only once the memory it's expected to take fits under the budget
+# next to the running ones, so big images run alone or few at a time and small ones fill the workers
+def optimalize_images(DIR, stage):
     print("Optimalizing images with {}% quality and saving them to {}".format(OPTIMALIZATION_QUALITY, DIR))
     start_watch()
 
     images_len = len(IMAGES)
+    new_paths = set()
+    jobs = []
+    settings = {}
+    errors = {}
+    in_library_count = 0
 
-    for i in range(0, images_len):
-        image = IMAGES[i]
+    for image in IMAGES:
+        new_path, skipped = optimalization_path(image, DIR, stage, new_paths, settings)
 
-        print("Optimalizing images: [{}/{}] [{}%]".format(i+1, images_len, round(((i+1)/images_len * 100))), end="\r")
+        if skipped == None:
+            jobs.append((image, new_path))
+        elif skipped == "library":
+            in_library_count += 1
 
-        if OPTIMALIZATION_TRANSPARENCY_REPLACE:
-            new_path = Path(DIR.joinpath(image.stem + ".jpg"))
-        else:
-            file_name = os.path.basename(image)
-            index_of_dot = file_name.index('.')
-            file_name_without_extension = file_name[:index_of_dot]
-            new_path = Path(DIR.joinpath(file_name_without_extension)).with_suffix(image.suffix)
+    done = images_len - len(jobs)
+    outputs = dict(jobs)
+    px_size = fingerprint_size(stage)
+
+    if WORKERS > 1 and len(jobs) > 1:
+        budget = MemoryBudget()
+        estimates = {image: budget.estimate(image) for image, new_path in jobs}
+        pending = collections.deque(sorted(jobs, key=lambda job: estimates[job[0]], reverse=True))
+
+        pool = WorkerPool()
+        futures = {}
+
+        try:
+            while len(pending) > 0 or len(futures) > 0:
+                while len(pending) > 0 and len(futures) < WORKERS and budget.fits(estimates[pending[0][0]]) and pool.accepts(pending[0][0], futures.values()):
+                    image, new_path = pending[0]
+                    future = pool.submit(image, new_path, px_size)
+
+                    if future == None:
+                        break
+
+                    pending.popleft()
+                    futures[future] = image
+                    budget.admit(future, estimates[image])
+
+                if len(futures) == 0:
+                    pool.restart(futures)
+                    continue
+
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    image = futures.pop(future)
+                    budget.release(future)
+
+                    if pool.crashed(future, image):
+                        pending.appendleft((image, outputs[image]))
+                        continue
+
+                    done += 1
+                    print("Optimalizing images: [{}/{}] [{}%]".format(done, images_len, round((done/images_len * 100))), end="\r")
+
+                    try:
+                        error, fingerprint = future.result()
+                    except Exception as e:
+                        error = "{}: {}".format(type(e).__name__, e)
+
+                    if error != None:
+                        errors[image] = error
+                    else:
+                        optimalized(stage, image, settings, outputs[image], fingerprint)
+
+                pool.restart(futures)
+        finally:
+            pool.shutdown()
+
+        budget.report()
+    else:
+        for image, new_path in jobs:
+            done += 1
+            print("Optimalizing images: [{}/{}] [{}%]".format(done, images_len, round((done/images_len * 100))), end="\r")
+
+            error, fingerprint = optimalize_image(image, new_path, px_size, catalog_info(image))
+
+            if error != None:
+                errors[image] = error
+            else:
+                optimalized(stage, image, settings, new_path, fingerprint)
 
-        if not new_path.exists():
-            convert_to_optimized_image(image, new_path)
+    if MANIFEST != None:
+        MANIFEST.save()
 
     print("Optimalizing images: [{}/{}] [100%]".format(images_len, images_len))
+
+    if in_library_count > 0:
+        print("Skipped {} image(s) that are already present in upscaled images {}".format(in_library_count, OPTIMALIZED_IMGS_DIR_UPSCALED))
+
+    if len(errors) > 0:
+        print("Could not optimalize {} image(s):".format(len(errors)))
+
+        for image, _ in jobs:
+            if image in errors:
+                print("\t{} [{}]".format(image, errors[image]))
+
     end_watch("Optimalizing")
 
+# whether the image has enough pixels to not be upscaled
+def has_upscale_quality(img):
+    info = image_info(img)
+    total_pixels = (info.width * info.height)
+
+    if total_pixels > (UPSCALE_SKIP_MIN_MIL_PIXELS * 1000000):
+        debug("{} will be skipped as it has {} pixels ({}x{})".format(img.name, total_pixels, info.width, info.height))
+        return True
+
+    return False
+
+# pixels of an image, from its header facts
+def image_pixels(img):
+    info = image_info(img)
+    return info.width * info.height
+
+# quality an image gains from upscaling, from 1 for the smallest images down to 0 at UPSCALE_SKIP_MIN_MIL_PIXELS where upscaling is skipped
+# every run the image was deferred adds 1, so the images left for the next run go before new ones and none is put off forever
+def upscale_gain(pixels, deferred_runs):
+    return 1 - min(pixels / (UPSCALE_SKIP_MIN_MIL_PIXELS * 1000000), 1) + deferred_runs
+
+# with UPSCALE_TIME_BUDGET the images that gain the most per expected second are picked while they fit in the budget of every job slot,
+# an image that doesn't fit anymore is passed over for cheaper ones that still do, the picked ones stay in that order so when the jobs
+# take longer than expected it's the images that gain the least that the scheduler defers
+# until UPSCALE_COSTS knows the backend the images are only ordered by gain and the scheduler stops starting jobs once the budget is spent
+# returns (picked, deferred)
+def plan_upscales(images):
+    if UPSCALE_TIME_BUDGET == None:
+        return images, []
+
+    pixels = {image: image_pixels(image) for image in images}
+    gains = {image: upscale_gain(pixels[image], UPSCALE_COSTS.deferred_runs(image) if UPSCALE_COSTS != None else 0) for image in images}
+    image_cost = UPSCALE_COSTS.image_cost if UPSCALE_COSTS != None else None
+
+    if image_cost == None or image_cost(0) == None:
+        return sorted(images, key=lambda image: -gains[image]), []
+
+    costs = {image: image_cost(pixels[image]) for image in images}
+    capacity = UPSCALE_TIME_BUDGET * UPSCALE_CONCURRENT_JOBS
+    picked = []
+    deferred = []
+
+    for image in sorted(images, key=lambda image: -gains[image] / max(costs[image], 1e-6)):
+        if costs[image] <= capacity:
+            picked.append(image)
+            capacity -= costs[image]
+        else:
+            deferred.append(image)
+
+    return picked, deferred
+
+# moves an image that won't be upscaled to the library, recorded as if it went through the remaining stages, so the next run finds it there
+def move_to_library(image):
+    library_path = OPTIMALIZED_IMGS_DIR_UPSCALED.joinpath(image.name)
+
+    if MANIFEST != None:
+        MANIFEST.record("optimalize upscaled", image, chain_settings(image, upscale_settings() + " | " + optimalization_settings()), library_path)
+
+    move(image, library_path)
+    return library_path
+
+# path the upscaller writes the upscale of an image to
+def upscaled_path(image, OUTPUT_DIR):
+    return Path(OUTPUT_DIR).joinpath(image.stem + "." + UPSCALE_OUTPUT_FORMAT)
+
+def upscaling_command(INPUT_DIR, OUTPUT_DIR):
+    upscaling_cmd = UPSCALE_CMD_TEMPLATE.format(REALSRGAN_PATH, INPUT_DIR, OUTPUT_DIR, UPSCALING_MODEL, UPSCALE_SIZE, UPSCALE_USE_GPU_ID, UPSCALE_OUTPUT_FORMAT)
+
+    debug("Calling upscaller using:")
+    debug(upscaling_cmd + "\n")
+
+    return upscaling_cmd
+
+class UpscaleCosts:
+    """
+    SQLite record of how long upscale jobs took, every run learns from the jobs of the runs before it
+
+    a job is expected to take start + per image * images + per pixel * upscaled pixels seconds, fitted by least squares to the last
+    FITTED_JOBS jobs of the backend and model, upscaled pixels are the input pixels times UPSCALE_SIZE squared, so jobs
+    of another size count too, a part that would come out negative is left out and the rest is fitted again
+
+    record(pixels, seconds)...records a finished job, pixels are the input pixels of its images
+    predict(pixels)...........seconds a job of images with the pixels is expected to take, None until a job of the backend was recorded
+    image_cost(pixels)........seconds one image adds to a run, its share of the job start included
+    defer(images).............counts that the images were left for the next run
+    deferred_runs(image)......how many runs the image was left for the next one
+    forget(images)............drops the count of images that were upscaled
+    """
+
+    FITTED_JOBS = 200
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(str(path))
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (backend TEXT, model TEXT, images INTEGER, pixels INTEGER, seconds REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS deferred (image TEXT PRIMARY KEY, runs INTEGER)")
+        self.coefficients = None
+        self.fitted = False
+
+    def record(self, pixels, seconds):
+        self.db.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?)", (UPSCALE_BACKEND, UPSCALING_MODEL, len(pixels), sum(pixels) * UPSCALE_SIZE ** 2, seconds))
+        self.db.commit()
+        self.fitted = False
+
+    # (start, per image, per upscaled pixel) or None
+    def fit(self):
+        if not self.fitted:
+            self.fitted = True
+            self.coefficients = None
+
+            rows = self.db.execute("SELECT images, pixels, seconds FROM jobs WHERE backend = ? AND model = ? ORDER BY rowid DESC LIMIT ?", (UPSCALE_BACKEND, UPSCALING_MODEL, self.FITTED_JOBS)).fetchall()
+
+            if len(rows) == 0:
+                return None
+
+            # pixels in millions so the columns are of a similar scale
+            features = numpy.array([[1, images, pixels / 1000000] for images, pixels, seconds in rows], dtype=numpy.float64)
+            seconds = numpy.array([row[2] for row in rows], dtype=numpy.float64)
+            used = [0, 1, 2]
+
+            while len(used) > 0:
+                solution = numpy.linalg.lstsq(features[:, used], seconds, rcond=None)[0]
+
+                if solution.min() >= 0:
+                    coefficients = [0.0, 0.0, 0.0]
+
+                    for column, value in zip(used, solution):
+                        coefficients[column] = float(value)
+
+                    coefficients[2] /= 1000000
+                    self.coefficients = tuple(coefficients)
+                    break
+
+                used.pop(int(solution.argmin()))
+
+        return self.coefficients
+
+    def predict(self, pixels):
+        coefficients = self.fit()
+
+        if coefficients == None:
+            return None
+
+        start, per_image, per_pixel = coefficients
+        return start + per_image * len(pixels) + per_pixel * sum(pixels) * UPSCALE_SIZE ** 2
+
+    def image_cost(self, pixels):
+        coefficients = self.fit()
+
+        if coefficients == None:
+            return None
+
+        start, per_image, per_pixel = coefficients
+        return start / UPSCALE_JOB_SIZE + per_image + per_pixel * pixels * UPSCALE_SIZE ** 2
+
+    def defer(self, images):
+        for image in images:
+            key = os.path.abspath(str(image))
+            self.db.execute("INSERT OR IGNORE INTO deferred VALUES (?, 0)", (key,))
+            self.db.execute("UPDATE deferred SET runs = runs + 1 WHERE image = ?", (key,))
+
+        self.db.commit()
+
+    def deferred_runs(self, image):
+        row = self.db.execute("SELECT runs FROM deferred WHERE image = ?", (os.path.abspath(str(image)),)).fetchone()
+        return row[0] if row != None else 0
+
+    def forget(self, images):
+        self.db.executemany("DELETE FROM deferred WHERE image = ?", [(os.path.abspath(str(image)),) for image in images])
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+class RealesrganBackend:
+    """
+    Upscale backend running REALSRGAN_PATH with UPSCALE_CMD_TEMPLATE, a backend starts a job on a folder of images and writes
+    the upscales to the output folder as <stem>.<UPSCALE_OUTPUT_FORMAT>
+
+    start(input, output)......starts the job and returns its handle
+    poll(handle)..............None while the job runs, its exit code once it ended
+    stop(handle)..............kills the job
+    """
+
+    def start(self, INPUT_DIR, OUTPUT_DIR):
+        return Popen(upscaling_command(INPUT_DIR, OUTPUT_DIR), stdout=DEVNULL, stderr=STDOUT)
+
+    def poll(self, handle):
+        return handle.poll()
+
+    def stop(self, handle):
+        handle.kill()
+        handle.wait()
+
+class LanczosBackend:
+    """
+    Upscale backend resizing with Lanczos in a process of its own, so upscaling can be tried and benchmarked without a GPU
+    """
+
+    def start(self, INPUT_DIR, OUTPUT_DIR):
+        handle = Process(target=lanczos_upscale, args=(str(INPUT_DIR), str(OUTPUT_DIR), UPSCALE_SIZE, UPSCALE_OUTPUT_FORMAT))
+        handle.start()
+        return handle
+
+    def poll(self, handle):
+        return None if handle.is_alive() else handle.exitcode
+
+    def stop(self, handle):
+        handle.terminate()
+        handle.join()
+
+UPSCALE_BACKENDS = {"realesrgan": RealesrganBackend, "lanczos": LanczosBackend}
+
+# runs in the process of LanczosBackend
+def lanczos_upscale(INPUT_DIR, OUTPUT_DIR, size, output_format):
+    for entry in os.scandir(INPUT_DIR):
+        with Image.open(entry.path) as image:
+            image = image.convert("RGBA" if output_format == "png" else "RGB")
+            image = image.resize((image.width * size, image.height * size), Image.LANCZOS)
+            image.save(os.path.join(OUTPUT_DIR, os.path.splitext(entry.name)[0] + "." + output_format))
+
+class UpscaleScheduler:
+    """
+    Feeds images to the upscale backend in jobs of UPSCALE_JOB_SIZE images, UPSCALE_CONCURRENT_JOBS at a time
+
+    every job gets a folder in UPSCALE_STAGING_DIR with its images and its own output folder, upscales are moved to OUTPUT_DIR only
+    once the job ended well, so everything in OUTPUT_DIR is complete and an interrupted run goes on with the images that are missing
+    a job that fails or runs out of its UPSCALE_JOB_TIMEOUT is tried again UPSCALE_JOB_RETRIES times, after that its images are failed
+    with UPSCALE_TIME_BUDGET a job is started only if UPSCALE_COSTS expects it to end within the budget, counted from the first job,
+    the images of the jobs that don't are deferred to the next run, finished jobs are recorded to UPSCALE_COSTS
+
+    add(images)...............queues images for upscaling
+    defer(images).............leaves images for the next run
+    poll()....................starts and checks jobs, returns [(image, upscale)] of the images that are done since the last poll
+    busy()....................whether jobs are queued or running
+    """
+
+    def __init__(self, OUTPUT_DIR):
+        self.backend = UPSCALE_BACKENDS[UPSCALE_BACKEND]()
+        self.output_dir = Path(OUTPUT_DIR)
+        self.queue = collections.deque()
+        self.running = []
+        self.jobs = 0
+        self.upscaled = 0
+        self.failed = {}
+        self.deferred = []
+        self.began = None
+        # (images of the job, seconds it took)
+        self.timings = []
+
+    def add(self, images):
+        for start in range(0, len(images), UPSCALE_JOB_SIZE):
+            job_images = images[start:start + UPSCALE_JOB_SIZE]
+            self.queue.append({"images": job_images, "pixels": [image_pixels(image) for image in job_images], "attempt": 0})
+
+    def defer(self, images):
+        self.deferred.extend(images)
+
+        if UPSCALE_COSTS != None:
+            UPSCALE_COSTS.defer(images)
+
+    # whether the job is expected to end within UPSCALE_TIME_BUDGET, jobs are started while nothing is known about their time
+    def fits(self, job):
+        if UPSCALE_TIME_BUDGET == None or UPSCALE_COSTS == None or self.began == None:
+            return True
+
+        expected = UPSCALE_COSTS.predict(job["pixels"])
+        return expected == None or time.time() - self.began + expected <= UPSCALE_TIME_BUDGET
+
+    def busy(self):
+        return len(self.queue) > 0 or len(self.running) > 0
+
+    # free job slots, a caller that fills the queue only while there are some keeps the images waiting with it
+    def free_slots(self):
+        return UPSCALE_CONCURRENT_JOBS - len(self.running) - len(self.queue)
+
+    def poll(self):
+        done = []
+
+        for job in list(self.running):
+            code = self.backend.poll(job["handle"])
+            elapsed = time.time() - job["started"]
+
+            if code == None and (UPSCALE_JOB_TIMEOUT == None or elapsed < UPSCALE_JOB_TIMEOUT * len(job["images"])):
+                continue
+
+            self.running.remove(job)
+
+            if code == None:
+                self.backend.stop(job["handle"])
+                self.retry(job, "killed after {} seconds".format(round(elapsed)))
+            elif code != 0:
+                self.retry(job, "exit code {}".format(code))
+            else:
+                self.timings.append((job["images"], elapsed))
+
+                if UPSCALE_COSTS != None:
+                    UPSCALE_COSTS.record(job["pixels"], elapsed)
+
+                done.extend(self.finish(job))
+
+        while len(self.running) < UPSCALE_CONCURRENT_JOBS and len(self.queue) > 0:
+            job = self.queue.popleft()
+
+            if self.fits(job):
+                self.start(job)
+            else:
+                self.defer(job["images"])
+
+        return done
+
+    def start(self, job):
+        self.jobs += 1
+        job["dir"] = UPSCALE_STAGING_DIR.joinpath("job_{}".format(self.jobs))
+
+        if job["dir"].exists():
+            rmtree(job["dir"])
+
+        os.makedirs(job["dir"].joinpath("in"))
+        os.makedirs(job["dir"].joinpath("out"))
+
+        for image in job["images"]:
+            stage_file(image, job["dir"].joinpath("in", image.name))
+
+        job["started"] = time.time()
+        self.began = self.began if self.began != None else job["started"]
+        job["handle"] = self.backend.start(job["dir"].joinpath("in"), job["dir"].joinpath("out"))
+        self.running.append(job)
+
+    # the upscales of a job that ended well are moved to OUTPUT_DIR, an image without one failed
+    def finish(self, job):
+        done = []
+
+        for image in job["images"]:
+            upscale = upscaled_path(image, job["dir"].joinpath("out"))
+
+            if upscale.exists():
+                os.replace(upscale, upscaled_path(image, self.output_dir))
+                done.append((image, upscaled_path(image, self.output_dir)))
+            else:
+                self.failed[image] = "no upscale written"
+
+        rmtree(job["dir"])
+        self.upscaled += len(done)
+
+        if UPSCALE_COSTS != None:
+            UPSCALE_COSTS.forget([image for image, upscale in done])
+
+        return done
+
+    def retry(self, job, reason):
+        rmtree(job["dir"])
+        job["attempt"] += 1
+
+        if job["attempt"] <= UPSCALE_JOB_RETRIES:
+            debug("Upscale job of {} image(s) {}, trying again".format(len(job["images"]), reason))
+            self.queue.appendleft(job)
+        else:
+            for image in job["images"]:
+                self.failed[image] = reason
+
+    def report(self):
+        report_staging()
+
+        if len(self.timings) > 0:
+            images = sum(len(images) for images, elapsed in self.timings)
+            seconds = sum(elapsed for images, elapsed in self.timings)
+            print("Upscaled {} image(s) in {} job(s), {} seconds per image, slowest job took {} seconds".format(self.upscaled, len(self.timings), round(seconds / images, 3), round(max(elapsed for images, elapsed in self.timings), 3)))
+
+        if len(self.failed) > 0:
+            print("Could not upscale {} image(s):".format(len(self.failed)))
+
+            for image, reason in self.failed.items():
+                print("\t{} [{}]".format(image, reason))
+
+        if len(self.deferred) > 0:
+            print("Deferred {} image(s) to the next run as they don't fit in the upscale time budget of {} seconds".format(len(self.deferred), UPSCALE_TIME_BUDGET))
+
+# with the manifest images whose upscale is current are not upscaled again, without it images whose upscale exists
+# the upscales are recorded as their jobs end, so an interrupted run goes on where it stopped
+# with UPSCALE_TIME_BUDGET only the images plan_upscales picks are upscaled, the rest stays in INPUT_DIR for the next run
 def start_upscalling(INPUT_DIR, OUTPUT_DIR):
     debug("Determining which images have enough quality to not be upscaled")
 
     already_upscaled_imgs = []
     upscale_skipped_imgs = []
 
-    pixels_needed_to_skip = (UPSCALE_SKIP_MIN_MIL_PIXELS * 1000000)
-
     for img in IMAGES:
-        with Image.open(img) as image:
-            width, height = image.size
-            total_pixels = (width * height)
-
-            if OPTIMALIZED_IMGS_DIR_UPSCALED.joinpath(img.name).exists():
-                already_upscaled_imgs.append(img)
-                debug("{} will be skipped as it's already present in upscaled images".format(img.name))
-            elif total_pixels > pixels_needed_to_skip:
-                upscale_skipped_imgs.append(img)
-                debug("{} will be skipped as it has {} pixels ({}x{})".format(img.name, total_pixels, width, height))
+        if in_library(img):
+            already_upscaled_imgs.append(img)
+            debug("{} will be skipped as it's already present in upscaled images".format(img.name))
+        elif has_upscale_quality(img):
+            upscale_skipped_imgs.append(img)
 
     for image in already_upscaled_imgs:
         os.remove(image)
@@ -299,24 +1451,601 @@ def start_upscalling(INPUT_DIR, OUTPUT_DIR):
         print("Skipping {} image(s) that are already present in upscaled images {}".format(len(already_upscaled_imgs), OPTIMALIZED_IMGS_DIR_UPSCALED))
 
     for image in upscale_skipped_imgs:
-        move(image, OPTIMALIZED_IMGS_DIR_UPSCALED.joinpath(image.name))
+        move_to_library(image)
         IMAGES.remove(image)
 
     if len(upscale_skipped_imgs) > 0:
         print("{} image(s) are of high quality to not be upscaled, they will be moved to {}".format(len(upscale_skipped_imgs), OPTIMALIZED_IMGS_DIR_UPSCALED))
-    
-    if len(IMAGES) > 0:
-        upscaling_cmd = UPSCALE_CMD_TEMPLATE.format(REALSRGAN_PATH, INPUT_DIR, OUTPUT_DIR, UPSCALING_MODEL, UPSCALE_SIZE, UPSCALE_USE_GPU_ID, UPSCALE_OUTPUT_FORMAT)
 
-        debug("Calling upscaller using:")
-        debug(upscaling_cmd + "\n")
-        print("Upscalling {} image(s), you can check progress by looking in {}".format(len(IMAGES), UPSCALED_IMGS_DIR))
+    settings = {}
+    pending = []
+
+    for image in IMAGES:
+        if MANIFEST != None:
+            settings[image] = chain_settings(image, upscale_settings())
+
+            if MANIFEST.current("upscale", image, settings[image]) != None:
+                continue
+        elif upscaled_path(image, OUTPUT_DIR).exists():
+            continue
+
+        pending.append(image)
 
+    if len(pending) < len(IMAGES):
+        print("Skipping {} image(s) that are already upscaled in {}".format(len(IMAGES) - len(pending), OUTPUT_DIR))
+
+    pending, deferred = plan_upscales(pending)
+    scheduler = UpscaleScheduler(OUTPUT_DIR)
+    scheduler.defer(deferred)
+
+    if len(pending) > 0:
+        print("Upscalling {} image(s) with {}".format(len(pending), UPSCALE_BACKEND))
         start_watch()
-        check_call(upscaling_cmd, stdout=DEVNULL, stderr=STDOUT)
+
+        scheduler.add(pending)
+        done = 0
+
+        while scheduler.busy():
+            for image, upscaled in scheduler.poll():
+                done += 1
+
+                if MANIFEST != None:
+                    MANIFEST.record("upscale", image, settings[image], upscaled)
+                    MANIFEST.save()
+
+            print("Upscalling images: [{}/{}] [{}%]".format(done, len(pending), round((done/len(pending) * 100))), end="\r")
+            time.sleep(0.05)
+
+        print("")
+
+        if UPSCALE_STAGING_DIR.exists():
+            rmtree(UPSCALE_STAGING_DIR)
+
+        scheduler.report()
         end_watch("Upscalling")
     else:
         print("No images left to upscale")
+        scheduler.report()
+
+class Pipeline:
+    """
+    Streamed full cycle, images go through bounded queues from stage to stage instead of every stage waiting for the whole one before it
+
+    optimalize base..........images from BASE_DIR are optimalized to OPTIMALIZED_IMGS_DIR_BASE in the process pool
+    duplicates...............batches of optimalized images are compared against the images cleared so far and the library,
+                             the first image of a cluster goes on, across batches the one that came first, the others are held back,
+                             the library and the cleared images are kept in a FingerprintLibrary, so they are only read once
+    upscale..................cleared images are handed to the upscale scheduler whenever it has a free job slot, its jobs run while the other stages go on,
+                             with UPSCALE_TIME_BUDGET they are taken in the order they are cleared and a job not expected to end in time is deferred
+    optimalize upscaled......upscaled images are optimalized to OPTIMALIZED_IMGS_DIR_UPSCALED in the same process pool
+
+    a stage takes more work only while the queue after it holds less than PIPELINE_QUEUE_SIZE images, so a slow stage holds back the ones before it
+    and pool jobs are submitted only while they fit under OPTIMALIZATION_MEMORY_BUDGET
+    when a worker dies the pool is started again and the jobs that were in it run again one at a time, only the image that takes a worker down is reported
+    everything runs from one loop, so the manifest is only used from this thread
+    images are given with add() and streamed by run(), a pipeline can take more images after a run, the library, the cleared images
+    and the leftovers of OPTIMALIZED_IMGS_DIR_BASE and UPSCALED_IMGS_DIR are only read once, counts and the upscale time budget start over
+    """
+
+    STAGES = ["optimalize base", "duplicates", "upscale", "optimalize upscaled"]
+
+    def __init__(self):
+        self.settings = {}
+        self.base_paths = set()
+        self.upscaled_paths = set()
+        self.base_jobs = collections.deque()
+        self.to_dedup = collections.deque()
+        self.to_upscale = collections.deque()
+        self.to_optimalize = collections.deque()
+        # (stage, image, new_path) of jobs that were in the pool when a worker died
+        self.retries = collections.deque()
+        # cleared image -> where it is now, images moved to the library keep being compared
+        self.cleared = {}
+        # (original, [duplicates held back])
+        self.duplicates = []
+        self.fed_upscales = set()
+        self.leftovers_fed = False
+        self.futures = {}
+        # optimalized images that no job of the first images rewrites go straight to duplicate detection, like the whole folder does without streaming
+        self.leftovers = index_directory(OPTIMALIZED_IMGS_DIR_BASE).paths()
+        self.library = FingerprintLibrary(IMAGE_SIMILIARITY_PX_SIZE, IMAGE_SIMILIARITY_MIRROR, IMAGE_SIMILIARITY_CANONICAL, FINGERPRINT_CACHE_DIR, IMAGE_SIMILIARITY_REDUCED_DECODE)
+
+        if DUPLICATES_CHECK_LIBRARY and not DUPLICATES_FIRST:
+            self.library.add(index_directory(OPTIMALIZED_IMGS_DIR_UPSCALED).paths(), FINGERPRINT_CACHE_DIR, None, WORKERS)
+
+    # queues images for the next run, the counts of the report and the upscale time budget start over
+    def add(self, images):
+        self.scheduler = UpscaleScheduler(UPSCALED_IMGS_DIR)
+        self.memory = MemoryBudget()
+        self.errors = {}
+        self.done = {stage: 0 for stage in self.STAGES}
+        self.busy = {stage: 0.0 for stage in self.STAGES}
+        self.in_library_count = 0
+        self.moved_count = 0
+
+        for image in images:
+            new_path, skipped = optimalization_path(image, OPTIMALIZED_IMGS_DIR_BASE, "optimalize base", self.base_paths, self.settings)
+
+            if skipped == None:
+                self.base_jobs.append((image, new_path))
+            elif skipped == "library":
+                self.in_library_count += 1
+
+        if self.leftovers != None:
+            targets = {new_path for image, new_path in self.base_jobs}
+            self.to_dedup.extend(path for path in self.leftovers if path not in targets)
+            self.leftovers = None
+
+    def run(self):
+        self.pool = WorkerPool()
+
+        try:
+            last = time.time()
+
+            while not self.finished():
+                self.submit_jobs()
+                self.start_upscaler()
+
+                if self.dedup_ready():
+                    self.deduplicate()
+
+                if len(self.futures) > 0:
+                    finished, _ = wait(self.futures, timeout=0.05, return_when=FIRST_COMPLETED)
+                else:
+                    finished = []
+                    time.sleep(0.05)
+
+                now = time.time()
+                self.account(now - last)
+                last = now
+
+                for future in finished:
+                    self.job_done(future)
+
+                self.pool.restart(self.futures)
+                self.poll_upscaler()
+                self.show_progress()
+        finally:
+            self.pool.shutdown()
+
+        if MANIFEST != None:
+            MANIFEST.save()
+
+        if UPSCALE_STAGING_DIR.exists():
+            rmtree(UPSCALE_STAGING_DIR)
+
+        self.memory.report()
+        self.show_progress()
+        print("")
+
+    # pool jobs, upscales are optimalized first so finished work leaves the pipeline before new work enters it
+    # the next job waits while it doesn't fit under the memory budget next to the ones in the pool, the order images stream in is kept
+    # jobs of a pool that broke go first, one at a time
+    def submit_jobs(self):
+        while len(self.futures) < WORKERS * 2:
+            running = [job[1] for job in self.futures.values()]
+
+            if len(self.retries) > 0:
+                stage, image, new_path = self.retries[0]
+                estimate = self.memory.estimate(image)
+
+                if not self.memory.fits(estimate) or not self.pool.accepts(image, running):
+                    return
+
+                self.retries.popleft()
+                self.submit(stage, image, new_path, estimate)
+            elif len(self.to_optimalize) > 0:
+                estimate = self.memory.estimate(self.to_optimalize[0])
+
+                if not self.memory.fits(estimate) or not self.pool.accepts(self.to_optimalize[0], running):
+                    return
+
+                image = self.to_optimalize.popleft()
+                new_path, skipped = optimalization_path(image, OPTIMALIZED_IMGS_DIR_UPSCALED, "optimalize upscaled", self.upscaled_paths, self.settings)
+
+                if skipped == None:
+                    self.submit("optimalize upscaled", image, new_path, estimate)
+            elif len(self.base_jobs) > 0 and len(self.to_dedup) + self.in_flight("optimalize base") < PIPELINE_QUEUE_SIZE:
+                image, new_path = self.base_jobs[0]
+                estimate = self.memory.estimate(image)
+
+                if not self.memory.fits(estimate) or not self.pool.accepts(image, running):
+                    return
+
+                self.base_jobs.popleft()
+                self.submit("optimalize base", image, new_path, estimate)
+            else:
+                return
+
+    # a job the broken pool didn't take is run again by the next one
+    def submit(self, stage, image, new_path, estimate):
+        future = self.pool.submit(image, new_path, fingerprint_size(stage))
+
+        if future == None:
+            self.retries.appendleft((stage, image, new_path))
+            return
+
+        self.futures[future] = (stage, image, new_path)
+        self.memory.admit(future, estimate)
+
+    def in_flight(self, stage):
+        return sum(1 for job in self.futures.values() if job[0] == stage) + sum(1 for job in self.retries if job[0] == stage)
+
+    def job_done(self, future):
+        stage, image, new_path = self.futures.pop(future)
+        self.memory.release(future)
+
+        if self.pool.crashed(future, image):
+            self.retries.append((stage, image, new_path))
+            return
+
+        try:
+            error, fingerprint = future.result()
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e)
+
+        if error != None:
+            self.errors[image] = error
+            return
+
+        optimalized(stage, image, self.settings, new_path, fingerprint)
+        self.done[stage] += 1
+
+        if stage == "optimalize base":
+            self.to_dedup.append(new_path)
+
+    # a batch is compared once it's full, once no more images come or once the upscaller would have nothing to do
+    def dedup_ready(self):
+        if len(self.to_dedup) == 0 or len(self.to_upscale) >= PIPELINE_QUEUE_SIZE:
+            return False
+
+        base_done = len(self.base_jobs) == 0 and self.in_flight("optimalize base") == 0
+        upscaler_idle = not self.scheduler.busy() and len(self.to_upscale) == 0
+
+        return len(self.to_dedup) >= PIPELINE_DEDUP_BATCH or base_done or upscaler_idle
+
+    def deduplicate(self):
+        start = time.time()
+        batch = []
+        taken = []
+
+        while len(self.to_dedup) > 0 and len(batch) < PIPELINE_DEDUP_BATCH:
+            path = self.to_dedup.popleft()
+            taken.append(path)
+
+            if not path.exists():
+                continue
+
+            # images already present in upscaled images would be reported as duplicates of themselves
+            if DUPLICATES_CHECK_LIBRARY and in_library(path):
+                os.remove(path)
+                self.in_library_count += 1
+                continue
+
+            batch.append(path)
+
+        held = set()
+
+        # with DUPLICATES_FIRST the originals were searched already
+        if len(batch) > 0 and not DUPLICATES_FIRST:
+            if len(self.library) > 0:
+                clusters = dif.iter_clusters(batch, self.library, fingerprints=FINGERPRINTS, similarity=IMAGE_SIMILIARITY, px_size=IMAGE_SIMILIARITY_PX_SIZE, show_progress=False, cache_dir=FINGERPRINT_CACHE_DIR, index=IMAGE_SIMILIARITY_INDEX, mirror=IMAGE_SIMILIARITY_MIRROR, canonical=IMAGE_SIMILIARITY_CANONICAL, cascade=IMAGE_SIMILIARITY_CASCADE, catalog=CATALOG, reduced_decode=IMAGE_SIMILIARITY_REDUCED_DECODE, library=True)
+            else:
+                clusters = dif.iter_clusters(batch, fingerprints=FINGERPRINTS, similarity=IMAGE_SIMILIARITY, px_size=IMAGE_SIMILIARITY_PX_SIZE, show_progress=False, cache_dir=FINGERPRINT_CACHE_DIR, index=IMAGE_SIMILIARITY_INDEX, mirror=IMAGE_SIMILIARITY_MIRROR, canonical=IMAGE_SIMILIARITY_CANONICAL, cascade=IMAGE_SIMILIARITY_CASCADE, catalog=CATALOG, reduced_decode=IMAGE_SIMILIARITY_REDUCED_DECODE)
+
+            batch_paths = set(batch)
+
+            for cluster in clusters:
+                duplicates = [Path(path) for path in cluster[1:] if Path(path) in batch_paths]
+
+                if len(duplicates) > 0:
+                    self.duplicates.append((Path(cluster[0]), duplicates))
+                    held.update(duplicates)
+
+
+        cleared = [path for path in batch if path not in held]
+
+        for path in cleared:
+            self.cleared[path] = path
+            self.to_upscale.append(path)
+
+        # later batches are compared against the cleared images, the cache or the fingerprints have their matrices
+        if not DUPLICATES_FIRST:
+            self.library.add(cleared, FINGERPRINT_CACHE_DIR, FINGERPRINTS)
+
+        for path in taken:
+            FINGERPRINTS.pop(path, None)
+
+        self.done["duplicates"] += len(batch)
+        self.busy["duplicates"] += time.time() - start
+
+    # the scheduler gets a job of what's cleared so far for every free slot, images that don't need it are sorted out like start_upscalling does
+    def start_upscaler(self):
+        if self.scheduler.free_slots() <= 0 or len(self.to_upscale) == 0 or len(self.to_optimalize) >= PIPELINE_QUEUE_SIZE:
+            return
+
+        pending = []
+
+        while len(self.to_upscale) > 0 and len(pending) < UPSCALE_JOB_SIZE * self.scheduler.free_slots():
+            image = self.to_upscale.popleft()
+
+            if in_library(image):
+                os.remove(image)
+                del self.cleared[image]
+                self.library.remove(image)
+                self.in_library_count += 1
+            elif has_upscale_quality(image):
+                self.cleared[image] = move_to_library(image)
+                self.moved_count += 1
+            else:
+                if MANIFEST != None:
+                    self.settings[image] = chain_settings(image, upscale_settings())
+                    upscaled = MANIFEST.current("upscale", image, self.settings[image])
+
+                    if upscaled != None:
+                        self.fed_upscales.add(upscaled)
+                        self.to_optimalize.append(upscaled)
+                        continue
+
+                pending.append(image)
+
+        self.scheduler.add(pending)
+
+    def poll_upscaler(self):
+        for image, upscaled in self.scheduler.poll():
+            if MANIFEST != None:
+                MANIFEST.record("upscale", image, self.settings[image], upscaled)
+
+            self.fed_upscales.add(upscaled)
+            self.to_optimalize.append(upscaled)
+            self.done["upscale"] += 1
+
+    # finished once every queue is empty, upscales that were in UPSCALED_IMGS_DIR before the first run are optimalized last
+    def finished(self):
+        if len(self.base_jobs) > 0 or len(self.to_dedup) > 0 or len(self.to_upscale) > 0 or len(self.to_optimalize) > 0 or len(self.retries) > 0 or len(self.futures) > 0 or self.scheduler.busy():
+            return False
+
+        if not self.leftovers_fed:
+            self.leftovers_fed = True
+            self.to_optimalize.extend(path for path in index_directory(UPSCALED_IMGS_DIR).paths() if path not in self.fed_upscales)
+            return len(self.to_optimalize) == 0
+
+        return True
+
+    # time a stage had work in flight, the duplicate detection measures its own time
+    def account(self, elapsed):
+        for stage in ("optimalize base", "optimalize upscaled"):
+            if self.in_flight(stage) > 0:
+                self.busy[stage] += elapsed
+
+        if self.scheduler.busy():
+            self.busy["upscale"] += elapsed
+
+    def show_progress(self):
+        print("Streaming images: optimalized [{}] cleared [{}] upscaled [{}] optimalized upscales [{}]".format(self.done["optimalize base"], len(self.cleared), self.done["upscale"], self.done["optimalize upscaled"]), end="\r")
+
+    # held back duplicates are handled like duplicate detection does, the ones that are kept are upscaled by running the pipeline again
+    def handle_duplicates(self):
+        if len(self.duplicates) == 0:
+            return False
+
+        COPY_DUPLICATES = False
+
+        if ALLOW_DUPLICATES:
+            if askYN("Save original vs duplicates to {} ?".format(DUPLICATES_DIR)):
+                COPY_DUPLICATES = True
+
+        print("List of duplicate/similar images (original -> duplicates):\n")
+
+        run_id = datetime.now().strftime("%Y%m%d%H%M%S")
+        held = []
+
+        for number, (original, duplicates) in enumerate(self.duplicates):
+            result = "{}{:06d}".format(run_id, number)
+            original = self.cleared.get(original, original)
+
+            print("{} {}".format(result, original.name))
+
+            if COPY_DUPLICATES and original.exists():
+                stage_file(original, DUPLICATES_DIR.joinpath("{} original{}".format(result, original.suffix)))
+
+            for i in range(0, len(duplicates)):
+                print("\t{} {}".format(result, duplicates[i].name))
+
+                if COPY_DUPLICATES:
+                    stage_file(duplicates[i], DUPLICATES_DIR.joinpath("{} duplicity variation {}{}".format(result, i, original.suffix)))
+
+            held.extend(duplicates)
+
+        self.duplicates = []
+        report_staging()
+
+        if ALLOW_DELETING:
+            if askYN("\nDelete duplicates?"):
+                delete_images(held)
+                return False
+
+        for image in held:
+            self.cleared[image] = image
+            self.to_upscale.append(image)
+
+        if not DUPLICATES_FIRST:
+            self.library.add(held, FINGERPRINT_CACHE_DIR)
+
+        return True
+
+    # removes the file of the library
+    def close(self):
+        self.library.close()
+
+    def report(self):
+        if self.in_library_count > 0:
+            print("Skipped {} image(s) that are already present in upscaled images {}".format(self.in_library_count, OPTIMALIZED_IMGS_DIR_UPSCALED))
+
+        if self.moved_count > 0:
+            print("{} image(s) are of high quality to not be upscaled, they were moved to {}".format(self.moved_count, OPTIMALIZED_IMGS_DIR_UPSCALED))
+
+        self.scheduler.report()
+
+        if len(self.errors) > 0:
+            print("Could not optimalize {} image(s):".format(len(self.errors)))
+
+            for image, error in self.errors.items():
+                print("\t{} [{}]".format(image, error))
+
+        print("Throughput of the stages (images per second of the time the stage had work):")
+
+        for stage in self.STAGES:
+            busy = self.busy[stage]
+            print("\t{}: {} image(s) in {} seconds [{}/s]".format(stage, self.done[stage], round(busy, 3), round(self.done[stage] / busy, 2) if busy > 0 else 0))
+
+class DirectoryWatch:
+    """
+    Notices images in a folder tree that are new or changed, with inotify on Linux and by listing the tree every WATCH_POLL_INTERVAL seconds elsewhere
+
+    directory................root of the tree, sub-folders are watched with USE_RECURSION, only files with EXTENSIONS count
+    changed..................image -> time it last changed, it's ready once it didn't change for WATCH_DEBOUNCE seconds
+    seen.....................image -> (size, mtime) it had when it was listed or taken last
+    folders..................inotify watch descriptor -> folder, None when polling
+
+    folders created in the tree are watched as they appear and the images already in them count as new,
+    when the kernel drops events the tree is listed and compared like polling does, when a folder can't be watched it falls back to polling
+    """
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    # wd, mask, cookie, length of the name that follows
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.changed = {}
+        self.folders = None
+        self.fd = None
+        self.polled = time.time()
+
+        if LIBC != None:
+            LIBC.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            fd = LIBC.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+
+            if fd >= 0:
+                self.fd = fd
+                self.folders = {}
+                self.watch_tree(self.directory, False)
+
+        self.seen = {image: signature for image, signature in self.listing()}
+
+    def listing(self):
+        return [(Path(path), (size, mtime)) for path, size, mtime in DirectoryIndex(self.directory, EXTENSIONS, USE_RECURSION, None, WORKERS).refresh().entries()]
+
+    # watches a folder and with USE_RECURSION its sub-folders, images in a new folder count as changed
+    def watch_tree(self, folder, new):
+        for root, dirs, files in os.walk(folder):
+            wd = LIBC.inotify_add_watch(self.fd, os.fsencode(root), self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+
+            if wd < 0:
+                print("Could not watch {} ({}), listing {} every {} seconds instead".format(root, os.strerror(ctypes.get_errno()), self.directory, WATCH_POLL_INTERVAL))
+                self.close()
+                return
+
+            self.folders[wd] = root
+
+            if new:
+                for name in files:
+                    self.change(os.path.join(root, name))
+
+            if not USE_RECURSION:
+                return
+
+    def change(self, path):
+        if os.path.splitext(path)[1].lower() in EXTENSIONS:
+            self.changed[Path(path)] = time.time()
+
+    # waits up to timeout seconds for changes
+    def wait(self, timeout):
+        if self.fd == None:
+            time.sleep(timeout)
+
+            if time.time() - self.polled >= WATCH_POLL_INTERVAL:
+                self.compare()
+
+            return
+
+        if len(select.select([self.fd], [], [], timeout)[0]) > 0:
+            self.read_events()
+
+    def read_events(self):
+        while self.fd != None:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+
+            offset = 0
+
+            # a folder that couldn't be watched turned it to polling, which lists the rest
+            while offset < len(data) and self.fd != None:
+                wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b"\0"))
+                offset += self.EVENT.size + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    self.compare()
+                elif mask & self.IN_IGNORED:
+                    self.folders.pop(wd, None)
+                elif wd in self.folders:
+                    path = os.path.join(self.folders[wd], name)
+
+                    if not mask & self.IN_ISDIR:
+                        self.change(path)
+                    elif USE_RECURSION and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        self.watch_tree(path, True)
+
+    # lists the tree, images whose size or mtime is not the one seen last count as changed
+    def compare(self):
+        self.polled = time.time()
+
+        for image, signature in self.listing():
+            if self.seen.get(image) != signature:
+                self.seen[image] = signature
+                self.changed[image] = self.polled
+
+    # images that didn't change for WATCH_DEBOUNCE seconds in the order they first changed, at most WATCH_BATCH_SIZE
+    def ready(self):
+        now = time.time()
+        images = []
+
+        for image, changed in list(self.changed.items()):
+            if len(images) >= WATCH_BATCH_SIZE:
+                break
+
+            if now - changed < WATCH_DEBOUNCE:
+                continue
+
+            del self.changed[image]
+
+            try:
+                stat = os.stat(image)
+            except OSError:
+                continue
+
+            self.seen[image] = (stat.st_size, stat.st_mtime_ns)
+            images.append(image)
+
+        return images
+
+    def close(self):
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
+            self.folders = None
 
 def is_dir_empty(DIR):
     try:
@@ -332,9 +2061,10 @@ def menu():
     print("3. Duplicate detection")
     print("4. Upscale images")
     print("5. Optimalize upscaled images")
-    print("6. Exit")
+    print("6. Watch base directory [new images through 2-5]")
+    print("7. Exit")
 
-    selected = inputFromChoices("\nSelect from menu: ", ["0", "1", "2", "3", "4", "5", "6"])
+    selected = inputFromChoices("\nSelect from menu: ", ["0", "1", "2", "3", "4", "5", "6", "7"])
 
     if selected == "0": change_base_dir()
     if selected == "1": full_cycle()
@@ -342,7 +2072,8 @@ def menu():
     if selected == "3": find_duplicates()
     if selected == "4": upscale_images()
     if selected == "5": optimalize_upscaled_images()
-    if selected == "6": exit()
+    if selected == "6": watch_base_dir()
+    if selected == "7": exit()
 
     menu()
 
@@ -360,16 +2091,101 @@ def change_base_dir():
     change_base_dir()
 
 def full_cycle():
-    optimalize_base_images()
-    find_duplicates()
+    if PIPELINE_STREAMING:
+        streaming_cycle()
+        return
+
+    if DUPLICATES_FIRST:
+        print("\nIndexing base images\n")
+        index_images(BASE_DIR)
+        print("\nDetecting duplicates in base images\n")
+        skip_duplicate_originals()
+        print("\nOptimalize images\n")
+        optimalize_images(OPTIMALIZED_IMGS_DIR_BASE, "optimalize base")
+    else:
+        optimalize_base_images()
+        find_duplicates()
+
     upscale_images()
     optimalize_upscaled_images()
 
+def streaming_cycle(pipeline=None):
+    print("\nIndexing base images\n")
+    index_images(BASE_DIR)
+    stream_images(pipeline)
+
+# streams IMAGES through the stages with the pipeline, a pipeline that is given is kept for more images, a new one is closed
+def stream_images(pipeline=None):
+    if DUPLICATES_FIRST:
+        print("\nDetecting duplicates in base images\n")
+        skip_duplicate_originals()
+
+    print("\nStreaming images through optimalization, duplicate detection, upscaling and optimalization of upscales\n")
+    start_watch()
+
+    new = pipeline == None
+
+    if new:
+        pipeline = Pipeline()
+
+    try:
+        pipeline.add(IMAGES)
+        pipeline.run()
+
+        if pipeline.handle_duplicates():
+            pipeline.run()
+
+        pipeline.report()
+    finally:
+        if new:
+            pipeline.close()
+
+    FINGERPRINTS.clear()
+    end_watch("Streaming full cycle")
+
+# images that are new or changed in BASE_DIR are streamed through the stages in small batches until Ctrl+C
+# with the manifest the images that came in while nobody watched are taken first, already done work is skipped
+# one pipeline takes all batches, so the library and the leftovers of the stages are only read once
+def watch_base_dir():
+    global IMAGES, WATCHING
+
+    watch = DirectoryWatch(BASE_DIR)
+    print("\nWatching {} {}, Ctrl+C to stop\n".format(BASE_DIR, "with inotify" if watch.fd != None else "every {} seconds".format(WATCH_POLL_INTERVAL)))
+    WATCHING = True
+    pipeline = None
+
+    try:
+        pipeline = Pipeline()
+
+        if MANIFEST != None:
+            streaming_cycle(pipeline)
+
+        while True:
+            watch.wait(0.5)
+            IMAGES = watch.ready()
+
+            if len(IMAGES) == 0:
+                continue
+
+            print("\n{} new or changed image(s) in {}\n".format(len(IMAGES), BASE_DIR))
+            stream_images(pipeline)
+
+            if CATALOG != None:
+                CATALOG.save()
+    except KeyboardInterrupt:
+        print("\nStopped watching {}".format(BASE_DIR))
+    finally:
+        WATCHING = False
+        watch.close()
+
+        if pipeline != None:
+            pipeline.close()
+
 def optimalize_base_images():
     print("\nIndexing base images\n")
     index_images(BASE_DIR)
     print("\nOptimalize images\n")
-    optimalize_images(OPTIMALIZED_IMGS_DIR_BASE)
+    optimalize_images(OPTIMALIZED_IMGS_DIR_BASE, "optimalize base")
 
 def find_duplicates():
     print("\nDetecting duplicates\n")
@@ -385,9 +2201,18 @@ def optimalize_upscaled_images():
     print("\nIndexing upscaled images\n")
     index_images(UPSCALED_IMGS_DIR)
     print("\nOptimalizing upscaled images\n")
-    optimalize_images(OPTIMALIZED_IMGS_DIR_UPSCALED)
+    optimalize_images(OPTIMALIZED_IMGS_DIR_UPSCALED, "optimalize upscaled")
 
 def exit():
+    if MANIFEST != None:
+        MANIFEST.close()
+
+    if UPSCALE_COSTS != None:
+        UPSCALE_COSTS.close()
+
+    if CATALOG != None:
+        CATALOG.close()
+
     if DELETE_DIRS_AFTER_EXIT:
         print("\nCleanup\n")
 
@@ -0,0 +1,99 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from DifPy import dif
+
+
+# smooth random picture with values kept away from 0 and 255, so brightness offsets are not clipped
+def smooth_image(seed, width=160, height=120):
+    rng = np.random.default_rng(seed)
+    small = rng.integers(60, 190, size=(6, 8, 3)).astype(np.uint8)
+    return np.asarray(Image.fromarray(small).resize((width, height), Image.BICUBIC)).clip(50, 200).astype(np.uint8)
+
+
+def save(path, pixels, **params):
+    Image.fromarray(pixels).save(path, **params)
+    return Path(path)
+
+
+# folder of generated images: distinct pictures and variants of them at known distances
+# offsets of d in every channel give a mse of about d * d, so the variants fall between the similarity grades
+def make_corpus(folder, pictures=6, seed=0):
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for number in range(pictures):
+        pixels = smooth_image(seed * 100 + number)
+        paths.append(save(folder / "p{}.png".format(number), pixels))
+        if number % 3 == 0:
+            paths.append(save(folder / "p{}_resaved.png".format(number), pixels, pnginfo=text_chunk("resaved")))
+        if number % 3 == 1:
+            paths.append(save(folder / "p{}_jpeg.jpg".format(number), pixels, quality=92))
+        paths.append(save(folder / "p{}_rotated.png".format(number), np.ascontiguousarray(np.rot90(pixels, k=number % 3 + 1))))
+        paths.append(save(folder / "p{}_mirrored.png".format(number), np.ascontiguousarray(pixels[:, ::-1])))
+        for offset in (3, 12, 25, 40):
+            paths.append(save(folder / "p{}_offset{}.png".format(number, offset), (pixels.astype(np.int16) + offset).clip(0, 255).astype(np.uint8)))
+    return paths
+
+
+def text_chunk(text):
+    from PIL import PngImagePlugin
+    info = PngImagePlugin.PngInfo()
+    info.add_text("comment", text)
+    return info
+
+
+# pairs found by the search of the original difPy: every image against every later one in the order of the files,
+# compared in the 4 rotations, with mirror also mirrored, one by one with dif._mse, the first transform that matches counts
+def baseline_pairs(files_A, files_B, ref, same_dir, px_size=50, mirror=False):
+    matrices_A = [(path, dif._create_img_matrix(path, px_size)) for path in files_A]
+    matrices_A = [(path, img) for path, img in matrices_A if img is not None]
+    if same_dir:
+        matrices_B = matrices_A
+    else:
+        matrices_B = [(path, dif._create_img_matrix(path, px_size)) for path in files_B]
+        matrices_B = [(path, img) for path, img in matrices_B if img is not None]
+    pairs = {}
+    for count_A, (path_A, img_A) in enumerate(matrices_A):
+        for count_B, (path_B, img_B) in enumerate(matrices_B):
+            if same_dir and count_B <= count_A:
+                continue
+            for transform in dif._transforms(mirror):
+                err = dif._mse(img_A, dif._transform(img_B, transform))
+                if err < ref:
+                    pairs[(str(path_A), str(path_B))] = err
+                    break
+    return pairs
+
+
+# pairs of a dif result as {(location, duplicate): mse}
+def result_pairs(result):
+    pairs = {}
+    for entry in result.values():
+        for path, err in zip(entry["duplicates"]["paths"], entry["duplicates"]["diffs"]):
+            pairs[(entry["location"], path)] = err
+    return pairs
+
+
+# files of a folder in the order dif lists them
+def listed(folder):
+    return [str(Path(path) / name) for path, name in dif._list_files(Path(folder))]
+
+
+@pytest.fixture(scope="session")
+def corpus(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("corpus")
+    make_corpus(folder)
+    return folder
+
+
+@pytest.fixture(autouse=True)
+def run_in_tmp(tmp_path, monkeypatch):
+    # the CLI and some helpers write result files to the working directory
+    monkeypatch.chdir(tmp_path)
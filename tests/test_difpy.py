@@ -0,0 +1,396 @@
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import DifPy
+from DifPy import dif, DirectoryIndex, ImageCatalog
+from conftest import text_chunk, baseline_pairs, listed, make_corpus, result_pairs, save, smooth_image
+
+GRADES = ["low", "normal", "high", 300]
+
+# engines that have to find exactly the pairs of the original search
+ENGINES = {
+    "vectorized": {},
+    "cascade": {"cascade": True},
+    "parallel": {"workers": 2},
+    "parallel cascade": {"workers": 2, "cascade": True},
+    "index with every distance": {"index": 64},
+}
+
+
+@pytest.fixture
+def small_tiles(monkeypatch):
+    # a few images per block, so the search is split into many tiles and row blocks
+    monkeypatch.setattr(DifPy, "BLOCK_BYTES", 50 * 50 * 3 * 4 * 5)
+
+
+@pytest.fixture(scope="module")
+def split_corpus(tmp_path_factory):
+    root = tmp_path_factory.mktemp("split")
+    corpus = make_corpus(root / "all", pictures=4, seed=1)
+    new, library = root / "new", root / "library"
+    new.mkdir()
+    library.mkdir()
+    for path in corpus:
+        target = new if "offset" in path.name or "rotated" in path.name else library
+        shutil.copy(path, target / path.name)
+    return new, library
+
+
+def assert_same_pairs(found, expected):
+    assert found.keys() == expected.keys()
+    for pair, err in expected.items():
+        assert found[pair] == pytest.approx(err)
+
+
+@pytest.mark.parametrize("similarity", GRADES)
+@pytest.mark.parametrize("engine", ENGINES)
+def test_one_dir_matches_baseline(corpus, small_tiles, similarity, engine):
+    search = dif(str(corpus), similarity=similarity, show_progress=False, **ENGINES[engine])
+    expected = baseline_pairs(listed(corpus), None, dif._map_similarity(similarity), True)
+    assert len(expected) > 0
+    assert_same_pairs(result_pairs(search.result), expected)
+
+    # the bigger file of every pair is kept
+    lower = {min(pair, key=lambda path: (os.path.getsize(path), path == pair[0])) for pair in expected}
+    assert set(search.lower_quality) == lower
+
+
+@pytest.mark.parametrize("similarity", GRADES)
+@pytest.mark.parametrize("cascade", [False, True])
+def test_mirror_matches_baseline_with_mirrored_transforms(corpus, similarity, cascade):
+    search = dif(str(corpus), similarity=similarity, show_progress=False, mirror=True, cascade=cascade)
+    expected = baseline_pairs(listed(corpus), None, dif._map_similarity(similarity), True, mirror=True)
+    assert_same_pairs(result_pairs(search.result), expected)
+
+
+@pytest.mark.parametrize("options", [{"index": True}, {"canonical": True}, {"canonical": True, "cascade": True}])
+def test_approximate_engines_find_a_subset_of_the_baseline(corpus, options):
+    search = dif(str(corpus), similarity="low", show_progress=False, **options)
+    expected = baseline_pairs(listed(corpus), None, 1000, True)
+    found = result_pairs(search.result)
+    assert len(found) > 0
+    assert set(found) <= set(expected)
+
+
+@pytest.mark.parametrize("similarity", GRADES)
+@pytest.mark.parametrize("engine", ["vectorized", "parallel"])
+def test_two_dirs_match_baseline(split_corpus, small_tiles, similarity, engine):
+    new, library = split_corpus
+    search = dif(str(new), str(library), similarity=similarity, show_progress=False, **ENGINES[engine])
+    expected = baseline_pairs(listed(new), listed(library), dif._map_similarity(similarity), False)
+    assert_same_pairs(result_pairs(search.result), expected)
+
+
+@pytest.mark.parametrize("similarity", GRADES)
+@pytest.mark.parametrize("engine", ["vectorized", "cascade", "parallel"])
+def test_library_mode_matches_baseline_and_keeps_the_library(split_corpus, small_tiles, tmp_path, similarity, engine):
+    new, library = split_corpus
+    ref = dif._map_similarity(similarity)
+    expected = baseline_pairs(listed(new), listed(library), ref, False)
+    expected.update(baseline_pairs(listed(new), None, ref, True))
+
+    for cache_dir in (None, tmp_path / "cache", tmp_path / "cache"):
+        search = dif(str(new), str(library), similarity=similarity, show_progress=False, library=True, cache_dir=cache_dir, **ENGINES[engine])
+        assert_same_pairs(result_pairs(search.result), expected)
+        assert not any(path.startswith(str(library)) for path in search.lower_quality)
+        # a new image like a library image is always the lower quality one
+        assert {pair[0] for pair in expected if pair[1].startswith(str(library))} <= set(search.lower_quality)
+
+
+def test_exact_copies_are_collapsed_and_decoded_once(tmp_path, monkeypatch):
+    folder = tmp_path / "copies"
+    folder.mkdir()
+    original = save(folder / "a.png", smooth_image(1))
+    save(folder / "b.png", smooth_image(2))
+    for name in ("a_copy.png", "z_copy.png"):
+        shutil.copy(original, folder / name)
+
+    decoded = []
+    create_img_matrix = dif._create_img_matrix
+    monkeypatch.setattr(dif, "_create_img_matrix", lambda path, px_size, reduced_decode: decoded.append(Path(path).name) or create_img_matrix(path, px_size, reduced_decode))
+
+    search = dif(str(folder), show_progress=False)
+    pairs = result_pairs(search.result)
+    first = str(folder / min(("a.png", "a_copy.png", "z_copy.png"), key=lambda name: listed(folder).index(str(folder / name))))
+    copies = {str(folder / name) for name in ("a.png", "a_copy.png", "z_copy.png")} - {first}
+    assert pairs == {(first, copy): 0.0 for copy in copies}
+    assert sorted(decoded) == sorted(["b.png", Path(first).name])
+    assert search.stats["total_files_searched"] == 4
+
+
+def test_iter_clusters_are_the_connected_pairs(corpus):
+    expected = baseline_pairs(listed(corpus), None, 200, True)
+    groups = {}
+    for path_A, path_B in expected:
+        group = groups.get(path_A, {path_A}) | groups.get(path_B, {path_B})
+        for path in group:
+            groups[path] = group
+
+    clusters = list(dif.iter_clusters(str(corpus), show_progress=False))
+    assert sorted(sorted(cluster) for cluster in clusters) == sorted(sorted(group) for group in {id(group): group for group in groups.values()}.values())
+    for cluster in clusters:
+        assert os.path.getsize(cluster[0]) == max(os.path.getsize(path) for path in cluster)
+
+
+def test_iter_clusters_put_the_library_image_first(split_corpus):
+    new, library = split_corpus
+    clusters = list(dif.iter_clusters(str(new), str(library), similarity="low", show_progress=False, library=True))
+    assert len(clusters) > 0
+    for cluster in clusters:
+        if any(path.startswith(str(library)) for path in cluster):
+            assert cluster[0].startswith(str(library))
+        assert all(path.startswith(str(new)) for path in cluster[1:] if not path.startswith(str(library)))
+
+
+def test_union_find_keeps_one_heap_entry_per_closing_index():
+    clusters = DifPy.UnionFind()
+    # matches that don't move the closing index of the set push nothing
+    for count in range(1, 1000):
+        clusters.union(("A", 0), ("A", count), 5)
+    assert len(clusters.heap) == 1
+    # a set that keeps growing leaves outdated entries, they are dropped before they pile up
+    for count in range(1000, 2000):
+        clusters.union(("A", count - 1), ("A", count), count)
+    assert len(clusters.heap) <= 2 * len(clusters.members) + 64
+    assert clusters.pop_closed(1999) == []
+    assert [len(members) for members in clusters.pop_closed(2000)] == [2000]
+    assert clusters.heap == [] and clusters.parent == {}
+
+
+def test_path_table_keeps_the_files_in_order(corpus):
+    folder_files = dif._list_files(corpus) + [(corpus / "sub", "nested.png"), (corpus, "last.jpg")]
+    table = DifPy.PathTable(folder_files)
+    assert len(table) == len(folder_files)
+    assert list(table) == folder_files
+    table.append((corpus, "appended.png"))
+    assert table[-1] == (corpus, "appended.png")
+    assert len(table.folders) == 2
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_missing_and_non_image_files_are_skipped(corpus, tmp_path, cached):
+    folder = tmp_path / "mixed"
+    folder.mkdir()
+    images = sorted(corpus.glob("p0*.png"))[:4]
+    for path in images:
+        shutil.copy(path, folder / path.name)
+    (folder / "notes.txt").write_text("not an image")
+    (folder / "empty.jpg").write_bytes(b"")
+    (folder / "corrupt.jpg").write_bytes(os.urandom(2000))
+    (folder / "sub").mkdir()
+    # same pixels but other bytes, so it is not collapsed as an exact copy
+    save(folder / "sub" / "nested.png", np.asarray(Image.open(images[0])), pnginfo=text_chunk("nested"))
+    os.symlink(tmp_path / "nowhere.png", folder / "broken.png")
+
+    expected = baseline_pairs(listed(folder), None, 1000, True)
+    assert len(expected) > 0
+    cache_dir = tmp_path / "cache" if cached else None
+    for directory in (str(folder), DirectoryIndex(folder, [".png", ".jpg", ".txt"])):
+        # the second run takes the matrices from the cache
+        for run in range(2):
+            search = dif(directory, similarity="low", show_progress=False, cache_dir=cache_dir)
+            assert_same_pairs(result_pairs(search.result), expected)
+
+
+def test_files_removed_after_indexing_are_skipped(corpus, tmp_path):
+    folder = tmp_path / "stale"
+    shutil.copytree(corpus, folder)
+    index = DirectoryIndex(folder, [".png", ".jpg"]).refresh()
+    removed = sorted(folder.glob("p1*"))
+    for path in removed:
+        os.remove(path)
+
+    search = dif(index, similarity="low", show_progress=False, cache_dir=tmp_path / "cache")
+    assert not any(Path(path) in removed for pair in result_pairs(search.result) for path in pair)
+
+
+def test_directory_index_reuses_the_snapshot_until_a_folder_changes(tmp_path, monkeypatch):
+    folder = tmp_path / "indexed"
+    (folder / "sub").mkdir(parents=True)
+    for name in ("a.png", "b.JPG", "sub/c.png"):
+        save(folder / name, smooth_image(1))
+    (folder / "notes.txt").write_text("not an image")
+    snapshot = tmp_path / "index.pickle"
+
+    # folders modified an hour ago are not racy, so their listings are kept
+    def settle():
+        for path in (folder, folder / "sub"):
+            os.utime(path, ns=(time.time_ns() - 3600 * 10 ** 9,) * 2)
+
+    listed_folders = []
+    scandir = os.scandir
+    monkeypatch.setattr(DifPy.os, "scandir", lambda path: listed_folders.append(Path(path).name) or scandir(path))
+
+    def index(**options):
+        del listed_folders[:]
+        return sorted(path.relative_to(folder).as_posix() for path in DirectoryIndex(folder, [".png", ".jpg"], snapshot=snapshot, **options).refresh().paths())
+
+    settle()
+    assert index() == ["a.png", "b.JPG", "sub/c.png"]
+    assert sorted(listed_folders) == ["indexed", "sub"]
+    assert index() == ["a.png", "b.JPG", "sub/c.png"]
+    assert listed_folders == []
+
+    # a new file changes the mtime of its folder, only that folder is listed again
+    save(folder / "sub" / "d.png", smooth_image(2))
+    assert index() == ["a.png", "b.JPG", "sub/c.png", "sub/d.png"]
+    assert listed_folders == ["sub"]
+    # touched folders are listed again
+    settle()
+    assert index() == ["a.png", "b.JPG", "sub/c.png", "sub/d.png"]
+    assert listed_folders == ["indexed", "sub"]
+    assert index() == ["a.png", "b.JPG", "sub/c.png", "sub/d.png"]
+    assert listed_folders == []
+
+    # a snapshot of other settings is not used
+    assert index(recursive=False) == ["a.png", "b.JPG"]
+    assert listed_folders == ["indexed"]
+
+
+def test_cache_and_fingerprints_give_the_same_result(corpus, tmp_path, monkeypatch):
+    monkeypatch.setattr(DifPy.tempfile, "tempdir", str(tmp_path))
+    expected = result_pairs(dif(str(corpus), similarity="low", show_progress=False).result)
+    # the second run takes the matrices from the cache
+    for run in range(2):
+        assert result_pairs(dif(str(corpus), similarity="low", show_progress=False, cache_dir=tmp_path / "cache").result) == expected
+    # the stores of the matrices are removed after the search
+    assert [name for name in os.listdir(tmp_path) if name.startswith("difpy_")] == []
+    assert [name for name in os.listdir(tmp_path / "cache") if name.startswith("difpy_")] == []
+
+    fingerprints = {path: dif.fingerprint(path.read_bytes()) for path in corpus.glob("*.png")}
+    assert result_pairs(dif(str(corpus), similarity="low", show_progress=False, fingerprints=fingerprints).result) == expected
+
+
+def test_reduced_decode_is_opt_in_and_cached_apart(tmp_path):
+    folder = tmp_path / "photos"
+    folder.mkdir()
+    pixels = smooth_image(5, 1600, 1200)
+    photo = save(folder / "photo.jpg", pixels, quality=90)
+    save(folder / "copy.png", pixels)
+    full = dif._create_img_matrix(photo, 50)
+    reduced = dif.fingerprint(photo.read_bytes(), reduced_decode=True)
+
+    # by default a big JPEG is fully decoded like the original difPy does, reduced it drifts by a few MSE
+    assert (dif.fingerprint(photo.read_bytes()) == full).all()
+    assert not (reduced == full).all()
+    assert dif._mse(reduced, full) < 14
+
+    expected = baseline_pairs(listed(folder), None, 200, True)
+    for run in range(2):
+        for reduced_decode in (False, True):
+            pairs = result_pairs(dif(str(folder), show_progress=False, cache_dir=tmp_path / "cache", reduced_decode=reduced_decode).result)
+            assert pairs.keys() == expected.keys()
+            # the matrices of both decodes are cached apart, so neither run takes the other one's
+            assert (pairs == expected) != reduced_decode
+    assert sorted(name for name in os.listdir(tmp_path / "cache") if name.endswith(".db")) == ["fingerprints.db", "fingerprints_reduced.db"]
+
+
+def test_catalog_keeps_the_higher_resolution(tmp_path):
+    folder = tmp_path / "resolution"
+    folder.mkdir()
+    pixels = smooth_image(3, 320, 240)
+    small = save(folder / "small.png", pixels[::2, ::2])
+    # the big one is a well compressed JPEG, smaller on disk than the PNG
+    big = save(folder / "big.jpg", pixels, quality=60)
+    assert os.path.getsize(big) < os.path.getsize(small)
+
+    assert dif(str(folder), similarity="low", show_progress=False).lower_quality == [str(big)]
+    catalog = ImageCatalog(tmp_path / "catalog.db")
+    assert dif(str(folder), similarity="low", show_progress=False, catalog=catalog).lower_quality == [str(small)]
+    catalog.close()
+
+
+# qualities from 25 up are estimated to within rounding, below it the tables clamped to 255 give a higher estimate
+@pytest.mark.parametrize("quality", [1, 5, 10, 25, 50, 70, 75, 90, 95, 100])
+def test_catalog_estimates_the_jpeg_quality(tmp_path, quality):
+    path = save(tmp_path / "q.jpg", smooth_image(1), quality=quality)
+    with Image.open(path) as image:
+        estimate = ImageCatalog.jpeg_quality(image.quantization)
+        assert ImageCatalog.describe(image).quality == estimate
+    if quality >= 25:
+        assert estimate == pytest.approx(quality, abs=1)
+    else:
+        assert quality < estimate < 25
+    assert ImageCatalog.jpeg_quality(None) == None and ImageCatalog.jpeg_quality({}) == None
+
+
+# pairs whose exact mse is one squared difference under ref and at ref, the float32 search must not reject the first ones
+@pytest.mark.parametrize("cascade", [False, True])
+def test_pairs_at_the_threshold(cascade):
+    rng = np.random.default_rng(7)
+    ref = 200
+    deltas = [100] * 49 + [99, 14, 1, 1]
+    assert sum(delta * delta for delta in deltas) == ref * 50 * 50 - 1
+
+    images_A, images_B = [], []
+    for number in range(40):
+        img = rng.integers(0, 156, size=(50, 50, 3)).astype(np.uint8)
+        near = img.copy().reshape(-1)
+        spots = rng.choice(near.size, len(deltas) + 1, replace=False)
+        near[spots[:-1]] += np.array(deltas, dtype=np.uint8)
+        if number % 2 == 1:
+            # one more unit of squared difference makes it exactly ref
+            near[spots[-1]] += 1
+        images_A.append(img)
+        images_B.append(np.rot90(near.reshape(img.shape), k=number % 4))
+
+    matches = {(count_A, count_B): err for count_A, count_B, transform, err in dif._find_matches(np.stack(images_A), np.stack(images_B), ref, False, cascade=cascade)}
+    assert matches == {(number, number): pytest.approx(ref - 1 / 2500) for number in range(0, 40, 2)}
+
+
+# with a cache the library is compared straight from the cache's data file, only the new images get a store
+def test_library_is_compared_from_the_cache(split_corpus, tmp_path, monkeypatch):
+    new, library = split_corpus
+    stores = []
+    store = DifPy.FingerprintStore
+    monkeypatch.setattr(DifPy, "FingerprintStore", lambda store_dir, capacity, px_size: stores.append(capacity) or store(store_dir, capacity, px_size))
+
+    expected = result_pairs(dif(str(new), str(library), similarity="low", show_progress=False, library=True).result)
+    assert stores == [len(listed(new)), len(listed(library))]
+    for workers in (1, 2):
+        stores.clear()
+        search = dif(str(new), str(library), similarity="low", show_progress=False, library=True, cache_dir=tmp_path, workers=workers)
+        assert result_pairs(search.result) == expected
+        assert stores == [len(listed(new))]
+        clusters = list(dif.iter_clusters(str(new), str(library), similarity="low", show_progress=False, library=True, cache_dir=tmp_path, workers=workers))
+        assert len(clusters) > 0
+    assert sorted(os.listdir(tmp_path)) == ["fingerprints.db", "fingerprints_50.bin"]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_fingerprint_library_grows_and_forgets(split_corpus, small_tiles, tmp_path, workers):
+    new, library = split_corpus
+    library_files = listed(library)
+    expected = result_pairs(dif(str(new), library_files, similarity="low", show_progress=False, library=True).result)
+
+    fingerprint_library = DifPy.FingerprintLibrary(50, store_dir=tmp_path)
+    # added a few at a time, so the file grows, with a cache the second half is read from it
+    for start in range(0, len(library_files), 5):
+        fingerprint_library.add(library_files[start:start + 5] + [str(library / "missing.png")], tmp_path / "cache" if start > len(library_files) // 2 else None)
+    fingerprint_library.add(library_files)
+    assert len(fingerprint_library) == len(library_files)
+
+    search = dif(str(new), fingerprint_library, similarity="low", show_progress=False, library=True, workers=workers)
+    assert result_pairs(search.result) == expected
+    clusters = list(dif.iter_clusters(str(new), fingerprint_library, similarity="low", show_progress=False, library=True, workers=workers))
+    assert {path for cluster in clusters for path in cluster} & set(library_files) == {path_B for path_A, path_B in expected if path_B in library_files}
+
+    removed = {path_B for path_A, path_B in expected if path_B in library_files}
+    assert len(removed) > 0
+    for path in removed:
+        fingerprint_library.remove(path)
+    search = dif(str(new), fingerprint_library, similarity="low", show_progress=False, library=True, workers=workers)
+    assert result_pairs(search.result) == {pair: err for pair, err in expected.items() if pair[1] not in removed}
+
+    with pytest.raises(ValueError):
+        dif(str(new), fingerprint_library, show_progress=False)
+    with pytest.raises(ValueError):
+        dif(str(new), fingerprint_library, show_progress=False, library=True, canonical=True)
+    fingerprint_library.close()
+    assert [name for name in os.listdir(tmp_path) if name != "cache"] == []
@@ -0,0 +1,587 @@
+import multiprocessing
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import HenPy
+from DifPy import dif
+from conftest import make_corpus, save, smooth_image, text_chunk
+
+
+@pytest.fixture
+def henpy(tmp_path, monkeypatch):
+    root = tmp_path / "Images"
+    settings = {
+        "BASE_DIR": root / "Base",
+        "OPTIMALIZED_IMGS_DIR_BASE": root / "OptimalizedBase",
+        "OPTIMALIZED_IMGS_DIR_UPSCALED": root / "BaseUpscaledOptimalized",
+        "UPSCALED_IMGS_DIR": root / "Upscaled",
+        "DUPLICATES_DIR": root / "Duplicates",
+        "FINGERPRINT_CACHE_DIR": root / "Cache",
+        "INDEX_SNAPSHOT_DIR": root / "Cache",
+        "IMAGE_CATALOG_PATH": root / "Cache" / "catalog.db",
+        "MANIFEST_PATH": root / "manifest.db",
+        "UPSCALE_COSTS_PATH": root / "upscale_costs.db",
+        "UPSCALE_STAGING_DIR": root / "UpscaleStaging",
+        "UPSCALE_BACKEND": "lanczos",
+        "UPSCALE_SIZE": 2,
+        "WORKERS": 2,
+        "WATCH_DEBOUNCE": 0,
+        "WATCH_POLL_INTERVAL": 0,
+        "IMAGES": [],
+        "MANIFEST": None,
+        "UPSCALE_COSTS": None,
+        "CATALOG": None,
+        "WATCHING": False,
+    }
+    for name, value in settings.items():
+        monkeypatch.setattr(HenPy, name, value)
+    monkeypatch.setattr(HenPy, "FINGERPRINTS", {})
+    monkeypatch.setattr(HenPy, "askYN", lambda message: True)
+    os.makedirs(HenPy.BASE_DIR)
+    yield HenPy
+    close()
+
+
+# what exit() closes, without deleting the folders and leaving
+def close():
+    for name in ("MANIFEST", "UPSCALE_COSTS", "CATALOG"):
+        if getattr(HenPy, name) != None:
+            getattr(HenPy, name).close()
+            setattr(HenPy, name, None)
+
+
+def base_corpus(pictures=3):
+    paths = make_corpus(HenPy.BASE_DIR, pictures=pictures, seed=2)
+    # only pictures and clear duplicates of them, the further offsets are neither
+    for path in paths:
+        if path.stem.endswith(("_offset12", "_offset25", "_offset40")):
+            os.remove(path)
+    return [path for path in paths if path.exists()]
+
+
+def library():
+    return sorted(HenPy.OPTIMALIZED_IMGS_DIR_UPSCALED.iterdir())
+
+
+# pictures in the library, which image of a cluster gets there depends on the order the images are done in
+def library_pictures():
+    return sorted(path.stem.split("_")[0] + ("_mirrored" if "mirrored" in path.stem else "") for path in library())
+
+
+def raise_os_error(*args):
+    raise OSError("not supported")
+
+
+# the first steps of reflink, hardlink and copy_file_range fail, the next one is taken and the staged file has the content
+@pytest.mark.parametrize("failing, way", [(0, "reflink"), (1, "hardlink"), (2, "copy_file_range"), (3, "copy")])
+def test_stage_file_falls_back_step_by_step(tmp_path, monkeypatch, failing, way):
+    if HenPy.fcntl == None or not hasattr(os, "copy_file_range"):
+        pytest.skip("reflink and copy_file_range are only on Linux")
+
+    # reflink is faked by copying, most file systems of tests can't clone
+    def clone(target_fd, request, source_fd):
+        assert request == HenPy.FICLONE
+        os.write(target_fd, os.read(source_fd, 1 << 20))
+
+    source = tmp_path / "source.bin"
+    source.write_bytes(os.urandom(100000))
+    # the target is an old hardlink of another file, which has to stay as it is
+    other = tmp_path / "other.bin"
+    other.write_bytes(b"other")
+    target = tmp_path / "staged.bin"
+    os.link(other, target)
+
+    steps = [(HenPy.fcntl, "ioctl", clone), (HenPy.os, "link", None), (HenPy.os, "copy_file_range", None)]
+    for count, (module, name, working) in enumerate(steps):
+        if count < failing:
+            monkeypatch.setattr(module, name, raise_os_error)
+        elif working != None:
+            monkeypatch.setattr(module, name, working)
+    monkeypatch.setattr(HenPy, "STAGING_HARDLINKS", True)
+    monkeypatch.setattr(HenPy, "STAGED", HenPy.collections.Counter())
+
+    HenPy.stage_file(source, target)
+    assert HenPy.STAGED == {way: 1}
+    assert target.read_bytes() == source.read_bytes()
+    assert os.path.samefile(source, target) == (way == "hardlink")
+    assert other.read_bytes() == b"other"
+
+
+# 4 x 2 images whose left half is opaque and right half transparent, in RGBA only partly
+def transparent_image(mode):
+    if mode == "RGBA":
+        pixels = np.zeros((2, 4, 4), dtype=np.uint8)
+        pixels[:, :2] = (0, 0, 255, 255)
+        pixels[:, 2:] = (255, 0, 0, 85)
+        return HenPy.Image.fromarray(pixels, "RGBA")
+    if mode == "LA":
+        pixels = np.zeros((2, 4, 2), dtype=np.uint8)
+        pixels[:, :2] = (200, 255)
+        return HenPy.Image.fromarray(pixels, "LA")
+    image = HenPy.Image.new("P", (4, 2))
+    image.putpalette([255, 0, 0, 0, 255, 0])
+    image.paste(1, (2, 0, 4, 2))
+    image.info["transparency"] = 1
+    return image
+
+
+# average colour weighted by alpha, and the rows of the flattened image, partly transparent pixels blend into the average
+@pytest.mark.parametrize("mode, average, row", [
+    ("RGBA", (64, 0, 191), [(0, 0, 255)] * 2 + [(128, 0, 128)] * 2),
+    ("LA", (200, 200, 200), [(200, 200, 200)] * 4),
+    ("P", (255, 0, 0), [(255, 0, 0)] * 4),
+])
+def test_transparency_is_replaced_by_the_average_color(mode, average, row):
+    image = transparent_image(mode)
+    # modes with transparency are turned to RGBA before they are flattened, like encode_optimized_image does
+    assert HenPy.ImageCatalog.describe(image).alpha
+    image = image.convert("RGBA")
+    assert HenPy.average_color(image, (1, 2, 3)) == average
+    flattened = HenPy.remove_transparency(image, average)
+    assert flattened.mode == "RGB"
+    for y in range(2):
+        assert [flattened.getpixel((x, y)) for x in range(4)] == [pytest.approx(pixel, abs=1) for pixel in row]
+    assert HenPy.average_color(HenPy.Image.new("RGBA", (3, 3)), (1, 2, 3)) == (1, 2, 3)
+
+
+# JPEGs at or below OPTIMALIZATION_QUALITY keep their pixels and are not even opened when their header facts are known
+@pytest.mark.parametrize("quality, lossless", [(50, True), (70, True), (90, False)])
+def test_jpegs_at_or_below_the_quality_are_only_optimized_losslessly(tmp_path, monkeypatch, quality, lossless):
+    monkeypatch.setattr(HenPy, "OPTIMALIZATION_QUALITY", 70)
+    path = save(tmp_path / "photo.jpg", smooth_image(1), quality=quality)
+    with HenPy.Image.open(path) as image:
+        info = HenPy.ImageCatalog.describe(image)
+        pixels = np.asarray(image)
+    assert HenPy.losslessly_optimizable(info) == lossless
+
+    opened = []
+    open_image = HenPy.Image.open
+    monkeypatch.setattr(HenPy.Image, "open", lambda *args, **kwargs: opened.append(args[0]) or open_image(*args, **kwargs))
+    data = HenPy.encode_optimized_image(path, info)
+    assert opened == ([] if lossless else [path])
+
+    with open_image(HenPy.BytesIO(data)) as image:
+        assert round(HenPy.ImageCatalog.jpeg_quality(image.quantization)) == (quality if lossless else 70)
+        assert (np.asarray(image) == pixels).all() == lossless
+
+
+def test_manifest_tells_when_work_is_current(tmp_path):
+    manifest = HenPy.Manifest(tmp_path / "manifest.db")
+    source = save(tmp_path / "source.png", smooth_image(1))
+    output = save(tmp_path / "output.jpg", smooth_image(1))
+    upscaled = save(tmp_path / "upscaled.jpg", smooth_image(1))
+
+    assert manifest.current("optimalize base", source, "q70") == None
+    manifest.record("optimalize base", source, "q70", output)
+    manifest.record("upscale", output, "q70 x4", upscaled)
+    assert manifest.current("optimalize base", source, "q70") == output
+    assert manifest.current("optimalize base", source, "q80") == None
+    assert manifest.owner("optimalize base", output) == os.path.abspath(str(source))
+
+    # the chain keeps the origin of the base image
+    origin = manifest.file_hash(source)
+    assert manifest.lineage(upscaled) == (origin, "q70 x4")
+    assert manifest.produced("upscale", origin, "q70 x4")
+    manifest.close()
+
+    # changed content needs the work again, a missing output too
+    manifest = HenPy.Manifest(tmp_path / "manifest.db")
+    assert manifest.current("optimalize base", source, "q70") == output
+    time.sleep(0.01)
+    save(source, smooth_image(2))
+    assert manifest.current("optimalize base", source, "q70") == None
+    os.remove(upscaled)
+    assert not manifest.produced("upscale", origin, "q70 x4")
+    manifest.close()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_optimalize_images_reports_broken_images(henpy, monkeypatch, capsys, workers):
+    monkeypatch.setattr(henpy, "WORKERS", workers)
+    images = [save(henpy.BASE_DIR / "p{}.png".format(number), smooth_image(number)) for number in range(3)]
+    broken = henpy.BASE_DIR / "broken.png"
+    broken.write_bytes(os.urandom(2000))
+    henpy.IMAGES = images + [broken]
+    os.makedirs(henpy.OPTIMALIZED_IMGS_DIR_BASE)
+
+    henpy.optimalize_images(henpy.OPTIMALIZED_IMGS_DIR_BASE, "optimalize base")
+    assert sorted(os.listdir(henpy.OPTIMALIZED_IMGS_DIR_BASE)) == ["p0.jpg", "p1.jpg", "p2.jpg"]
+    for path in images:
+        new_path = henpy.OPTIMALIZED_IMGS_DIR_BASE / (path.stem + ".jpg")
+        with HenPy.Image.open(new_path) as image:
+            assert (image.format, image.size) == ("JPEG", (160, 120))
+        # the fingerprint made from the bytes in memory is the one dif makes from the file
+        assert (henpy.FINGERPRINTS[new_path] == dif._create_img_matrix(new_path, henpy.IMAGE_SIMILIARITY_PX_SIZE)).all()
+    out = capsys.readouterr().out
+    assert "Could not optimalize 1 image(s)" in out
+    assert str(broken) in out
+
+
+# stands in for optimalize_image in the workers and takes the worker down on the crashing image
+def crashing_optimalize(image, new_path, px_size, info):
+    if image.stem == "crash":
+        os._exit(1)
+    return OPTIMALIZE_IMAGE(image, new_path, px_size, info)
+
+
+OPTIMALIZE_IMAGE = HenPy.optimalize_image
+
+
+def test_optimalize_images_survives_a_dead_worker(henpy, monkeypatch, capsys):
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the workers only see the patched function when they are forked")
+    monkeypatch.setattr(henpy, "optimalize_image", crashing_optimalize)
+    images = [save(henpy.BASE_DIR / "p{}.png".format(number), smooth_image(number)) for number in range(4)]
+    crash = save(henpy.BASE_DIR / "crash.png", smooth_image(9, 400, 300))
+    henpy.IMAGES = [crash] + images
+    os.makedirs(henpy.OPTIMALIZED_IMGS_DIR_BASE)
+
+    henpy.optimalize_images(henpy.OPTIMALIZED_IMGS_DIR_BASE, "optimalize base")
+    # the images that were in the pool next to the crashing one are run again, only the crashing one is reported
+    assert sorted(os.listdir(henpy.OPTIMALIZED_IMGS_DIR_BASE)) == ["p0.jpg", "p1.jpg", "p2.jpg", "p3.jpg"]
+    out = capsys.readouterr().out
+    assert "Could not optimalize 1 image(s)" in out
+    assert "{} [BrokenProcessPool".format(crash) in out
+
+
+@pytest.mark.parametrize("inotify", [False, True])
+def test_directory_watch_takes_new_images_once(henpy, monkeypatch, inotify):
+    if inotify and henpy.LIBC == None:
+        pytest.skip("inotify is only on Linux")
+    if not inotify:
+        monkeypatch.setattr(henpy, "LIBC", None)
+
+    save(henpy.BASE_DIR / "old.png", smooth_image(1))
+    watch = henpy.DirectoryWatch(henpy.BASE_DIR)
+    assert (watch.fd != None) == inotify
+
+    def ready(expected):
+        taken = []
+        deadline = time.time() + 10
+        while len(taken) < len(expected) and time.time() < deadline:
+            watch.wait(0.05)
+            taken += watch.ready()
+        return sorted(taken)
+
+    new = save(henpy.BASE_DIR / "new.png", smooth_image(2))
+    (henpy.BASE_DIR / "notes.txt").write_text("not an image")
+    assert ready([new]) == [new]
+
+    os.makedirs(henpy.BASE_DIR / "sub" / "deeper")
+    nested = save(henpy.BASE_DIR / "sub" / "deeper" / "nested.jpg", smooth_image(3))
+    assert ready([nested]) == [nested]
+
+    # nothing changed since they were taken
+    watch.wait(0.2)
+    assert watch.ready() == []
+    watch.close()
+
+
+def test_streaming_cycle_upscales_every_picture_once(henpy):
+    base_corpus()
+    henpy.init()
+    henpy.streaming_cycle()
+
+    upscaled = library()
+    # one image of every picture, the mirrored one is a picture of its own
+    assert len(upscaled) == 3 * 2
+    assert all(HenPy.Image.open(path).size == (320, 240) for path in upscaled if "rotated" not in path.name)
+    assert dif(str(henpy.OPTIMALIZED_IMGS_DIR_UPSCALED), show_progress=False).result == {}
+    assert all(not (henpy.BASE_DIR / name).exists() for name in os.listdir(henpy.OPTIMALIZED_IMGS_DIR_BASE) if "offset3" in name)
+
+    # with the manifest nothing is done again
+    henpy.streaming_cycle()
+    assert library() == upscaled
+
+
+def test_streaming_cycle_survives_a_dead_worker(henpy, monkeypatch, capsys):
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the workers only see the patched function when they are forked")
+    monkeypatch.setattr(henpy, "optimalize_image", crashing_optimalize)
+    base_corpus()
+    crash = save(henpy.BASE_DIR / "crash.png", smooth_image(9, 400, 300))
+    henpy.init()
+    henpy.streaming_cycle()
+
+    # every picture gets through the stages, only the crashing image is held back and reported
+    assert len(library()) == 3 * 2
+    assert not (henpy.OPTIMALIZED_IMGS_DIR_BASE / "crash.jpg").exists()
+    out = capsys.readouterr().out
+    assert "Could not optimalize 1 image(s)" in out
+    assert "{} [BrokenProcessPool".format(crash) in out
+
+
+def test_streaming_and_stage_by_stage_cycles_agree(henpy):
+    base_corpus()
+    henpy.init()
+    henpy.streaming_cycle()
+    streamed = library_pictures()
+
+    for folder in (henpy.OPTIMALIZED_IMGS_DIR_BASE, henpy.OPTIMALIZED_IMGS_DIR_UPSCALED, henpy.UPSCALED_IMGS_DIR):
+        shutil.rmtree(folder)
+        os.makedirs(folder)
+    close()
+    os.remove(henpy.MANIFEST_PATH)
+    henpy.init()
+    henpy.full_cycle()
+    assert library_pictures() == streamed
+
+
+def test_watch_streams_new_images_through_one_pipeline(henpy, monkeypatch):
+    henpy.init()
+    batches, listed_dirs = [], []
+    pictures = iter(range(3))
+
+    # every call of the loop drops one picture with a duplicate into BASE_DIR, then it stops
+    def wait(self, timeout):
+        number = next(pictures, None)
+        if number == None:
+            raise KeyboardInterrupt
+        pixels = smooth_image(10 + number)
+        save(henpy.BASE_DIR / "w{}.png".format(number), pixels)
+        save(henpy.BASE_DIR / "w{}_copy.jpg".format(number), pixels, quality=95)
+        if number == 2:
+            # a copy of a picture of an earlier batch is a duplicate of its image in the library
+            save(henpy.BASE_DIR / "w0_again.png", smooth_image(10), pnginfo=text_chunk("again"))
+        self.compare()
+
+    stream_images = henpy.stream_images
+    index_directory = henpy.index_directory
+    monkeypatch.setattr(henpy.DirectoryWatch, "wait", wait)
+    monkeypatch.setattr(henpy, "stream_images", lambda pipeline=None: batches.append((pipeline, list(henpy.IMAGES))) or stream_images(pipeline))
+    monkeypatch.setattr(henpy, "index_directory", lambda DIR: listed_dirs.append(Path(DIR)) or index_directory(DIR))
+    henpy.watch_base_dir()
+
+    # the manifest makes it take what's in BASE_DIR first, there is nothing yet
+    assert [len(images) for pipeline, images in batches] == [0, 2, 2, 3]
+    assert len({id(pipeline) for pipeline, images in batches}) == 1
+    assert listed_dirs.count(henpy.OPTIMALIZED_IMGS_DIR_UPSCALED) == 1
+    assert listed_dirs.count(henpy.OPTIMALIZED_IMGS_DIR_BASE) == 1
+    assert listed_dirs.count(henpy.UPSCALED_IMGS_DIR) == 1
+    assert len(library()) == 3
+    assert not os.path.exists(batches[0][0].library.path)
+
+
+ASK_YN = HenPy.askYN
+
+
+# nobody answers while watching, nothing is deleted unless WATCH_AUTO_CONFIRM is set
+@pytest.mark.parametrize("confirm", [False, True])
+def test_questions_while_watching_get_watch_auto_confirm(henpy, monkeypatch, capsys, confirm):
+    monkeypatch.setattr(henpy, "WATCHING", True)
+    monkeypatch.setattr(henpy, "WATCH_AUTO_CONFIRM", confirm)
+    monkeypatch.setattr("builtins.input", raise_os_error)
+    assert ASK_YN("Delete duplicates?") == confirm
+    assert capsys.readouterr().out == "Delete duplicates? (y/n): {}\n".format("y" if confirm else "n")
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_duplicates_first_skips_duplicates_of_the_originals(henpy, monkeypatch, capsys, streaming):
+    originals = base_corpus()
+    monkeypatch.setattr(henpy, "DUPLICATES_FIRST", True)
+    monkeypatch.setattr(henpy, "PIPELINE_STREAMING", streaming)
+    henpy.init()
+    henpy.full_cycle()
+
+    # the rotated, brighter and resaved copies of every picture are skipped, the originals are kept
+    assert "Skipping 8 duplicate(s)" in capsys.readouterr().out
+    assert all(path.exists() for path in originals)
+    assert library_pictures() == ["p0", "p0_mirrored", "p1", "p1_mirrored", "p2", "p2_mirrored"]
+    # only what was left after them was optimalized
+    assert len(os.listdir(henpy.OPTIMALIZED_IMGS_DIR_BASE)) == 6
+
+
+# upscale backend that plays the outcomes given to it call by call: "fail" exits with 1, "hang" runs until it's stopped
+# and "ok" upscales the job at once, it keeps the images of every call
+class ScriptedBackend:
+    outcomes = []
+    calls = []
+    stopped = 0
+
+    def start(self, INPUT_DIR, OUTPUT_DIR):
+        outcome = self.outcomes[len(self.calls)]
+        self.calls.append(sorted(os.listdir(INPUT_DIR)))
+        if outcome == "ok":
+            HenPy.lanczos_upscale(str(INPUT_DIR), str(OUTPUT_DIR), HenPy.UPSCALE_SIZE, HenPy.UPSCALE_OUTPUT_FORMAT)
+        return outcome
+
+    def poll(self, handle):
+        return {"fail": 1, "hang": None, "ok": 0}[handle]
+
+    def stop(self, handle):
+        ScriptedBackend.stopped += 1
+
+
+def test_upscale_scheduler_retries_failed_and_killed_jobs_once_each(henpy, monkeypatch, capsys):
+    for name, value in (("UPSCALE_JOB_SIZE", 2), ("UPSCALE_CONCURRENT_JOBS", 1), ("UPSCALE_JOB_RETRIES", 2), ("UPSCALE_JOB_TIMEOUT", 0.05), ("UPSCALE_BACKEND", "scripted")):
+        monkeypatch.setattr(henpy, name, value)
+    monkeypatch.setitem(henpy.UPSCALE_BACKENDS, "scripted", ScriptedBackend)
+    # the first job fails, is killed and then ends well, the second one fails every time
+    monkeypatch.setattr(ScriptedBackend, "outcomes", ["fail", "hang", "ok", "fail", "fail", "fail"])
+    monkeypatch.setattr(ScriptedBackend, "calls", [])
+    monkeypatch.setattr(ScriptedBackend, "stopped", 0)
+    images = [save(henpy.BASE_DIR / "p{}.png".format(number), smooth_image(number, 40, 30)) for number in range(4)]
+    # a run that was interrupted left its staging folder behind, nothing of it may be taken
+    stale = henpy.UPSCALE_STAGING_DIR / "job_1" / "out"
+    os.makedirs(stale)
+    for image in (images[0], images[2]):
+        save(henpy.upscaled_path(image, stale), smooth_image(9, 80, 60))
+
+    os.makedirs(henpy.UPSCALED_IMGS_DIR)
+    scheduler = henpy.UpscaleScheduler(henpy.UPSCALED_IMGS_DIR)
+    scheduler.add(images)
+    done = []
+    deadline = time.time() + 10
+    while scheduler.busy() and time.time() < deadline:
+        done += scheduler.poll()
+        time.sleep(0.01)
+
+    first, second = ["p0.png", "p1.png"], ["p2.png", "p3.png"]
+    assert ScriptedBackend.calls == [first] * 3 + [second] * 3
+    assert ScriptedBackend.stopped == 1
+    assert done == [(image, henpy.upscaled_path(image, henpy.UPSCALED_IMGS_DIR)) for image in images[:2]]
+    assert sorted(os.listdir(henpy.UPSCALED_IMGS_DIR)) == [upscale.name for image, upscale in done]
+    with HenPy.Image.open(done[0][1]) as upscale:
+        assert upscale.size == (80, 60)
+        assert (np.asarray(upscale.convert("RGB").resize((40, 30))).astype(int) - smooth_image(0, 40, 30)).std() < 10
+    assert scheduler.failed == {images[2]: "exit code 1", images[3]: "exit code 1"}
+    assert os.listdir(henpy.UPSCALE_STAGING_DIR) == []
+
+    scheduler.report()
+    out = capsys.readouterr().out
+    assert "Could not upscale 2 image(s)" in out
+    assert "{} [exit code 1]".format(images[2]) in out
+
+
+def test_time_budget_holds_back_jobs_expected_to_run_past_it(henpy, monkeypatch):
+    monkeypatch.setattr(henpy, "UPSCALE_TIME_BUDGET", 10)
+    henpy.init()
+
+    scheduler = henpy.UpscaleScheduler(henpy.UPSCALED_IMGS_DIR)
+    job = {"images": [], "pixels": [1000000] * 4}
+    scheduler.began = time.time()
+    # nothing is known before the first job ends
+    assert scheduler.fits(job)
+    henpy.UPSCALE_COSTS.record([1000000] * 4, 20)
+    assert not scheduler.fits(job)
+    assert scheduler.fits({"images": [], "pixels": [100000]})
+
+    # the next run knows the jobs of this one
+    close()
+    henpy.init()
+    assert henpy.UPSCALE_COSTS.predict([1000000] * 4) == pytest.approx(20)
+
+
+def test_upscale_costs_fit_the_recorded_jobs(henpy, tmp_path, monkeypatch):
+    costs = henpy.UpscaleCosts(tmp_path / "costs.db")
+    assert costs.predict([1000]) == None and costs.image_cost(1000) == None
+    # jobs that took 2 seconds to start, 0.5 per image and 3 per million upscaled pixels, UPSCALE_SIZE is 2
+    def seconds(pixels):
+        return 2 + 0.5 * len(pixels) + 3e-6 * sum(pixels) * 4
+
+    for pixels in ([100000], [200000, 50000], [400000] * 3, [10000] * 8, [300000, 20000, 80000, 5000]):
+        costs.record(pixels, seconds(pixels))
+    # jobs of another backend are not fitted
+    monkeypatch.setattr(henpy, "UPSCALE_BACKEND", "realesrgan")
+    costs.record([100000], 1000)
+    monkeypatch.setattr(henpy, "UPSCALE_BACKEND", "lanczos")
+
+    assert costs.fit() == pytest.approx((2, 0.5, 3e-6))
+    assert costs.predict([250000, 125000]) == pytest.approx(seconds([250000, 125000]))
+    assert costs.image_cost(250000) == pytest.approx(2 / henpy.UPSCALE_JOB_SIZE + 0.5 + 3e-6 * 250000 * 4)
+
+    costs.close()
+
+    # jobs that would need a negative start are fitted without one
+    costs = henpy.UpscaleCosts(tmp_path / "negative.db")
+    for images in range(1, 9):
+        costs.record([100000] * images, images * 2 - 1)
+    start, per_image, per_pixel = costs.fit()
+    assert start == 0 and per_image > 0 and per_pixel >= 0
+    costs.close()
+
+
+# every image costs 1 second per 10000 pixels, the budget is filled by gain per second and an image that doesn't fit is passed over
+def test_plan_upscales_picks_the_most_gain_per_second(henpy, tmp_path, monkeypatch):
+    monkeypatch.setattr(henpy, "UPSCALE_COSTS", henpy.UpscaleCosts(tmp_path / "costs.db"))
+    images = {name: save(henpy.BASE_DIR / "{}.png".format(name), smooth_image(1, width, height)) for name, width, height in (("a", 100, 100), ("b", 200, 100), ("c", 300, 200), ("d", 400, 300))}
+    order = [images[name] for name in "dcba"]
+
+    assert henpy.plan_upscales(order) == (order, [])
+    monkeypatch.setattr(henpy, "UPSCALE_TIME_BUDGET", 7.5)
+    # nothing is known yet, the images are ordered by gain and the scheduler keeps to the budget
+    assert henpy.plan_upscales(order) == ([images[name] for name in "abcd"], [])
+
+    for pixels in ([10000], [20000, 60000], [120000] * 2):
+        henpy.UPSCALE_COSTS.record(pixels, sum(pixels) / 10000)
+    assert henpy.UPSCALE_COSTS.image_cost(60000) == pytest.approx(6)
+    assert henpy.plan_upscales(order) == ([images["a"], images["b"]], [images["c"], images["d"]])
+
+    # images left for the next runs gain more, c goes before b, which then doesn't fit anymore
+    henpy.UPSCALE_COSTS.defer([images["c"]] * 3)
+    assert henpy.plan_upscales(order) == ([images["a"], images["c"]], [images["b"], images["d"]])
+    # d goes first but never fits, it's passed over for the cheaper ones
+    henpy.UPSCALE_COSTS.defer([images["d"]] * 20)
+    assert henpy.plan_upscales(order) == ([images["a"], images["c"]], [images["d"], images["b"]])
+
+
+def test_time_budget_without_costs_file_learns_from_the_run(henpy, monkeypatch):
+    monkeypatch.setattr(henpy, "UPSCALE_COSTS_PATH", None)
+    monkeypatch.setattr(henpy, "UPSCALE_TIME_BUDGET", 10)
+    henpy.init()
+
+    # the jobs that ended earlier in the run are known
+    scheduler = henpy.UpscaleScheduler(henpy.UPSCALED_IMGS_DIR)
+    scheduler.began = time.time()
+    henpy.UPSCALE_COSTS.record([1000000] * 4, 20)
+    assert not scheduler.fits({"images": [], "pixels": [1000000] * 4})
+
+
+def test_memory_budget_admits_jobs_while_they_fit(henpy, monkeypatch):
+    monkeypatch.setattr(henpy, "OPTIMALIZATION_MEMORY_BUDGET", 1)
+    megabyte = 1024 * 1024
+    budget = henpy.MemoryBudget()
+    assert budget.limit == megabyte
+
+    # a job bigger than the whole budget still runs, alone
+    assert budget.fits(3 * megabyte)
+    budget.admit("big", 3 * megabyte)
+    assert not budget.fits(1)
+    budget.release("big")
+
+    budget.admit("first", megabyte // 2)
+    assert budget.fits(megabyte // 2)
+    budget.admit("second", megabyte // 2)
+    assert not budget.fits(1)
+    budget.release("first")
+    assert budget.fits(megabyte // 2) and not budget.fits(megabyte // 2 + 1)
+    budget.release("second")
+    # a job released twice is only taken off once
+    budget.release("second")
+    assert (budget.used, budget.jobs, budget.peak, budget.largest) == (0, {}, 3 * megabyte, 3 * megabyte)
+
+    image = save(henpy.BASE_DIR / "image.png", smooth_image(1))
+    assert budget.estimate(image) == henpy.optimalization_memory(henpy.image_info(image)) > 0
+    # without a limit every job fits and no header is read
+    monkeypatch.setattr(henpy, "OPTIMALIZATION_MEMORY_BUDGET", 0)
+    budget = henpy.MemoryBudget()
+    assert budget.estimate(henpy.BASE_DIR / "missing.png") == 0
+    budget.admit("big", 3 * megabyte)
+    assert budget.fits(3 * megabyte)
+
+
+def test_memory_budget_without_sysconf_falls_back(henpy, monkeypatch, capsys):
+    assert henpy.memory_budget() == henpy.physical_memory() // 2
+    monkeypatch.setattr(henpy.os, "sysconf", lambda name: (_ for _ in ()).throw(ValueError(name)), raising=False)
+    assert henpy.physical_memory() == None
+    assert henpy.memory_budget() == henpy.FALLBACK_MEMORY_BUDGET * 1024 * 1024
+
+    henpy.init()
+    assert "Could not find out the memory" in capsys.readouterr().out
+    monkeypatch.setattr(henpy, "OPTIMALIZATION_MEMORY_BUDGET", 0)
+    assert henpy.memory_budget() == None